@@ -4,30 +4,86 @@ This file defines API routes and orchestrates
 the different components of the system
 """
 
-from application_api.model.pydantic_models import QueryInput, QueryResponse, DocumentInfo, DeleteFileRequest
+from application_api.model.pydantic_models import QueryInput, QueryResponse, DocumentInfo, DeleteFileRequest, \
+    IngestionJobInfo, BatchQueryInput, DocumentManifest, DocumentStats, DocumentSortField, SortOrder, \
+    ReindexFileRequest, DocumentStatus
 from application_api.utils.chroma_utils import ChromaUtils
 from application_api.utils.langchain_utils import LangChainUtils
-from application_api.utils.db_utils import DBUtils
+from application_api.utils.db_utils import DBUtils, AsyncDBUtils
+from application_api.utils.job_queue import IngestionJobQueue
+from application_api.utils.model_registry import ModelRegistry
+from application_api.utils.history_utils import ChatHistoryManager
+from application_api.utils.metrics import metrics, MetricsMiddleware
+from application_api.utils.upload_utils import UploadSpooler, SpooledUpload
+from application_api.utils.document_deleter import DocumentDeleter
+from application_api.utils.config import Config
+from application_api.utils.writer_lock import WriterLock
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request, Response, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from langchain_core.documents import Document
 import os
+import json
+import asyncio
 import uuid
 import logging
-import shutil
-from typing import List, Dict, Text, Any
+import time
+from typing import List, Dict, Text, Any, AsyncIterator, Optional, Set, Tuple
 
 logging.basicConfig(filename='app.log', level=logging.INFO)
 
 app: FastAPI = FastAPI()
 
 db_utils: DBUtils = DBUtils()
+async_db_utils: AsyncDBUtils = AsyncDBUtils(db_utils)
 langchain_utils: LangChainUtils = LangChainUtils()
-chroma_utils: ChromaUtils = ChromaUtils()
+chroma_utils: ChromaUtils = ChromaUtils(on_chunks_written=db_utils.insert_document_chunks)
+document_deleter: DocumentDeleter = DocumentDeleter(
+    db_utils, chroma_utils, on_deleted=langchain_utils.answer_cache.invalidate_file
+)
+job_queue: IngestionJobQueue = IngestionJobQueue(
+    db_utils, chroma_utils, document_deleter, on_indexed=langchain_utils.answer_cache.invalidate_file
+)
+history_manager: ChatHistoryManager = ChatHistoryManager(db_utils, langchain_utils)
+upload_spooler: UploadSpooler = UploadSpooler(allowed_extensions=['.pdf', '.docx', '.html'])
+# Reranking falls back to retrieval order when it exceeds its latency budget, as the first one would with loading
+if langchain_utils.retriever.reranker is not None:
+    langchain_utils.retriever.reranker.warm_up()
+# Answers cached by this worker may be stale once another process changed the documents
+chroma_utils.bm25_index.on_reloaded = langchain_utils.answer_cache.clear
+
+
+def start_writer() -> None:
+    """
+    Starts the work done only by the one process writing the indexes,
+    the other workers queue uploads and deletions for it in the database
+    :return:
+    """
+
+    chroma_utils.ensure_bm25_index()
+    # Jobs resumed by the queue delete documents, that fail to index
+    document_deleter.start()
+    job_queue.start()
+
 
 db_utils.create_application_logs()
+db_utils.create_session_summaries()
 db_utils.create_document_store()
+db_utils.create_document_chunks()
+db_utils.create_ingestion_jobs()
+writer_lock: WriterLock = WriterLock(Config.WRITER_LOCK_PATH, on_acquired=start_writer)
+# Another process holds the lock. Embedded Chroma keeps the index in the memory of every process
+# and never sees chunks another process writes, so the workers have to share a Chroma server
+if not writer_lock.start() and Config.VECTOR_STORE == 'chroma' and not Config.CHROMA_HOST:
+    raise RuntimeError(
+        f'Another process writes the indexes (lock {Config.WRITER_LOCK_PATH} is held). Several workers need '
+        'a Chroma server (RAG_CHROMA_HOST) or RAG_VECTOR_STORE=quantized'
+    )
 
+app.add_middleware(MetricsMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:8501"],
@@ -37,104 +93,418 @@ app.add_middleware(
 )
 
 
+def parse_tags(value: str) -> List[str]:
+    """
+    Parses comma-separated tags, dropping blanks and repeats
+    :param value:
+    :return:
+    """
+
+    return list(dict.fromkeys(tag.strip() for tag in value.split(',') if tag.strip()))
+
+
+async def resolve_file_ids(query_input: QueryInput) -> Optional[List[int]]:
+    """
+    Returns ids of documents the query is limited to: the given
+    documents and documents having any of the given tags
+    :param query_input:
+    :return: None if the query searches all documents
+    """
+
+    if query_input.file_ids is None and query_input.tags is None:
+        return None
+
+    file_ids: Set[int] = set(query_input.file_ids or [])
+    if query_input.tags:
+        file_ids.update(await async_db_utils.get_file_ids_by_tags(query_input.tags))
+    return sorted(file_ids)
+
+
 @app.post('/', response_model=QueryResponse)
-def chat(query_input: QueryInput) -> QueryResponse:
+async def chat(query_input: QueryInput, background_tasks: BackgroundTasks) -> QueryResponse:
     """
-    Endpoint, that handles chat operations
+    Endpoint, that handles chat operations. Durations of the chat stages
+    are returned with the answer if include_timings is set
     :param query_input:
+    :param background_tasks:
     :return:
     """
 
+    started: float = time.perf_counter()
     session_id: str = query_input.session_id or str(uuid.uuid4())
     logging.info(
         f'Session ID: {session_id}, User Query: {query_input.question}, Model: {query_input.model.value}'
     )
 
-    chat_history: List[Dict[Text, Text]] = db_utils.get_chat_history(session_id)
-    rag_chain: Any = langchain_utils.get_rag_chain()
+    with metrics.collect_timings({} if query_input.include_timings else None) as timings:
+        chat_history: List[Dict[Text, Text]] = await async_db_utils.run(
+            history_manager.get_chat_history, session_id
+        )
+        file_ids: Optional[List[int]] = await resolve_file_ids(query_input)
+
+        result: Dict[Text, Any] = await langchain_utils.aanswer(
+            query_input.question, chat_history, query_input.model.value, file_ids
+        )
+        answer: str = result['answer']
+        await async_db_utils.insert_application_logs(
+            session_id, query_input.question, answer, query_input.model.value
+        )
 
-    answer = rag_chain.invoke({
-        'input': query_input.question,
-        'chat_history': chat_history
-    })['answer']
-    db_utils.insert_application_logs(session_id, query_input.question, answer, query_input.model.value)
     logging.info(f'Session ID: {session_id}, AI Response: {answer}')
+    background_tasks.add_task(history_manager.refresh_summary, session_id, query_input.model.value)
     print(answer)
-    return QueryResponse(answer=answer, session_id=session_id, model=query_input.model)
+
+    if timings is not None:
+        timings['total'] = round(time.perf_counter() - started, 6)
+    return QueryResponse(
+        answer=answer, session_id=session_id, model=query_input.model, cached=result['cached'], timings=timings
+    )
 
 
-@app.post('/upload-doc')
-def upload_and_index_document(file: UploadFile = File(...)) -> Dict[Text, Text]:
+@app.post('/chat/stream')
+async def chat_stream(query_input: QueryInput) -> StreamingResponse:
     """
-    Endpoint, that handles document upload and
-    updates document record in database
-    :param file:
+    Endpoint, that handles chat operations and streams the answer
+    as newline-delimited JSON events: the retrieved context first,
+    then answer tokens as they are generated and a final end event,
+    that carries durations of the chat stages if include_timings is set
+    :param query_input:
     :return:
     """
 
-    allowed_extensions: list[str] = ['.pdf', '.docx', '.html']
-    file_extension: str = os.path.splitext(file.filename)[1].lower()
+    started: float = time.perf_counter()
+    session_id: str = query_input.session_id or str(uuid.uuid4())
+    logging.info(
+        f'Session ID: {session_id}, User Query: {query_input.question}, Model: {query_input.model.value}'
+    )
 
-    if file_extension not in allowed_extensions:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported file type. Allowed types are: {','.join(allowed_extensions)}"
+    timings: Optional[Dict[Text, float]] = {} if query_input.include_timings else None
+    with metrics.collect_timings(timings):
+        chat_history: List[Dict[Text, Text]] = await async_db_utils.run(
+            history_manager.get_chat_history, session_id
         )
+        file_ids: Optional[List[int]] = await resolve_file_ids(query_input)
 
-    temp_file_path: str = f'temp_{file.filename}'
+    async def generate_events() -> AsyncIterator[Text]:
+        answer_parts: List[Text] = []
 
-    try:
-        # Saving the uploaded file to a temporary file
-        with open(temp_file_path, 'wb') as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        file_id: int = db_utils.insert_document_record(file.filename)
-        success: bool = chroma_utils.index_document_to_chroma(temp_file_path, file_id)
-
-        if success:
-            return {
-                'message': f'File {file.filename} has been successfully uploaded and indexed.',
-                'file_id': str(file_id)
-            }
-        else:
-            db_utils.delete_document_record(file_id)
-            raise HTTPException(status_code=500, detail=f'Failed to index {file.filename}')
-    finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        with metrics.collect_timings(timings):
+            try:
+                async for chunk in langchain_utils.astream_answer(
+                        query_input.question, chat_history, query_input.model.value, file_ids
+                ):
+                    if 'context' in chunk:
+                        context: List[Document] = chunk['context']
+                        yield json.dumps({
+                            'type': 'context',
+                            'context_ids': [doc.id for doc in context],
+                            'file_ids': [doc.metadata.get('file_id') for doc in context]
+                        }) + '\n'
+                    if 'answer' in chunk:
+                        answer_parts.append(chunk['answer'])
+                        yield json.dumps({'type': 'token', 'content': chunk['answer']}) + '\n'
+            except Exception as e:
+                logging.error(f'Session ID: {session_id}, Streaming failed: {str(e)}')
+                yield json.dumps({'type': 'error', 'detail': str(e)}) + '\n'
+                return
+
+            answer: str = ''.join(answer_parts)
+            await async_db_utils.insert_application_logs(
+                session_id, query_input.question, answer, query_input.model.value
+            )
+
+        logging.info(f'Session ID: {session_id}, AI Response: {answer}')
+        end_event: Dict[Text, Any] = {'type': 'end', 'session_id': session_id, 'model': query_input.model.value}
+        if timings is not None:
+            timings['total'] = round(time.perf_counter() - started, 6)
+            end_event['timings'] = timings
+        yield json.dumps(end_event) + '\n'
+
+    return StreamingResponse(
+        generate_events(),
+        media_type='application/x-ndjson',
+        background=BackgroundTask(history_manager.refresh_summary, session_id, query_input.model.value)
+    )
+
+
+@app.post('/batch')
+async def batch_chat(batch_input: BatchQueryInput) -> StreamingResponse:
+    """
+    Endpoint, that answers a batch of chat queries, for example to regression-test
+    the knowledge base. Results are streamed as newline-delimited JSON events
+    as every answer is ready: result or error events carrying the position
+    of the query in the batch, then a final end event. History is read once
+    per session before the batch, so queries of the same session do not see
+    each other, and logs are written in a single transaction
+    :param batch_input:
+    :return:
+    """
+
+    queries: List[QueryInput] = batch_input.queries
+    session_ids: List[str] = [query.session_id or str(uuid.uuid4()) for query in queries]
+    logging.info(f'Batch of {len(queries)} queries')
+
+    known_sessions: List[str] = list({query.session_id for query in queries if query.session_id})
+    histories: Dict[str, List[Dict[Text, Text]]] = dict(zip(known_sessions, await asyncio.gather(*(
+        async_db_utils.run(history_manager.get_chat_history, session_id) for session_id in known_sessions
+    ))))
+    file_ids: List[Optional[List[int]]] = await asyncio.gather(*(resolve_file_ids(query) for query in queries))
+
+    async def generate_events() -> AsyncIterator[Text]:
+        logs: List[Tuple[str, str, str, str]] = []
+        failed: int = 0
+
+        try:
+            async for position, result in langchain_utils.abatch_answer(
+                    [
+                        (query.question, histories.get(query.session_id, []), query.model.value, query_file_ids)
+                        for query, query_file_ids in zip(queries, file_ids)
+                    ],
+                    batch_input.max_concurrency
+            ):
+                if 'error' in result:
+                    failed += 1
+                    logging.error(f'Batch query {position} failed: {result["error"]}')
+                    yield json.dumps({'type': 'error', 'index': position, 'detail': result['error']}) + '\n'
+                    continue
+
+                query: QueryInput = queries[position]
+                logs.append((session_ids[position], query.question, result['answer'], query.model.value))
+                yield json.dumps({
+                    'type': 'result',
+                    'index': position,
+                    'answer': result['answer'],
+                    'session_id': session_ids[position],
+                    'model': query.model.value,
+                    'cached': result['cached']
+                }) + '\n'
+        except Exception as e:
+            logging.error(f'Batch failed: {str(e)}')
+            yield json.dumps({'type': 'error', 'detail': str(e)}) + '\n'
+        finally:
+            # Answers streamed before a failure or a disconnect are logged as well
+            if logs:
+                await async_db_utils.insert_application_logs_batch(logs)
+
+        yield json.dumps({'type': 'end', 'answered': len(logs), 'failed': failed}) + '\n'
+
+    return StreamingResponse(generate_events(), media_type='application/x-ndjson')
+
+
+@app.post('/upload-doc', openapi_extra={
+    'requestBody': {
+        'required': True,
+        'content': {'multipart/form-data': {'schema': {
+            'type': 'object',
+            'required': ['file'],
+            'properties': {'file': {'type': 'string', 'format': 'binary'}, 'tags': {'type': 'string'}}
+        }}}
+    }
+})
+async def upload_and_index_document(request: Request, force: bool = False) -> Dict[Text, Text]:
+    """
+    Endpoint, that handles document upload, creates document
+    record in database and queues the document for indexing.
+    The file is streamed into the upload directory as it arrives.
+    Already indexed content is not indexed again unless force is set.
+    Comma-separated tags can be sent in the tags field, non-blank tags
+    replace tags of an already uploaded document with the same content
+    :param request: multipart request with the document in the file field
+    :param force:
+    :return:
+    """
+
+    job_id: str = str(uuid.uuid4())
+    file: SpooledUpload = await upload_spooler.spool(
+        request, lambda file_extension: job_queue.get_upload_path(job_id, file_extension)
+    )
+    file_path: str = file.file_path
+    content_hash: str = file.content_hash
+    # A blank field, as forms send for an empty input, leaves tags of an already uploaded document unchanged
+    tags: Optional[List[str]] = parse_tags(file.fields['tags']) if file.fields.get('tags', '').strip() else None
+
+    existing_document: Optional[Dict[Text, Any]] = await async_db_utils.get_document_by_hash(content_hash)
+    if existing_document and tags is not None:
+        await async_db_utils.update_document_tags(existing_document['id'], tags)
+    if existing_document and not force:
+        await run_in_threadpool(os.remove, file_path)
+        return {
+            'message': f'File {file.filename} is already indexed as {existing_document["filename"]}.',
+            'file_id': str(existing_document['id']),
+            'duplicate': 'true'
+        }
+
+    if existing_document:
+        file_id: int = existing_document['id']
+    else:
+        file_id: int = await async_db_utils.insert_document_record(file.filename, content_hash, tags, file.size)
+    await async_db_utils.run(
+        job_queue.submit, job_id, file_id, file.filename, file_path, replace_existing=existing_document is not None
+    )
+
+    return {
+        'message': f'File {file.filename} has been successfully uploaded and queued for indexing.',
+        'file_id': str(file_id),
+        'job_id': job_id
+    }
+
+
+@app.get('/jobs', response_model=List[IngestionJobInfo])
+async def list_ingestion_jobs() -> List[IngestionJobInfo]:
+    """
+    Returns list of ingestion jobs with their progress
+    :return:
+    """
+
+    return [IngestionJobInfo(**job) for job in await async_db_utils.get_ingestion_jobs()]
+
+
+@app.get('/jobs/{job_id}', response_model=IngestionJobInfo)
+async def get_ingestion_job(job_id: str) -> IngestionJobInfo:
+    """
+    Returns status and progress of an ingestion job
+    :param job_id:
+    :return:
+    """
+
+    job: Optional[Dict[Text, Any]] = await async_db_utils.get_ingestion_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Ingestion job {job_id} not found')
+    return IngestionJobInfo(**job)
 
 
 @app.get('/list-docs', response_model=List[DocumentInfo])
-def list_documents() -> List[DocumentInfo]:
+async def list_documents(
+        response: Response,
+        limit: Optional[int] = Query(default=None, ge=1, le=1000),
+        offset: int = Query(default=0, ge=0),
+        sort_by: DocumentSortField = DocumentSortField.UPLOAD_TIMESTAMP,
+        order: SortOrder = SortOrder.DESC
+) -> List[DocumentInfo]:
+    """
+    Returns page of indexed documents with their manifests, all documents without limit.
+    Number of all documents is returned in the X-Total-Count header
+    :param response:
+    :param limit:
+    :param offset:
+    :param sort_by:
+    :param order:
+    :return:
     """
-    Returns list of indexed documents
+
+    documents: List[Dict] = await async_db_utils.get_all_documents(
+        limit, offset, sort_by.value, order == SortOrder.DESC
+    )
+    response.headers['X-Total-Count'] = str(await async_db_utils.count_documents())
+    return [DocumentInfo(**doc) for doc in documents]
+
+
+@app.get('/documents/{file_id}', response_model=DocumentManifest)
+async def get_document(file_id: int, include_chunk_ids: bool = False) -> DocumentManifest:
+    """
+    Returns manifest of a document, optionally with ids of its chunks
+    :param file_id:
+    :param include_chunk_ids:
     :return:
     """
 
-    documents: List[Dict] = db_utils.get_all_documents()
-    return [
-        DocumentInfo(id=doc['id'], filename=doc['filename'], upload_timestamp=doc['upload_timestamp'])
-        for doc in documents
-    ]
+    document: Optional[Dict[Text, Any]] = await async_db_utils.get_document(file_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail=f'Document {file_id} not found')
+    chunk_ids: Optional[List[str]] = await async_db_utils.get_document_chunk_ids(file_id) if include_chunk_ids else None
+    return DocumentManifest(**document, chunk_ids=chunk_ids)
+
+
+@app.get('/document-stats', response_model=DocumentStats)
+async def get_document_stats() -> DocumentStats:
+    """
+    Returns number of documents, chunks, bytes and pages indexed
+    :return:
+    """
+
+    return DocumentStats(**await async_db_utils.get_document_stats())
+
+
+@app.post('/reindex-doc')
+async def reindex_document(request: ReindexFileRequest) -> Dict[Text, Text]:
+    """
+    Endpoint embeds chunks of a document again with the current embedding model
+    :param request:
+    :return:
+    """
+
+    document: Optional[Dict[Text, Any]] = await async_db_utils.get_document(request.file_id)
+    if document is None or document['status'] != DocumentStatus.ACTIVE.value:
+        raise HTTPException(status_code=404, detail=f'Document {request.file_id} not found')
+
+    try:
+        reembedded: int = await run_in_threadpool(job_queue.reembed_document, request.file_id)
+    except Exception as e:
+        print(f'Error re-indexing document with file_id {request.file_id}: {str(e)}')
+        return {'error': f'Failed to re-index document with file_id {request.file_id}.'}
+    return {'message': f'Re-embedded {reembedded} chunks of document with file_id {request.file_id}.'}
 
 
 @app.post('/delete-doc')
-def delete_document(request: DeleteFileRequest) -> Dict[Text, Text]:
+async def delete_document(request: DeleteFileRequest) -> Dict[Text, Text]:
     """
-    Endpoint handles document deletion, removing
-    the document from the Chroma and database
+    Endpoint handles deletion of a document (file_id) or several documents (file_ids),
+    removing their chunks from Chroma by recorded ids and marking them deleted in the database
     :param request:
     :return:
     """
 
-    chroma_delete_success: bool = chroma_utils.delete_doc_from_chroma(request.file_id)
+    file_ids: List[int] = list(dict.fromkeys(
+        ([request.file_id] if request.file_id is not None else []) + request.file_ids
+    ))
+    if not file_ids:
+        raise HTTPException(status_code=400, detail='No file_id given.')
 
-    if chroma_delete_success:
-        db_delete_success: bool = db_utils.delete_document_record(request.file_id)
-        if db_delete_success:
-            return {'message': f'Successfully deleted document with file_id {request.file_id} from system.'}
-        else:
-            return {'error': f'Deleted from Chroma but failed to delete document with file_id {request.file_id}'
-                             f' from the database.'}
-    else:
-        return {'error': f'Failed to delete document with file_id {request.file_id} from Chroma.'}
+    results: Dict[int, bool] = await run_in_threadpool(document_deleter.delete_documents, file_ids)
+    failed: List[int] = [file_id for file_id, deleted in results.items() if not deleted]
+
+    if len(file_ids) == 1:
+        if failed:
+            return {'error': f'Failed to delete document with file_id {file_ids[0]}.'}
+        return {'message': f'Successfully deleted document with file_id {file_ids[0]} from system.'}
+    if failed:
+        return {'error': f'Failed to delete documents with file_ids {", ".join(map(str, failed))}.'}
+    return {'message': f'Successfully deleted documents with file_ids {", ".join(map(str, file_ids))} from system.'}
+
+
+@app.get('/cache-stats')
+def get_cache_stats() -> Dict[Text, Any]:
+    """
+    Returns hit/miss statistics of the caches used by the system
+    :return:
+    """
+
+    cache_stats: Dict[Text, Any] = {
+        'embeddings': ModelRegistry.get_embedding_function().get_stats(),
+        'question_rewrites': langchain_utils.question_rewriter.get_stats(),
+        'answers': langchain_utils.answer_cache.get_stats()
+    }
+    if langchain_utils.retriever.reranker is not None:
+        cache_stats['reranker'] = langchain_utils.retriever.reranker.get_stats()
+    return cache_stats
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """
+    Returns stage latency histograms, generation speed, retrieved chunk counts,
+    cache hit rates and in-flight requests in the Prometheus text format
+    :return:
+    """
+
+    cache_stats: Dict[Text, Any] = await run_in_threadpool(get_cache_stats)
+    cache_counts: Dict[str, Tuple[int, int]] = {
+        'embeddings': (cache_stats['embeddings']['hits'], cache_stats['embeddings']['misses']),
+        'question_rewrites': (
+            cache_stats['question_rewrites']['cache_hits'], cache_stats['question_rewrites']['rewrites']
+        ),
+        'answers': (cache_stats['answers']['hits'], cache_stats['answers']['misses'])
+    }
+    if 'reranker' in cache_stats:
+        cache_counts['reranker'] = (cache_stats['reranker']['hits'], cache_stats['reranker']['misses'])
+    return PlainTextResponse(metrics.render(cache_counts), media_type='text/plain; version=0.0.4')
@@ -0,0 +1,54 @@
+"""
+The entry point of the embedding service.
+A single process loads the embedding model and its cache and
+embeds texts for all API workers, which reach it through
+RAG_EMBEDDING_SERVICE_URL
+"""
+
+from application_api.model.pydantic_models import EmbeddingKind, EmbeddingRequest, EmbeddingResponse
+from application_api.utils.embedding_cache import CachedEmbeddings
+from application_api.utils.model_registry import ModelRegistry
+
+from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+from typing import Any, Dict, List, Text
+
+app: FastAPI = FastAPI()
+
+embedding_function: CachedEmbeddings = ModelRegistry.get_local_embedding_function()
+
+
+@app.get('/info')
+def get_info() -> Dict[Text, Any]:
+    """
+    Returns name of the model texts are embedded with
+    :return:
+    """
+
+    return {'model_name': embedding_function.model_name}
+
+
+@app.post('/embed', response_model=EmbeddingResponse)
+async def embed(request: EmbeddingRequest) -> EmbeddingResponse:
+    """
+    Embeds texts through the embedding cache. Queries are computed
+    in a single batch, like documents
+    :param request:
+    :return:
+    """
+
+    if request.kind == EmbeddingKind.QUERY:
+        vectors: List[List[float]] = await run_in_threadpool(embedding_function.embed_queries, request.texts)
+    else:
+        vectors: List[List[float]] = await run_in_threadpool(embedding_function.embed_documents, request.texts)
+    return EmbeddingResponse(model_name=embedding_function.model_name, vectors=vectors)
+
+
+@app.get('/stats')
+def get_stats() -> Dict[Text, Any]:
+    """
+    Returns hit/miss statistics of the embedding cache
+    :return:
+    """
+
+    return embedding_function.get_stats()
@@ -7,6 +7,7 @@ type safety and clear API contracts
 from pydantic import BaseModel, Field
 from enum import Enum
 from datetime import datetime
+from typing import Dict, List, Optional
 
 
 class ModelName(str, Enum):
@@ -27,6 +28,10 @@ class QueryInput(BaseModel):
     question: str
     session_id: str = Field(default=None)
     model: ModelName = Field(default=ModelName.LLAMA3)
+    include_timings: bool = False
+    # Search is limited to these documents and documents having any of the tags, all documents if both are None
+    file_ids: Optional[List[int]] = None
+    tags: Optional[List[str]] = None
 
 
 class QueryResponse(BaseModel):
@@ -37,6 +42,18 @@ class QueryResponse(BaseModel):
     answer: str
     session_id: str
     model: ModelName
+    cached: bool = False
+    timings: Optional[Dict[str, float]] = None
+
+
+class BatchQueryInput(BaseModel):
+    """
+    Represents a batch of chat queries answered together
+    """
+
+    queries: List[QueryInput] = Field(min_length=1, max_length=10000)
+    # Generations running at once for every model
+    max_concurrency: int = Field(default=4, ge=1, le=64)
 
 
 class DocumentInfo(BaseModel):
@@ -46,12 +63,138 @@ class DocumentInfo(BaseModel):
 
     id: int
     filename: str
+    tags: List[str] = []
     upload_timestamp: datetime
+    # Manifest recorded when the document is uploaded and indexed
+    content_hash: Optional[str] = None
+    byte_size: Optional[int] = None
+    chunk_count: int = 0
+    page_count: int = 0
+    embedding_model: Optional[str] = None
+    status: str = 'active'
+    indexed_at: Optional[datetime] = None
+
+
+class DocumentManifest(DocumentInfo):
+    """
+    Represents metadata about an indexed document together with ids of its chunks
+    """
+
+    chunk_ids: Optional[List[str]] = None
+
+
+class DocumentStats(BaseModel):
+    """
+    Represents totals over all indexed documents
+    """
+
+    documents: int
+    chunks: int
+    bytes: int
+    pages: int
+    chunks_by_embedding_model: Dict[str, int]
+
+
+class DocumentSortField(str, Enum):
+    """
+    Defines the manifest fields documents can be listed by
+    """
+
+    UPLOAD_TIMESTAMP = 'upload_timestamp'
+    INDEXED_AT = 'indexed_at'
+    FILENAME = 'filename'
+    BYTE_SIZE = 'byte_size'
+    CHUNK_COUNT = 'chunk_count'
+    PAGE_COUNT = 'page_count'
+
+
+class SortOrder(str, Enum):
+    """
+    Defines the directions of sorting
+    """
+
+    ASC = 'asc'
+    DESC = 'desc'
 
 
 class DeleteFileRequest(BaseModel):
     """
-    Represents a request to delete a document
+    Represents a request to delete a document or several documents
+    """
+
+    file_id: Optional[int] = None
+    file_ids: List[int] = []
+
+
+class ReindexFileRequest(BaseModel):
+    """
+    Represents a request to embed chunks of a document again with the current embedding model
+    """
+
+    file_id: int
+
+
+class DocumentStatus(str, Enum):
+    """
+    Defines the states of a document record, deleted records
+    are kept until compaction has removed all their chunks
+    """
+
+    ACTIVE = 'active'
+    DELETING = 'deleting'
+    DELETED = 'deleted'
+
+
+class JobStatus(str, Enum):
+    """
+    Defines the states of a document ingestion job
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
+
+class IngestionJobInfo(BaseModel):
+    """
+    Represents status and progress of a document ingestion job
     """
 
+    id: str
     file_id: int
+    filename: str
+    status: JobStatus
+    pages_parsed: int
+    chunks_total: int
+    chunks_embedded: int
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
+
+class EmbeddingKind(str, Enum):
+    """
+    Defines the kinds of texts the embedding service embeds
+    """
+
+    DOCUMENT = 'document'
+    QUERY = 'query'
+
+
+class EmbeddingRequest(BaseModel):
+    """
+    Represents texts sent to the embedding service
+    """
+
+    kind: EmbeddingKind = EmbeddingKind.DOCUMENT
+    texts: List[str] = Field(max_length=10000)
+
+
+class EmbeddingResponse(BaseModel):
+    """
+    Represents vectors returned by the embedding service
+    """
+
+    model_name: str
+    vectors: List[List[float]]
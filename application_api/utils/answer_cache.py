@@ -0,0 +1,166 @@
+"""
+This file contains the semantic answer cache, that returns
+a previous answer for a question similar to an earlier one,
+as long as retrieval still finds the same documents
+"""
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from typing import Any, Dict, FrozenSet, List, Optional, Text
+import numpy as np
+import threading
+import time
+
+
+class SemanticAnswerCache:
+    """
+    Class, that caches answers keyed by embedding of the standalone question
+    """
+
+    SIMILARITY_THRESHOLD: float = 0.95
+    MAX_ENTRIES: int = 512
+    TTL_SECONDS: float = 3600.0
+
+    def __init__(
+            self,
+            embedding_function: Embeddings,
+            similarity_threshold: float = SIMILARITY_THRESHOLD,
+            max_entries: int = MAX_ENTRIES,
+            ttl_seconds: float = TTL_SECONDS
+    ) -> None:
+        self.embedding_function: Embeddings = embedding_function
+        self.similarity_threshold: float = similarity_threshold
+        self.max_entries: int = max_entries
+        self.ttl_seconds: float = ttl_seconds
+
+        self._entries: List[Dict[Text, Any]] = []
+        self._lock: threading.Lock = threading.Lock()
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.invalidations: int = 0
+
+    def _embed(self, question: str) -> np.ndarray:
+        """
+        Returns normalized embedding of a question
+        :param question:
+        :return:
+        """
+
+        vector: np.ndarray = np.asarray(self.embedding_function.embed_query(question), dtype=np.float32)
+        norm: float = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _get_file_ids(documents: List[Document]) -> FrozenSet[Any]:
+        """
+        Returns set of file_ids the retrieved documents come from
+        :param documents:
+        :return:
+        """
+
+        return frozenset(document.metadata.get('file_id') for document in documents)
+
+    def _remove_expired(self, now: float) -> None:
+        """
+        Drops entries older than TTL, must be called with lock held
+        :param now:
+        :return:
+        """
+
+        self._entries = [entry for entry in self._entries if now - entry['created_at'] < self.ttl_seconds]
+
+    def lookup(self, model: str, question: str, documents: List[Document]) -> Optional[str]:
+        """
+        Returns cached answer for a similar question of the same model,
+        that was answered from the same set of documents
+        :param model:
+        :param question:
+        :param documents:
+        :return:
+        """
+
+        vector: np.ndarray = self._embed(question)
+        file_ids: FrozenSet[Any] = self._get_file_ids(documents)
+
+        with self._lock:
+            self._remove_expired(time.time())
+            candidates: List[Dict[Text, Any]] = [
+                entry for entry in self._entries if entry['model'] == model and entry['file_ids'] == file_ids
+            ]
+
+            if candidates:
+                similarities: np.ndarray = np.stack([entry['vector'] for entry in candidates]) @ vector
+                best: int = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self.hits += 1
+                    # Moving entry to the end keeps the list in least recently used order,
+                    # entries are matched by identity as their vectors can't be compared with ==
+                    self._entries = [entry for entry in self._entries if entry is not candidates[best]]
+                    self._entries.append(candidates[best])
+                    return candidates[best]['answer']
+
+            self.misses += 1
+            return None
+
+    def store(self, model: str, question: str, documents: List[Document], answer: str) -> None:
+        """
+        Caches answer, evicting least recently used entries above the size cap
+        :param model:
+        :param question:
+        :param documents:
+        :param answer:
+        :return:
+        """
+
+        entry: Dict[Text, Any] = {
+            'model': model,
+            'vector': self._embed(question),
+            'file_ids': self._get_file_ids(documents),
+            'answer': answer,
+            'created_at': time.time()
+        }
+
+        with self._lock:
+            self._entries.append(entry)
+            if len(self._entries) > self.max_entries:
+                self._entries = self._entries[-self.max_entries:]
+
+    def invalidate_file(self, file_id: int) -> None:
+        """
+        Drops entries answered from a document, that was changed or deleted
+        :param file_id:
+        :return:
+        """
+
+        with self._lock:
+            remaining: List[Dict[Text, Any]] = [entry for entry in self._entries if file_id not in entry['file_ids']]
+            self.invalidations += len(self._entries) - len(remaining)
+            self._entries = remaining
+
+    def clear(self) -> None:
+        """
+        Drops all entries, used when documents were changed by another process
+        :return:
+        """
+
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries = []
+
+    def get_stats(self) -> Dict[Text, Optional[float]]:
+        """
+        Returns hit/miss counters of the cache
+        :return:
+        """
+
+        with self._lock:
+            lookups: int = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries
+            }
@@ -0,0 +1,519 @@
+"""
+This file contains the lexical BM25 index over the document chunks,
+that complements vector search for exact terms like invoice numbers,
+error codes and SKUs, which embeddings match poorly
+"""
+
+from array import array
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+class BM25Index:
+    """
+    Class, that keeps an incrementally updated inverted index of chunks.
+    Postings of every term are stored in two int arrays (chunk slots and
+    term frequencies), deleted chunks are marked and compacted away later.
+    The index is saved as a snapshot and a journal of the changes made since,
+    that other processes replay instead of loading the whole index again
+    """
+
+    K1: float = 1.5
+    B: float = 0.75
+    # Share of deleted chunks, after which postings are rewritten without them
+    COMPACTION_RATIO: float = 0.25
+    # Journal is folded into a new snapshot, once it grows beyond this share of the snapshot
+    SNAPSHOT_RATIO: float = 0.5
+
+    TOKEN_PATTERN: re.Pattern = re.compile(r'\w+(?:[-./]\w+)*')
+    TOKEN_SEPARATORS: re.Pattern = re.compile(r'[-./]')
+
+    def __init__(self, path: Optional[str] = None, reload_interval: Optional[float] = None) -> None:
+        """
+        :param path: path of the snapshot, the journal is kept next to it
+        :param reload_interval: seconds between checks, whether the index was saved by another
+        process and its changes have to be read, None to never check
+        """
+
+        self.path: Optional[str] = path
+        self.reload_interval: Optional[float] = reload_interval
+        # Called after the index was loaded again with changes of another process
+        self.on_reloaded: Callable[[], None] = lambda: None
+        self._lock: threading.RLock = threading.RLock()
+        # (modification time, size) of the snapshot as this process last saved or loaded it
+        self._file_version: Optional[Tuple[int, int]] = None
+        self._checked_at: float = 0.0
+        # Snapshot, that the journal continues, and the bytes of the journal this process has read or written
+        self._generation: str = ''
+        self._journal_offset: int = 0
+        # Changes made since the last save, as journal records
+        self._pending: List[str] = []
+        # Set when the index was replaced as a whole, which only a new snapshot records
+        self._snapshot_needed: bool = False
+        self._clear()
+
+    @property
+    def journal_path(self) -> Optional[str]:
+        return f'{self.path}.journal' if self.path is not None else None
+
+    def _get_file_version(self) -> Optional[Tuple[int, int]]:
+        """
+        Returns (modification time, size) of the index file, None if there is no file
+        :return:
+        """
+
+        try:
+            stat: os.stat_result = os.stat(self.path)
+        except (OSError, TypeError):
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _get_journal_size(self) -> int:
+        """
+        Returns size of the journal, -1 if there is no journal
+        :return:
+        """
+
+        try:
+            return os.path.getsize(self.journal_path)
+        except (OSError, TypeError):
+            return -1
+
+    def reload_if_changed(self, force: bool = False) -> bool:
+        """
+        Reads changes another process saved since this process last saved or loaded the index:
+        records appended to the journal are replayed, a new snapshot is loaded as a whole.
+        Checks are made at most once per reload interval, unless forced
+        :param force: check regardless of the interval, done before every change
+        :return: whether changes were read
+        """
+
+        now: float = time.monotonic()
+        if self.reload_interval is None or (not force and now - self._checked_at < self.reload_interval):
+            return False
+        self._checked_at = now
+
+        version: Optional[Tuple[int, int]] = self._get_file_version()
+        if version is None:
+            return False
+        if version != self._file_version:
+            if not self.load():
+                return False
+        else:
+            with self._lock:
+                if self._get_journal_size() <= self._journal_offset or not self._read_journal():
+                    return False
+        self.on_reloaded()
+        return True
+
+    def _clear(self) -> None:
+        """
+        Resets index to the empty state, must be called with lock held
+        :return:
+        """
+
+        self._term_ids: Dict[str, int] = {}
+        self._terms: List[str] = []
+        self._postings_slots: List[array] = []
+        self._postings_frequencies: List[array] = []
+
+        self._chunk_ids: List[str] = []
+        self._file_ids: array = array('q')
+        self._chunk_lengths: array = array('i')
+        self._deleted: bytearray = bytearray()
+
+        self._live_chunks: int = 0
+        self._live_length: int = 0
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        """
+        Splits text into lowercase terms. Compound identifiers like
+        INV-2024-0042 are kept whole and also split into their parts
+        :param text:
+        :return:
+        """
+
+        terms: List[str] = []
+        for token in cls.TOKEN_PATTERN.findall(text.lower()):
+            terms.append(token)
+            parts: List[str] = cls.TOKEN_SEPARATORS.split(token)
+            if len(parts) > 1:
+                terms.extend(parts)
+        return terms
+
+    def __len__(self) -> int:
+        return self._live_chunks
+
+    def add(self, chunk_ids: List[str], texts: List[str], file_ids: List[int]) -> None:
+        """
+        Adds chunks to the index
+        :param chunk_ids:
+        :param texts:
+        :param file_ids:
+        :return:
+        """
+
+        with self._lock:
+            self.reload_if_changed(force=True)
+            for chunk_id, text, file_id in zip(chunk_ids, texts, file_ids):
+                terms: List[str] = self.tokenize(text)
+                frequencies: Dict[str, int] = {}
+                for term in terms:
+                    frequencies[term] = frequencies.get(term, 0) + 1
+
+                self._add_chunk(chunk_id, file_id, frequencies, len(terms))
+                self._record({'add': chunk_id, 'file_id': file_id, 'terms': frequencies, 'length': len(terms)})
+
+    def _add_chunk(self, chunk_id: str, file_id: int, frequencies: Dict[str, int], length: int) -> None:
+        """
+        Adds a chunk with its term frequencies to the next slot, must be called with lock held
+        :param chunk_id:
+        :param file_id:
+        :param frequencies:
+        :param length: number of terms of the chunk
+        :return:
+        """
+
+        slot: int = len(self._chunk_ids)
+        for term, frequency in frequencies.items():
+            term_id: Optional[int] = self._term_ids.get(term)
+            if term_id is None:
+                term_id = len(self._terms)
+                self._term_ids[term] = term_id
+                self._terms.append(term)
+                self._postings_slots.append(array('i'))
+                self._postings_frequencies.append(array('i'))
+            self._postings_slots[term_id].append(slot)
+            self._postings_frequencies[term_id].append(frequency)
+
+        self._chunk_ids.append(chunk_id)
+        self._file_ids.append(file_id)
+        self._chunk_lengths.append(length)
+        self._deleted.append(0)
+        self._live_chunks += 1
+        self._live_length += length
+
+    def _record(self, record: Dict[str, Any]) -> None:
+        """
+        Keeps a change for the journal, unless the index is saved as a whole anyway.
+        Must be called with lock held
+        :param record:
+        :return:
+        """
+
+        if self.path is not None and not self._snapshot_needed:
+            self._pending.append(json.dumps(record))
+
+    def remove_file(self, file_id: int) -> int:
+        """
+        Removes all chunks of a file from the index
+        :param file_id:
+        :return: number of removed chunks
+        """
+
+        with self._lock:
+            self.reload_if_changed(force=True)
+            return self._remove_recorded([
+                slot for slot, chunk_file_id in enumerate(self._file_ids) if chunk_file_id == file_id
+            ])
+
+    def remove_chunks(self, chunk_ids: Iterable[str]) -> int:
+        """
+        Removes chunks with given ids from the index
+        :param chunk_ids:
+        :return: number of removed chunks
+        """
+
+        removed_ids: Set[str] = set(chunk_ids)
+        with self._lock:
+            self.reload_if_changed(force=True)
+            return self._remove_recorded([
+                slot for slot, chunk_id in enumerate(self._chunk_ids) if chunk_id in removed_ids
+            ])
+
+    def _remove_recorded(self, slots: List[int]) -> int:
+        """
+        Removes chunks in given slots and keeps the removal for the journal, must be called with lock held
+        :param slots:
+        :return: number of removed chunks
+        """
+
+        removed: List[int] = self._remove_slots(slots)
+        if removed:
+            # Replaying the removal on the same index compacts it at the same point, so slots stay the same
+            self._record({'remove': removed})
+        return len(removed)
+
+    def _remove_slots(self, slots: List[int]) -> List[int]:
+        """
+        Marks chunks in given slots as deleted, compacting postings when enough are deleted.
+        Must be called with lock held
+        :param slots:
+        :return: slots of the removed chunks, that were not deleted before
+        """
+
+        removed: List[int] = []
+        for slot in slots:
+            if not self._deleted[slot]:
+                self._deleted[slot] = 1
+                self._live_chunks -= 1
+                self._live_length -= self._chunk_lengths[slot]
+                removed.append(slot)
+
+        if len(self._chunk_ids) - self._live_chunks > self.COMPACTION_RATIO * len(self._chunk_ids):
+            self._compact()
+        return removed
+
+    def _compact(self) -> None:
+        """
+        Rewrites postings without deleted chunks, must be called with lock held
+        :return:
+        """
+
+        new_slots: List[int] = []
+        next_slot: int = 0
+        for deleted in self._deleted:
+            new_slots.append(-1 if deleted else next_slot)
+            next_slot += 0 if deleted else 1
+
+        term_ids: Dict[str, int] = {}
+        terms: List[str] = []
+        postings_slots: List[array] = []
+        postings_frequencies: List[array] = []
+        for term, slots, frequencies in zip(self._terms, self._postings_slots, self._postings_frequencies):
+            kept_slots: array = array('i')
+            kept_frequencies: array = array('i')
+            for slot, frequency in zip(slots, frequencies):
+                if new_slots[slot] >= 0:
+                    kept_slots.append(new_slots[slot])
+                    kept_frequencies.append(frequency)
+            if kept_slots:
+                term_ids[term] = len(terms)
+                terms.append(term)
+                postings_slots.append(kept_slots)
+                postings_frequencies.append(kept_frequencies)
+
+        live: List[int] = [slot for slot, deleted in enumerate(self._deleted) if not deleted]
+        self._term_ids, self._terms = term_ids, terms
+        self._postings_slots, self._postings_frequencies = postings_slots, postings_frequencies
+        self._chunk_ids = [self._chunk_ids[slot] for slot in live]
+        self._file_ids = array('q', (self._file_ids[slot] for slot in live))
+        self._chunk_lengths = array('i', (self._chunk_lengths[slot] for slot in live))
+        self._deleted = bytearray(len(live))
+
+    def search(self, query: str, k: int, file_ids: Optional[Iterable[int]] = None) -> List[Tuple[str, float]]:
+        """
+        Returns ids and BM25 scores of the k best matching chunks
+        :param query:
+        :param k:
+        :param file_ids: search only chunks of these files, all chunks if None
+        :return:
+        """
+
+        self.reload_if_changed()
+        with self._lock:
+            if not self._live_chunks:
+                return []
+
+            chunk_count: int = self._live_chunks
+            average_length: float = self._live_length / chunk_count
+            # Arrays are copied, as an array.array can't grow while a numpy view over it exists
+            chunk_lengths: np.ndarray = np.frombuffer(self._chunk_lengths, dtype=np.int32).copy()
+            scores: np.ndarray = np.zeros(len(self._chunk_ids), dtype=np.float32)
+
+            for term in set(self.tokenize(query)):
+                term_id: Optional[int] = self._term_ids.get(term)
+                if term_id is None:
+                    continue
+                slots: np.ndarray = np.frombuffer(self._postings_slots[term_id], dtype=np.int32).copy()
+                frequencies: np.ndarray = np.frombuffer(
+                    self._postings_frequencies[term_id], dtype=np.int32
+                ).astype(np.float32)
+                idf: float = math.log(1 + (chunk_count - len(slots) + 0.5) / (len(slots) + 0.5))
+                norms: np.ndarray = self.K1 * (1 - self.B + self.B * chunk_lengths[slots] / average_length)
+                scores[slots] += idf * frequencies * (self.K1 + 1) / (frequencies + norms)
+
+            scores[np.frombuffer(self._deleted, dtype=np.uint8).astype(bool)] = 0
+            if file_ids is not None:
+                scores[~np.isin(np.frombuffer(self._file_ids, dtype=np.int64), list(file_ids))] = 0
+            matches: np.ndarray = np.flatnonzero(scores)
+            if len(matches) > k:
+                matches = matches[np.argpartition(-scores[matches], k)[:k]]
+            matches = matches[np.argsort(-scores[matches])]
+            return [(self._chunk_ids[slot], float(scores[slot])) for slot in matches]
+
+    def save(self) -> None:
+        """
+        Saves changes made since the last save: they are appended to the journal, the index is written
+        as a new snapshot instead when it was replaced as a whole or the journal grew too long
+        :return:
+        """
+
+        if self.path is None:
+            return
+
+        with self._lock:
+            journal_bytes: int = sum(len(record) + 1 for record in self._pending)
+            if (
+                    self._snapshot_needed or self._file_version is None
+                    or self._file_version != self._get_file_version()
+                    # A journal, that ends with a record cut off by a crash, is not appended to
+                    or self._get_journal_size() != self._journal_offset
+                    or self._journal_offset + journal_bytes > self.SNAPSHOT_RATIO * self._file_version[1]
+            ):
+                self._write_snapshot()
+            elif self._pending:
+                with open(self.journal_path, 'ab') as file:
+                    file.write(''.join(f'{record}\n' for record in self._pending).encode('utf-8'))
+                self._journal_offset += journal_bytes
+            self._pending = []
+
+    def _write_snapshot(self) -> None:
+        """
+        Writes index to its path atomically, postings of all terms are concatenated
+        into two flat arrays with offsets. Starts an empty journal, that continues the snapshot.
+        Must be called with lock held
+        :return:
+        """
+
+        generation: str = uuid.uuid4().hex
+        posting_lengths: np.ndarray = np.array([len(slots) for slots in self._postings_slots], dtype=np.int64)
+        arrays: Dict[str, np.ndarray] = {
+            'generation': np.frombuffer(generation.encode('utf-8'), dtype=np.uint8),
+            'terms': np.frombuffer('\n'.join(self._terms).encode('utf-8'), dtype=np.uint8),
+            'offsets': np.concatenate(([0], np.cumsum(posting_lengths))).astype(np.int64),
+            'slots': np.concatenate([np.frombuffer(slots, dtype=np.int32) for slots in self._postings_slots])
+            if self._postings_slots else np.zeros(0, dtype=np.int32),
+            'frequencies': np.concatenate([
+                np.frombuffer(frequencies, dtype=np.int32) for frequencies in self._postings_frequencies
+            ]) if self._postings_frequencies else np.zeros(0, dtype=np.int32),
+            'chunk_ids': np.frombuffer('\n'.join(self._chunk_ids).encode('utf-8'), dtype=np.uint8),
+            'file_ids': np.array(self._file_ids, dtype=np.int64),
+            'chunk_lengths': np.array(self._chunk_lengths, dtype=np.int32),
+            'deleted': np.array(self._deleted, dtype=np.uint8)
+        }
+
+        temporary_path: str = f'{self.path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary_path, self.path)
+        # Until the journal is replaced, other processes find the previous one and skip it by its generation
+        header: bytes = f'{json.dumps({"generation": generation})}\n'.encode('utf-8')
+        with open(f'{self.journal_path}.tmp', 'wb') as file:
+            file.write(header)
+        os.replace(f'{self.journal_path}.tmp', self.journal_path)
+
+        self._file_version = self._get_file_version()
+        self._generation = generation
+        self._journal_offset = len(header)
+        self._snapshot_needed = False
+
+    def _read_journal(self) -> bool:
+        """
+        Replays journal records, that this process has not read yet, must be called with lock held.
+        A record still being written is read by the next call
+        :return: whether any records were replayed
+        """
+
+        try:
+            with open(self.journal_path, 'rb') as file:
+                if not self._journal_offset:
+                    header: bytes = file.readline()
+                    # Journal of another snapshot, that is about to be replaced
+                    if not header.endswith(b'\n') or json.loads(header).get('generation') != self._generation:
+                        return False
+                    self._journal_offset = len(header)
+                file.seek(self._journal_offset)
+                data: bytes = file.read()
+        except (OSError, TypeError, ValueError):
+            return False
+
+        end: int = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                record: Dict[str, Any] = json.loads(line)
+                if 'add' in record:
+                    self._add_chunk(record['add'], record['file_id'], record['terms'], record['length'])
+                else:
+                    self._remove_slots(record['remove'])
+            except (ValueError, KeyError, IndexError) as e:
+                print(f'Error reading BM25 index journal {self.journal_path}: {str(e)}')
+        self._journal_offset += end
+        return end > 0
+
+    def load(self) -> bool:
+        """
+        Reads index from its path
+        :return: False if there is no saved index or it can't be read
+        """
+
+        if self.path is None or not os.path.exists(self.path):
+            return False
+
+        try:
+            version: Optional[Tuple[int, int]] = self._get_file_version()
+            with np.load(self.path) as data:
+                # Snapshots saved before the journal was introduced have no generation and no journal
+                generation: str = data['generation'].tobytes().decode('utf-8') if 'generation' in data.files else ''
+                terms_text: str = data['terms'].tobytes().decode('utf-8')
+                chunk_ids_text: str = data['chunk_ids'].tobytes().decode('utf-8')
+                offsets: np.ndarray = data['offsets']
+                slots: np.ndarray = data['slots'].astype(np.int32)
+                frequencies: np.ndarray = data['frequencies'].astype(np.int32)
+                file_ids: np.ndarray = data['file_ids'].astype(np.int64)
+                chunk_lengths: np.ndarray = data['chunk_lengths'].astype(np.int32)
+                deleted: np.ndarray = data['deleted'].astype(np.uint8)
+        except Exception as e:
+            print(f'Error loading BM25 index from {self.path}: {str(e)}')
+            return False
+
+        with self._lock:
+            self._clear()
+            self._terms = terms_text.split('\n') if terms_text else []
+            self._term_ids = {term: term_id for term_id, term in enumerate(self._terms)}
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                term_slots: array = array('i')
+                term_slots.frombytes(slots[start:end].tobytes())
+                term_frequencies: array = array('i')
+                term_frequencies.frombytes(frequencies[start:end].tobytes())
+                self._postings_slots.append(term_slots)
+                self._postings_frequencies.append(term_frequencies)
+
+            self._chunk_ids = chunk_ids_text.split('\n') if chunk_ids_text else []
+            self._file_ids.frombytes(file_ids.tobytes())
+            self._chunk_lengths.frombytes(chunk_lengths.tobytes())
+            self._deleted = bytearray(deleted.tobytes())
+
+            live: np.ndarray = deleted == 0
+            self._live_chunks = int(live.sum())
+            self._live_length = int(chunk_lengths[live].sum())
+            self._file_version = version
+            self._generation = generation
+            self._journal_offset = 0
+            self._pending = []
+            self._snapshot_needed = False
+            self._read_journal()
+        return True
+
+    def rebuild(self, chunks: Iterable[Tuple[str, str, int]]) -> None:
+        """
+        Replaces index content with the given (chunk_id, text, file_id) chunks
+        :param chunks:
+        :return:
+        """
+
+        with self._lock:
+            self._clear()
+            self._pending = []
+            self._snapshot_needed = True
+            for chunk_id, text, file_id in chunks:
+                self.add([chunk_id], [text], [file_id])
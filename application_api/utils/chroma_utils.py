@@ -6,14 +6,19 @@ performing similarity searches
 """
 
 from application_api.exceptions.file_type_exception import FileTypeException
+from application_api.utils.model_registry import ModelRegistry
+from application_api.utils.ingestion_pipeline import IngestionPipeline
+from application_api.utils.bm25_index import BM25Index
+from application_api.utils.metrics import metrics
 
 from langchain_community.document_loaders import PyPDFLoader, Docx2txtLoader, UnstructuredHTMLLoader
+from langchain_core.document_loaders import BaseLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
 from langchain_core.documents import Document
-from typing import List, Dict, Text, Any
-import os
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from typing import List, Dict, Text, Any, Callable, Iterator, Optional, Tuple
+import uuid
 
 
 class ChromaUtils:
@@ -21,62 +26,212 @@ class ChromaUtils:
     Class for interaction with Chroma vector storage
     """
 
-    CHROMA_DIRECTORY: str = os.path.abspath(path='../chroma_db')
+    CHROMA_DIRECTORY: str = ModelRegistry.CHROMA_DIRECTORY
+    # Page size used when reading the whole collection to rebuild the BM25 index
+    REBUILD_PAGE_SIZE: int = 1000
+    # Number of chunk ids deleted from the collection in a single call
+    DELETE_BATCH_SIZE: int = 500
 
-    def __init__(self) -> None:
+    def __init__(self, on_chunks_written: Optional[Callable[[List[str], List[int]], None]] = None) -> None:
         self.text_splitter: RecursiveCharacterTextSplitter = RecursiveCharacterTextSplitter(
             chunk_size=1000,
             chunk_overlap=200,
             length_function=len
         )
-        self.embedding_function: HuggingFaceEmbeddings = HuggingFaceEmbeddings(
-            model_name='sentence-transformers/all-MiniLM-L6-V2'
-        )
-        self.vector_store: Chroma = Chroma(
-            persist_directory=ChromaUtils.CHROMA_DIRECTORY,
-            embedding_function=self.embedding_function
+        self.embedding_function: Embeddings = ModelRegistry.get_embedding_function()
+        # Chroma or the quantized store, both are written through their collection
+        self.vector_store: VectorStore = ModelRegistry.get_vector_store()
+        self.bm25_index: BM25Index = ModelRegistry.get_bm25_index()
+        self.ingestion_pipeline: IngestionPipeline = IngestionPipeline(
+            text_splitter=self.text_splitter,
+            embed_documents=self.embedding_function.embed_documents,
+            write_batch=self.add_embedded_documents
         )
+        # Called with (chunk_ids, file_ids) before chunks are written, so that they can be deleted by id later
+        self.on_chunks_written: Callable[[List[str], List[int]], None] = on_chunks_written or (lambda *_: None)
 
-    def load_and_split_document(self, file_path: str) -> List[Document]:
+    def ensure_bm25_index(self) -> None:
         """
-        Analyzes file format and loads file, then splits it into chunks
+        Rebuilds lexical index if it is missing or was not saved before the last shutdown.
+        Only the process writing the indexes may call it
+        :return:
+        """
+
+        if len(self.bm25_index) != self.vector_store._collection.count():
+            self.rebuild_bm25_index()
+
+    @staticmethod
+    def get_loader(file_path: str) -> BaseLoader:
+        """
+        Analyzes file format and returns loader for the file
         :param file_path:
         :return:
         """
 
         if file_path.endswith('.pdf'):
-            loader: PyPDFLoader = PyPDFLoader(file_path)
+            return PyPDFLoader(file_path)
         elif file_path.endswith('.docx'):
-            loader: Docx2txtLoader = Docx2txtLoader(file_path)
+            return Docx2txtLoader(file_path)
         elif file_path.endswith('.html'):
-            loader: UnstructuredHTMLLoader = UnstructuredHTMLLoader(file_path)
+            return UnstructuredHTMLLoader(file_path)
         else:
             raise FileTypeException('')
 
-        documents: List[Document] = loader.load()
-        return self.text_splitter.split_documents(documents)
+    def load_document(self, file_path: str) -> List[Document]:
+        """
+        Analyzes file format and loads file as a list of pages
+        :param file_path:
+        :return:
+        """
+
+        return self.get_loader(file_path).load()
+
+    def iter_chunks(self, file_path: str) -> Iterator[Document]:
+        """
+        Loads file page by page and yields its chunks as every page is split,
+        so that only the current page and its chunks are kept in memory.
+        Chunks keep 1-based number of their page in page_number metadata
+        :param file_path:
+        :return:
+        """
+
+        for page_number, page in enumerate(self.get_loader(file_path).lazy_load(), start=1):
+            yield from self.ingestion_pipeline.split_page(page, page_number)
 
-    def index_document_to_chroma(self, file_path: str, file_id: int) -> bool:
+    def load_and_split_document(self, file_path: str) -> List[Document]:
+        """
+        Analyzes file format and loads file, then splits it into chunks
+        :param file_path:
+        :return:
+        """
+
+        return list(self.iter_chunks(file_path))
+
+    def index_document_to_chroma(
+            self,
+            file_path: str,
+            file_id: int,
+            progress_callback: Optional[Callable[..., None]] = None
+    ) -> bool:
         """
         Loads and splits document, then adds metadata(file_id),
-        that allows to link vector store entries back to database records
+        that allows to link vector store entries back to database records.
+        Pages are streamed through the ingestion pipeline, progress
+        (pages_parsed, chunks_total, chunks_embedded)
+        is reported through progress_callback if it is given
         :param file_path:
         :param file_id:
+        :param progress_callback:
         :return:
         """
 
         try:
-            splits: List[Document] = self.load_and_split_document(file_path)
-
-            # Adding metadata to each split
-            for split in splits:
-                split.metadata['file_id'] = file_id
-
-            self.vector_store.add_documents(splits)
+            with metrics.span('ingestion'):
+                self.ingestion_pipeline.run(
+                    self.get_loader(file_path).lazy_load(), file_id, progress_callback=progress_callback
+                )
             return True
         except Exception as e:
             print(f'Error indexing document: {e}')
             return False
+        finally:
+            self.bm25_index.save()
+
+    def add_embedded_documents(self, documents: List[Document], embeddings: List[List[float]]) -> List[str]:
+        """
+        Writes already embedded chunks to the Chroma collection
+        in a single batch and returns their ids
+        :param documents:
+        :param embeddings:
+        :return:
+        """
+
+        ids: List[str] = [str(uuid.uuid4()) for _ in documents]
+        self.on_chunks_written(ids, [document.metadata['file_id'] for document in documents])
+        # Embeddings are computed by the ingestion pipeline, so the collection is written directly
+        self.vector_store._collection.upsert(
+            ids=ids,
+            embeddings=embeddings,
+            metadatas=[document.metadata for document in documents],
+            documents=[document.page_content for document in documents]
+        )
+        self.bm25_index.add(
+            ids, [document.page_content for document in documents],
+            [document.metadata['file_id'] for document in documents]
+        )
+        return ids
+
+    def _iterate_chunks(self) -> Iterator[Tuple[str, str, int]]:
+        """
+        Yields (chunk_id, text, file_id) of all chunks in the collection page by page
+        :return:
+        """
+
+        offset: int = 0
+        while True:
+            page: Dict[Text, Any] = self.vector_store._collection.get(
+                include=['documents', 'metadatas'], limit=self.REBUILD_PAGE_SIZE, offset=offset
+            )
+            for chunk_id, text, metadata in zip(page['ids'], page['documents'], page['metadatas']):
+                yield chunk_id, text, metadata.get('file_id')
+            if len(page['ids']) < self.REBUILD_PAGE_SIZE:
+                return
+            offset += self.REBUILD_PAGE_SIZE
+
+    def iterate_chunk_files(self) -> Iterator[Tuple[str, int]]:
+        """
+        Yields (chunk_id, file_id) of all chunks in the collection page by page, without their texts
+        :return:
+        """
+
+        offset: int = 0
+        while True:
+            page: Dict[Text, Any] = self.vector_store._collection.get(
+                include=['metadatas'], limit=self.REBUILD_PAGE_SIZE, offset=offset
+            )
+            for chunk_id, metadata in zip(page['ids'], page['metadatas']):
+                yield chunk_id, metadata.get('file_id')
+            if len(page['ids']) < self.REBUILD_PAGE_SIZE:
+                return
+            offset += self.REBUILD_PAGE_SIZE
+
+    def delete_chunks(self, chunk_ids: List[str]) -> None:
+        """
+        Deletes chunks with given ids from the collection in batches.
+        Lexical index is not changed, it is updated separately
+        :param chunk_ids:
+        :return:
+        """
+
+        for start in range(0, len(chunk_ids), self.DELETE_BATCH_SIZE):
+            self.vector_store._collection.delete(ids=chunk_ids[start:start + self.DELETE_BATCH_SIZE])
+
+    def reembed_chunks(self, chunk_ids: List[str]) -> int:
+        """
+        Embeds texts of chunks with given ids again and replaces their embeddings.
+        Texts and metadata are kept, so the lexical index stays valid
+        :param chunk_ids:
+        :return: number of re-embedded chunks
+        """
+
+        page: Dict[Text, Any] = self.vector_store._collection.get(ids=chunk_ids, include=['documents'])
+        if not page['ids']:
+            return 0
+        with metrics.span('ingestion_embed'):
+            embeddings: List[List[float]] = self.embedding_function.embed_documents(page['documents'])
+        with metrics.span('ingestion_write'):
+            self.vector_store._collection.update(ids=page['ids'], embeddings=embeddings)
+        return len(page['ids'])
+
+    def rebuild_bm25_index(self) -> None:
+        """
+        Rebuilds lexical index from the chunks stored in Chroma
+        :return:
+        """
+
+        print('Rebuilding BM25 index from Chroma collection')
+        self.bm25_index.rebuild(self._iterate_chunks())
+        self.bm25_index.save()
 
     def delete_doc_from_chroma(self, file_id: int) -> bool:
         """
@@ -87,10 +242,9 @@ class ChromaUtils:
         """
 
         try:
-            documents: Dict[Text, Any] = self.vector_store.get(where={'file_id': file_id})
-            print(f'Found {len(documents["ids"])} document chunks for file_id {file_id}')
-
-            self.vector_store.delete(where={'file_id': file_id})
+            self.vector_store._collection.delete(where={'file_id': file_id})
+            self.bm25_index.remove_file(file_id)
+            self.bm25_index.save()
             print(f'Deleted all documents with file_id {file_id}')
 
             return True
@@ -0,0 +1,66 @@
+"""
+This file contains the settings of the backend, read once from
+environment variables. Paths default to the layout the backend
+has always used: the SQLite database in the working directory and
+the other state in its parent directory (RAG_DATA_DIRECTORY)
+"""
+
+from typing import Optional
+import os
+
+
+def _get_path(variable: str, default: str) -> str:
+    """
+    Returns absolute path from an environment variable or its default
+    :param variable:
+    :param default:
+    :return:
+    """
+
+    return os.path.abspath(path=os.environ.get(variable, default))
+
+
+class Config:
+    """
+    Class, that holds settings of the backend
+    """
+
+    # Storage
+    DATA_DIRECTORY: str = _get_path('RAG_DATA_DIRECTORY', '..')
+    DB_PATH: str = _get_path('RAG_DB_PATH', 'rag_app.db')
+    CHROMA_DIRECTORY: str = _get_path('RAG_CHROMA_DIRECTORY', os.path.join(DATA_DIRECTORY, 'chroma_db'))
+    BM25_INDEX_PATH: str = _get_path('RAG_BM25_INDEX_PATH', os.path.join(DATA_DIRECTORY, 'bm25_index.npz'))
+    EMBEDDING_CACHE_PATH: str = _get_path(
+        'RAG_EMBEDDING_CACHE_PATH', os.path.join(DATA_DIRECTORY, 'embedding_cache.db')
+    )
+    UPLOAD_DIRECTORY: str = _get_path('RAG_UPLOAD_DIRECTORY', os.path.join(DATA_DIRECTORY, 'uploads'))
+    # Held by the one process, that writes the indexes, when several workers serve the API
+    WRITER_LOCK_PATH: str = _get_path('RAG_WRITER_LOCK_PATH', os.path.join(DATA_DIRECTORY, 'writer.lock'))
+
+    # Vector store backend: 'chroma', or 'quantized' for int8 vectors in memory-mapped files
+    VECTOR_STORE: str = os.environ.get('RAG_VECTOR_STORE', 'chroma')
+    QUANTIZED_DIRECTORY: str = _get_path(
+        'RAG_QUANTIZED_DIRECTORY', os.path.join(DATA_DIRECTORY, 'quantized_index')
+    )
+    # Candidates of the quantized store are scored again with float32 vectors kept on disk
+    QUANTIZED_RESCORE: bool = os.environ.get('RAG_QUANTIZED_RESCORE', '1') != '0'
+    # Chroma server used instead of the embedded store in CHROMA_DIRECTORY when the host is set
+    CHROMA_HOST: Optional[str] = os.environ.get('RAG_CHROMA_HOST')
+    CHROMA_PORT: int = int(os.environ.get('RAG_CHROMA_PORT', '8000'))
+
+    # Models
+    EMBEDDING_MODEL_NAME: str = os.environ.get('RAG_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-V2')
+    # Embedding service shared by the workers, the model is loaded in-process when it is not set
+    EMBEDDING_SERVICE_URL: Optional[str] = os.environ.get('RAG_EMBEDDING_SERVICE_URL')
+    CROSS_ENCODER_MODEL_NAME: str = os.environ.get('RAG_CROSS_ENCODER_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+    RERANK: bool = os.environ.get('RAG_RERANK', '0') == '1'
+    # How long Ollama keeps a model and its prompt cache loaded after a request
+    OLLAMA_KEEP_ALIVE: str = os.environ.get('RAG_OLLAMA_KEEP_ALIVE', '30m')
+
+    # Background work
+    MAX_UPLOAD_MB: int = int(os.environ.get('RAG_MAX_UPLOAD_MB', '100'))
+    COMPACTION_INTERVAL_SECONDS: float = float(os.environ.get('RAG_COMPACTION_INTERVAL', '3600'))
+    # How often the writer looks for work queued by other workers, and the others try to become the writer
+    POLL_INTERVAL_SECONDS: float = float(os.environ.get('RAG_POLL_INTERVAL', '1'))
+
+    METRICS_ENABLED: bool = os.environ.get('RAG_METRICS', '1') != '0'
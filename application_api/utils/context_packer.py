@@ -0,0 +1,219 @@
+"""
+This file contains the context packer, that fits chat history and
+retrieved chunks into the context window of the model: chunks are taken
+in relevance order while they fit the token budget, and neighbouring
+chunks of the same file are merged without their shared overlap
+"""
+
+from application_api.model.pydantic_models import ModelName
+from application_api.utils.token_utils import TokenUtils
+
+from langchain_core.documents import Document
+from typing import Any, Dict, List, Optional, Text, Tuple
+
+
+class ContextPacker:
+    """
+    Class, that selects history messages and chunks passed to the question-answering prompt
+    """
+
+    # Context windows Ollama runs the models with, in tokens
+    CONTEXT_WINDOWS: Dict[str, int] = {
+        ModelName.LLAMA3.value: 8192,
+        ModelName.LLAMA2.value: 4096
+    }
+    DEFAULT_CONTEXT_WINDOW: int = 4096
+    # Tokens kept free for the generated answer
+    ANSWER_TOKENS: int = 512
+    # Largest share of the budget chat history may take, the rest is left for chunks
+    HISTORY_SHARE: float = 0.3
+    # History is trimmed by this many turns at once, so that it stays a prefix of the previous
+    # prompt between the trims and Ollama reuses its prompt cache. The history window moves by the same step
+    HISTORY_STEP_TURNS: int = 3
+    # Neighbouring chunks share up to chunk_overlap characters, longer overlaps are not searched for
+    MAX_OVERLAP_CHARACTERS: int = 400
+    # Shorter common text is treated as a coincidence, not as split overlap
+    MIN_OVERLAP_CHARACTERS: int = 20
+    CHUNK_SEPARATOR: str = '\n\n'
+
+    def __init__(
+            self,
+            prompt_tokens: int,
+            context_windows: Optional[Dict[str, int]] = None,
+            answer_tokens: int = ANSWER_TOKENS,
+            history_share: float = HISTORY_SHARE,
+            history_step_turns: int = HISTORY_STEP_TURNS
+    ) -> None:
+        """
+        :param prompt_tokens: tokens of the fixed parts of the prompt (system instructions, separators)
+        :param context_windows:
+        :param answer_tokens:
+        :param history_share:
+        :param history_step_turns:
+        """
+
+        self.prompt_tokens: int = prompt_tokens
+        self.context_windows: Dict[str, int] = context_windows or self.CONTEXT_WINDOWS
+        self.answer_tokens: int = answer_tokens
+        self.history_share: float = history_share
+        self.history_step_turns: int = max(1, history_step_turns)
+
+    def get_budget(self, model: str, question: str) -> int:
+        """
+        Returns tokens available for history and chunks
+        :param model:
+        :param question:
+        :return:
+        """
+
+        window: int = self.context_windows.get(model, self.DEFAULT_CONTEXT_WINDOW)
+        return max(0, window - self.answer_tokens - self.prompt_tokens - TokenUtils.count_tokens(question))
+
+    def get_history_budget(self, model: str) -> int:
+        """
+        Returns tokens chat history may take. The budget does not depend on the question,
+        so that history of a session is trimmed at the same turns whatever is asked
+        :param model:
+        :return:
+        """
+
+        return int(self.get_budget(model, '') * self.history_share)
+
+    @classmethod
+    def find_overlap(cls, previous: str, following: str) -> int:
+        """
+        Returns length of the longest end of previous text, that following text starts with
+        :param previous:
+        :param following:
+        :return:
+        """
+
+        longest: int = min(len(previous), len(following), cls.MAX_OVERLAP_CHARACTERS)
+        for length in range(longest, cls.MIN_OVERLAP_CHARACTERS - 1, -1):
+            if previous.endswith(following[:length]):
+                return length
+        return 0
+
+    def trim_history(self, model: str, chat_history: List[Dict[Text, Text]]) -> List[Dict[Text, Text]]:
+        """
+        Drops oldest question/answer turns history_step_turns at a time until history fits
+        the history budget, keeping the leading summary message. The history window starts
+        at a multiple of the same step, so trimmed history starts at the same turn until
+        the budget forces the next trim, and its start never moves back
+        :param model:
+        :param chat_history:
+        :return:
+        """
+
+        budget: int = self.get_history_budget(model)
+        has_summary: bool = bool(chat_history) and chat_history[0]['role'] == 'system'
+        summary: List[Dict[Text, Text]] = chat_history[:1] if has_summary else []
+        messages: List[Dict[Text, Text]] = chat_history[len(summary):]
+        # History never starts with an answer to a dropped question
+        if messages and messages[0]['role'] != 'human':
+            messages = messages[1:]
+        while messages and TokenUtils.count_message_tokens(summary + messages) > budget:
+            messages = messages[2 * self.history_step_turns:]
+        return summary + messages
+
+    @staticmethod
+    def _is_neighbour(previous: Document, following: Document) -> bool:
+        """
+        Checks if following chunk comes right after previous one in the same file
+        :param previous:
+        :param following:
+        :return:
+        """
+
+        return (
+            previous.metadata.get('file_id') is not None
+            and previous.metadata.get('file_id') == following.metadata.get('file_id')
+            and previous.metadata.get('chunk_index') is not None
+            and following.metadata.get('chunk_index') == previous.metadata['chunk_index'] + 1
+        )
+
+    def _merge(self, documents: List[Document]) -> List[Document]:
+        """
+        Merges runs of neighbouring chunks into single documents without their overlaps.
+        A run takes the place of its most relevant chunk
+        :param documents: selected chunks in relevance order
+        :return:
+        """
+
+        ranks: Dict[int, int] = {id(document): rank for rank, document in enumerate(documents)}
+        ordered: List[Document] = sorted(
+            documents,
+            key=lambda document: (
+                str(document.metadata.get('file_id')), document.metadata.get('chunk_index') or 0
+            )
+        )
+
+        runs: List[Tuple[int, Document]] = []
+        for document in ordered:
+            rank: int = ranks[id(document)]
+            if runs and self._is_neighbour(runs[-1][1], document):
+                best_rank, previous = runs[-1]
+                overlap: int = self.find_overlap(previous.page_content, document.page_content)
+                merged: Document = Document(
+                    id=previous.id,
+                    page_content=previous.page_content + (
+                        document.page_content[overlap:] if overlap else ' ' + document.page_content
+                    ),
+                    metadata={**previous.metadata, 'chunk_index': document.metadata.get('chunk_index')}
+                )
+                runs[-1] = (min(best_rank, rank), merged)
+            else:
+                runs.append((rank, document))
+
+        return [document for _, document in sorted(runs, key=lambda run: run[0])]
+
+    def pack(
+            self,
+            model: str,
+            question: str,
+            chat_history: List[Dict[Text, Text]],
+            documents: List[Document]
+    ) -> Tuple[List[Dict[Text, Text]], List[Document]]:
+        """
+        Returns history and chunks fitting into the model's context window.
+        Chunks are added in relevance order, a chunk following an already
+        added neighbour costs only the tokens it does not share with it
+        :param model:
+        :param question:
+        :param chat_history:
+        :param documents: retrieved chunks in relevance order
+        :return:
+        """
+
+        budget: int = self.get_budget(model, question)
+        history: List[Dict[Text, Text]] = self.trim_history(model, chat_history)
+        remaining: int = budget - TokenUtils.count_message_tokens(history)
+
+        selected: List[Document] = []
+        positions: Dict[Tuple[Any, Any], Document] = {}
+        separator_tokens: int = TokenUtils.count_tokens(self.CHUNK_SEPARATOR)
+        for document in documents:
+            file_id: Any = document.metadata.get('file_id')
+            chunk_index: Any = document.metadata.get('chunk_index')
+            if (file_id, chunk_index) in positions and chunk_index is not None:
+                continue
+
+            text: str = document.page_content
+            previous: Optional[Document] = None
+            following: Optional[Document] = None
+            if isinstance(chunk_index, int):
+                previous = positions.get((file_id, chunk_index - 1))
+                following = positions.get((file_id, chunk_index + 1))
+            if previous is not None:
+                text = text[self.find_overlap(previous.page_content, text):]
+            if following is not None:
+                text = text[:len(text) - self.find_overlap(text, following.page_content)]
+
+            cost: int = TokenUtils.count_tokens(text) + separator_tokens
+            if cost > remaining:
+                continue
+            remaining -= cost
+            selected.append(document)
+            positions[(file_id, chunk_index)] = document
+
+        return history, self._merge(selected)
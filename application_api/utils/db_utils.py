@@ -4,8 +4,24 @@ including storing and retrieving chat history and
 document metadata
 """
 
+from application_api.model.pydantic_models import DocumentStatus, JobStatus
+from application_api.utils.config import Config
+from application_api.utils.metrics import metrics
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Text, Tuple
+import asyncio
+import functools
+import json
 import sqlite3
-from typing import Dict, List, Text, Tuple
+import threading
+
+
+# Columns of document_store, that make up the manifest of a document
+DOCUMENT_COLUMNS: str = (
+    'id, filename, tags, content_hash, byte_size, chunk_count, page_count, embedding_model, status, '
+    'upload_timestamp, indexed_at'
+)
 
 
 class DBUtils:
@@ -13,7 +29,13 @@ class DBUtils:
     Class for interactions with SQLite database
     """
 
-    DB_NAME: str = 'rag_app.db'
+    DB_NAME: str = Config.DB_PATH
+    BUSY_TIMEOUT_SECONDS: float = 30.0
+    CACHE_SIZE_KIB: int = 16384
+    CACHED_STATEMENTS: int = 256
+
+    # Every thread keeps its own long-lived connection per database file
+    _local: threading.local = threading.local()
 
     def __init__(self) -> None:
         pass
@@ -21,14 +43,46 @@ class DBUtils:
     @staticmethod
     def get_db_connection() -> sqlite3.Connection:
         """
-        Creates connection to SQLite database
+        Returns connection of the current thread to SQLite database,
+        creating and tuning it on first use. Connections are kept open,
+        so sqlite3 can reuse its cache of prepared statements
         :return:
         """
 
-        connection: sqlite3.Connection = sqlite3.connect(DBUtils.DB_NAME)
-        connection.row_factory = sqlite3.Row
+        connections: Dict[str, sqlite3.Connection] = DBUtils._local.__dict__.setdefault('connections', {})
+        connection: Optional[sqlite3.Connection] = connections.get(DBUtils.DB_NAME)
+
+        if connection is None:
+            connection = sqlite3.connect(
+                DBUtils.DB_NAME,
+                timeout=DBUtils.BUSY_TIMEOUT_SECONDS,
+                cached_statements=DBUtils.CACHED_STATEMENTS
+            )
+            connection.row_factory = sqlite3.Row
+            # WAL lets readers proceed while a writer commits
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f'PRAGMA cache_size=-{DBUtils.CACHE_SIZE_KIB}')
+            connection.execute('PRAGMA temp_store=MEMORY')
+            connections[DBUtils.DB_NAME] = connection
+
         return connection
 
+    @staticmethod
+    def add_missing_columns(connection: sqlite3.Connection, table: str, columns: Dict[Text, Text]) -> None:
+        """
+        Adds columns, that are missing in a table created by an older version
+        :param connection:
+        :param table:
+        :param columns:
+        :return:
+        """
+
+        existing_columns: List[str] = [row['name'] for row in connection.execute(f'PRAGMA table_info({table})')]
+        for column, column_type in columns.items():
+            if column not in existing_columns:
+                connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
     def create_application_logs(self) -> None:
         """
         Stores chat history and model responses
@@ -43,7 +97,24 @@ class DBUtils:
                                gpt_response TEXT,
                                model TEXT,
                                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        connection.close()
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS idx_application_logs_session_created '
+            'ON application_logs (session_id, created_at)'
+        )
+        connection.commit()
+
+    def create_session_summaries(self) -> None:
+        """
+        Stores rolling summaries of long chat sessions
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS session_summaries
+                              (session_id TEXT PRIMARY KEY,
+                               summary TEXT,
+                               summarized_until INTEGER,
+                               updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
 
     def create_document_store(self) -> None:
         """
@@ -55,8 +126,65 @@ class DBUtils:
         connection.execute('''CREATE TABLE IF NOT EXISTS document_store
                               (id INTEGER PRIMARY KEY AUTOINCREMENT,
                                filename TEXT,
+                               content_hash TEXT,
+                               tags TEXT DEFAULT '[]',
+                               status TEXT DEFAULT 'active',
+                               byte_size INTEGER,
+                               chunk_count INTEGER DEFAULT 0,
+                               page_count INTEGER DEFAULT 0,
+                               embedding_model TEXT,
+                               indexed_at TIMESTAMP,
                                upload_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
-        connection.close()
+        self.add_missing_columns(connection, 'document_store', {
+            'content_hash': 'TEXT', 'tags': "TEXT DEFAULT '[]'", 'status': "TEXT DEFAULT 'active'",
+            'byte_size': 'INTEGER', 'chunk_count': 'INTEGER DEFAULT 0', 'page_count': 'INTEGER DEFAULT 0',
+            'embedding_model': 'TEXT', 'indexed_at': 'TIMESTAMP'
+        })
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS idx_document_store_content_hash ON document_store (content_hash)'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS idx_document_store_status ON document_store (status, upload_timestamp)'
+        )
+        connection.commit()
+
+    def create_document_chunks(self) -> None:
+        """
+        Keeps ids of the chunks every document was split into,
+        so that documents can be deleted from Chroma by chunk ids
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS document_chunks
+                              (chunk_id TEXT PRIMARY KEY,
+                               file_id INTEGER NOT NULL)''')
+        connection.execute('CREATE INDEX IF NOT EXISTS idx_document_chunks_file_id ON document_chunks (file_id)')
+        connection.commit()
+
+    def create_ingestion_jobs(self) -> None:
+        """
+        Keeps track of document ingestion jobs and their progress,
+        so that unfinished jobs can be resumed after a restart
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        connection.execute('''CREATE TABLE IF NOT EXISTS ingestion_jobs
+                              (id TEXT PRIMARY KEY,
+                               file_id INTEGER,
+                               filename TEXT,
+                               file_path TEXT,
+                               status TEXT,
+                               replace_existing INTEGER DEFAULT 0,
+                               pages_parsed INTEGER DEFAULT 0,
+                               chunks_total INTEGER DEFAULT 0,
+                               chunks_embedded INTEGER DEFAULT 0,
+                               error TEXT,
+                               created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                               updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+        self.add_missing_columns(connection, 'ingestion_jobs', {'replace_existing': 'INTEGER DEFAULT 0'})
+        connection.commit()
 
     def insert_application_logs(self, session_id: str, user_query: str, gpt_response: str, model: str) -> None:
         """
@@ -69,51 +197,229 @@ class DBUtils:
         """
 
         connection: sqlite3.Connection = self.get_db_connection()
-        connection.execute(
-            'INSERT INTO application_logs (session_id, user_query, gpt_response, model) VALUES (?, ?, ?, ?)',
-            (session_id, user_query, gpt_response, model)
-        )
-        connection.commit()
-        connection.close()
+        with connection:
+            connection.execute(
+                'INSERT INTO application_logs (session_id, user_query, gpt_response, model) VALUES (?, ?, ?, ?)',
+                (session_id, user_query, gpt_response, model)
+            )
+
+    def insert_application_logs_batch(self, logs: List[Tuple[str, str, str, str]]) -> None:
+        """
+        Inserts (session_id, user_query, gpt_response, model) logs
+        into application_logs table in a single transaction
+        :param logs:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            connection.executemany(
+                'INSERT INTO application_logs (session_id, user_query, gpt_response, model) VALUES (?, ?, ?, ?)',
+                logs
+            )
 
-    def get_chat_history(self, session_id: str) -> List[Dict[Text, Text]]:
+    def get_chat_turns(
+            self,
+            session_id: str,
+            max_turns: Optional[int] = None,
+            after_id: int = 0
+    ) -> List[Dict[Text, Any]]:
         """
-        Retrieves chat history from application_logs using session_id
+        Retrieves the latest question/answer turns of a session in
+        chronological order, optionally limited to max_turns
+        and to turns logged after the log with after_id
         :param session_id:
+        :param max_turns:
+        :param after_id:
         :return:
         """
+
         connection: sqlite3.Connection = self.get_db_connection()
         cursor: sqlite3.Cursor = connection.cursor()
-        messages: List[Dict[Text, Text]] = []
 
+        # Served by idx_application_logs_session_created, newest turns first
         cursor.execute(
-            'SELECT user_query, gpt_response FROM application_logs WHERE session_id = ? ORDER BY created_at',
-            (session_id,)
+            'SELECT id, user_query, gpt_response FROM application_logs WHERE session_id = ? AND id > ? '
+            'ORDER BY created_at DESC, id DESC LIMIT ?',
+            (session_id, after_id, max_turns if max_turns is not None else -1)
         )
-        for row in cursor.fetchall():
+        turns: List[sqlite3.Row] = cursor.fetchall()
+        return [dict(turn) for turn in reversed(turns)]
+
+    def count_chat_turns(self, session_id: str) -> int:
+        """
+        Counts question/answer turns of a session
+        :param session_id:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM application_logs WHERE session_id = ?', (session_id,))
+        return cursor.fetchone()[0]
+
+    def get_chat_history(self, session_id: str, max_turns: Optional[int] = None) -> List[Dict[Text, Text]]:
+        """
+        Retrieves chat history from application_logs using session_id,
+        optionally only the last max_turns question/answer turns
+        :param session_id:
+        :param max_turns:
+        :return:
+        """
+
+        messages: List[Dict[Text, Text]] = []
+        for turn in self.get_chat_turns(session_id, max_turns):
             messages.extend([
-                {'role': 'human', 'content': row['user_query']},
-                {'role': 'ai', 'content': row['gpt_response']}
+                {'role': 'human', 'content': turn['user_query']},
+                {'role': 'ai', 'content': turn['gpt_response']}
             ])
 
-        connection.close()
         return messages
 
-    def insert_document_record(self, filename: str) -> int:
+    def get_session_summary(self, session_id: str) -> Optional[Dict[Text, Any]]:
+        """
+        Retrieves rolling summary of a session from session_summaries table
+        :param session_id:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.cursor()
+        cursor.execute(
+            'SELECT summary, summarized_until FROM session_summaries WHERE session_id = ?', (session_id,)
+        )
+        summary: Optional[sqlite3.Row] = cursor.fetchone()
+        return dict(summary) if summary else None
+
+    def upsert_session_summary(self, session_id: str, summary: str, summarized_until: int) -> None:
+        """
+        Stores rolling summary of a session covering logs up to summarized_until
+        :param session_id:
+        :param summary:
+        :param summarized_until:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            connection.execute(
+                'INSERT INTO session_summaries (session_id, summary, summarized_until) VALUES (?, ?, ?) '
+                'ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary, '
+                'summarized_until = excluded.summarized_until, updated_at = CURRENT_TIMESTAMP',
+                (session_id, summary, summarized_until)
+            )
+
+    def insert_document_record(
+            self,
+            filename: str,
+            content_hash: Optional[str] = None,
+            tags: Optional[List[str]] = None,
+            byte_size: Optional[int] = None
+    ) -> int:
         """
         Inserts new document record in document_store table
         :param filename:
+        :param content_hash:
+        :param tags:
+        :param byte_size: size of the uploaded file
         :return:
         """
 
         connection: sqlite3.Connection = self.get_db_connection()
-        cursor: sqlite3.Cursor = connection.cursor()
-        cursor.execute('INSERT INTO document_store (filename) VALUES (?)', (filename,))
-        file_id: int = cursor.lastrowid
-        connection.commit()
-        connection.close()
+        with connection:
+            cursor: sqlite3.Cursor = connection.cursor()
+            cursor.execute(
+                'INSERT INTO document_store (filename, content_hash, tags, byte_size) VALUES (?, ?, ?, ?)',
+                (filename, content_hash, json.dumps(tags or []), byte_size)
+            )
+            file_id: int = cursor.lastrowid
         return file_id
 
+    def update_document_manifest(self, file_id: int, embedding_model: str, page_count: Optional[int] = None) -> None:
+        """
+        Records manifest of a document once its chunks have been written,
+        chunks are counted from their recorded ids
+        :param file_id:
+        :param embedding_model: name of the model chunks were embedded with
+        :param page_count: pages parsed, None keeps the recorded count
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            connection.execute(
+                'UPDATE document_store SET '
+                'chunk_count = (SELECT COUNT(*) FROM document_chunks WHERE file_id = ?), '
+                'page_count = COALESCE(?, page_count), embedding_model = ?, indexed_at = CURRENT_TIMESTAMP '
+                'WHERE id = ?',
+                (file_id, page_count, embedding_model, file_id)
+            )
+
+    def refresh_chunk_counts(self) -> int:
+        """
+        Recounts chunks of active documents, whose recorded count differs from their recorded chunk ids
+        :return: number of corrected documents
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            cursor: sqlite3.Cursor = connection.execute(
+                'UPDATE document_store SET chunk_count = '
+                '(SELECT COUNT(*) FROM document_chunks WHERE document_chunks.file_id = document_store.id) '
+                'WHERE status = ? AND chunk_count IS NOT '
+                '(SELECT COUNT(*) FROM document_chunks WHERE document_chunks.file_id = document_store.id)',
+                (DocumentStatus.ACTIVE.value,)
+            )
+            return cursor.rowcount
+
+    def update_document_tags(self, file_id: int, tags: List[str]) -> None:
+        """
+        Replaces tags of a document record in document_store table
+        :param file_id:
+        :param tags:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            connection.execute('UPDATE document_store SET tags = ? WHERE id = ?', (json.dumps(tags), file_id))
+
+    def get_file_ids_by_tags(self, tags: List[str]) -> List[int]:
+        """
+        Retrieves ids of documents having any of the tags
+        :param tags:
+        :return:
+        """
+
+        if not tags:
+            return []
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.cursor()
+        cursor.execute(
+            'SELECT DISTINCT document_store.id FROM document_store, json_each(document_store.tags) '
+            f'WHERE document_store.status = ? AND json_each.value IN ({", ".join("?" for _ in tags)})',
+            (DocumentStatus.ACTIVE.value, *tags)
+        )
+        return [row['id'] for row in cursor.fetchall()]
+
+    def get_document_by_hash(self, content_hash: str) -> Optional[Dict[Text, Any]]:
+        """
+        Retrieves document record with given content hash from document_store table
+        :param content_hash:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.cursor()
+        cursor.execute(
+            'SELECT id, filename, upload_timestamp FROM document_store '
+            'WHERE content_hash = ? AND status = ? ORDER BY id LIMIT 1',
+            (content_hash, DocumentStatus.ACTIVE.value)
+        )
+        document: Optional[sqlite3.Row] = cursor.fetchone()
+        return dict(document) if document else None
+
     def delete_document_record(self, file_id: int) -> bool:
         """
         Deletes document record from document_store table
@@ -122,20 +428,488 @@ class DBUtils:
         """
 
         connection: sqlite3.Connection = self.get_db_connection()
-        connection.execute('DELETE FROM document_store WHERE id = ?', (file_id,))
-        connection.commit()
-        connection.close()
+        with connection:
+            connection.execute('DELETE FROM document_store WHERE id = ?', (file_id,))
         return True
 
-    def get_all_documents(self) -> List[Dict[Text, Text]]:
+    def set_documents_status(self, file_ids: List[int], status: str) -> List[int]:
+        """
+        Sets status of document records in a single transaction.
+        Records already deleted keep their status
+        :param file_ids:
+        :param status:
+        :return: ids of records, that have the status now
+        """
+
+        if not file_ids:
+            return []
+
+        placeholders: str = ', '.join('?' for _ in file_ids)
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            connection.execute(
+                f'UPDATE document_store SET status = ? WHERE id IN ({placeholders}) AND status != ?',
+                (status, *file_ids, DocumentStatus.DELETED.value)
+            )
+            cursor: sqlite3.Cursor = connection.execute(
+                f'SELECT id FROM document_store WHERE id IN ({placeholders}) AND status = ?', (*file_ids, status)
+            )
+            return [row['id'] for row in cursor.fetchall()]
+
+    def get_document_statuses(self, file_ids: List[int]) -> Dict[int, str]:
+        """
+        Retrieves statuses of document records by id, missing records are left out
+        :param file_ids:
+        :return:
+        """
+
+        if not file_ids:
+            return {}
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.execute(
+            f'SELECT id, status FROM document_store WHERE id IN ({", ".join("?" for _ in file_ids)})', file_ids
+        )
+        return {row['id']: row['status'] for row in cursor.fetchall()}
+
+    def get_file_ids_by_status(self, status: str) -> List[int]:
+        """
+        Retrieves ids of document records with given status
+        :param status:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.execute('SELECT id FROM document_store WHERE status = ?', (status,))
+        return [row['id'] for row in cursor.fetchall()]
+
+    def purge_deleted_documents(self) -> int:
+        """
+        Removes records of deleted documents from document_store table
+        :return: number of removed records
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            cursor: sqlite3.Cursor = connection.execute(
+                'DELETE FROM document_store WHERE status = ?', (DocumentStatus.DELETED.value,)
+            )
+            return cursor.rowcount
+
+    def insert_document_chunks(self, chunk_ids: List[str], file_ids: List[int]) -> None:
         """
-        Retrieves all document records from document_store table
+        Records ids of chunks written for documents
+        :param chunk_ids:
+        :param file_ids:
         :return:
         """
 
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO document_chunks (chunk_id, file_id) VALUES (?, ?)', zip(chunk_ids, file_ids)
+            )
+
+    def get_document_chunk_ids(self, file_id: int, limit: Optional[int] = None, offset: int = 0) -> List[str]:
+        """
+        Retrieves recorded chunk ids of a document in the order they were written
+        :param file_id:
+        :param limit: None retrieves all ids
+        :param offset:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.execute(
+            'SELECT chunk_id FROM document_chunks WHERE file_id = ? ORDER BY rowid LIMIT ? OFFSET ?',
+            (file_id, -1 if limit is None else limit, offset)
+        )
+        return [row['chunk_id'] for row in cursor.fetchall()]
+
+    def count_document_chunks(self, file_id: int) -> int:
+        """
+        Counts recorded chunks of a document
+        :param file_id:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.execute(
+            'SELECT COUNT(*) FROM document_chunks WHERE file_id = ?', (file_id,)
+        )
+        return cursor.fetchone()[0]
+
+    def iterate_document_chunks(self, page_size: int) -> Iterator[Tuple[str, int]]:
+        """
+        Yields (chunk_id, file_id) of all recorded chunks page by page
+        :param page_size:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        last_rowid: int = 0
+        while True:
+            rows: List[sqlite3.Row] = connection.execute(
+                'SELECT rowid, chunk_id, file_id FROM document_chunks WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                (last_rowid, page_size)
+            ).fetchall()
+            for row in rows:
+                yield row['chunk_id'], row['file_id']
+            if len(rows) < page_size:
+                return
+            last_rowid = rows[-1]['rowid']
+
+    def delete_document_chunks(self, chunk_ids: Optional[List[str]] = None, file_id: Optional[int] = None) -> None:
+        """
+        Deletes records of chunks with given ids or of all chunks of a document
+        :param chunk_ids:
+        :param file_id:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            if chunk_ids:
+                connection.executemany(
+                    'DELETE FROM document_chunks WHERE chunk_id = ?', ((chunk_id,) for chunk_id in chunk_ids)
+                )
+            if file_id is not None:
+                connection.execute('DELETE FROM document_chunks WHERE file_id = ?', (file_id,))
+
+    def delete_orphaned_document_chunks(self) -> int:
+        """
+        Deletes records of chunks, whose documents are neither active nor being deleted
+        :return: number of deleted records
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            cursor: sqlite3.Cursor = connection.execute(
+                'DELETE FROM document_chunks WHERE file_id NOT IN '
+                '(SELECT id FROM document_store WHERE status IN (?, ?))',
+                (DocumentStatus.ACTIVE.value, DocumentStatus.DELETING.value)
+            )
+            return cursor.rowcount
+
+    def get_all_documents(
+            self,
+            limit: Optional[int] = None,
+            offset: int = 0,
+            sort_by: str = 'upload_timestamp',
+            descending: bool = True
+    ) -> List[Dict[Text, Any]]:
+        """
+        Retrieves manifests of active documents from document_store table
+        :param limit: None retrieves all documents
+        :param offset:
+        :param sort_by: manifest column, one of DocumentSortField values
+        :param descending:
+        :return:
+        """
+
+        if sort_by not in DOCUMENT_COLUMNS.split(', '):
+            raise ValueError(f'Documents can not be sorted by {sort_by}')
+
+        direction: str = 'DESC' if descending else 'ASC'
         connection: sqlite3.Connection = self.get_db_connection()
         cursor: sqlite3.Cursor = connection.cursor()
-        cursor.execute('SELECT id, filename, upload_timestamp FROM document_store ORDER BY upload_timestamp DESC')
-        documents: List[Tuple] = cursor.fetchall()
-        connection.close()
-        return [dict(doc) for doc in documents]
+        # id breaks ties, so that pages do not overlap
+        cursor.execute(
+            f'SELECT {DOCUMENT_COLUMNS} FROM document_store WHERE status = ? '
+            f'ORDER BY {sort_by} {direction}, id {direction} LIMIT ? OFFSET ?',
+            (DocumentStatus.ACTIVE.value, -1 if limit is None else limit, offset)
+        )
+        documents: List[sqlite3.Row] = cursor.fetchall()
+        return [{**dict(doc), 'tags': json.loads(doc['tags'] or '[]')} for doc in documents]
+
+    def count_documents(self) -> int:
+        """
+        Counts active documents
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.execute(
+            'SELECT COUNT(*) FROM document_store WHERE status = ?', (DocumentStatus.ACTIVE.value,)
+        )
+        return cursor.fetchone()[0]
+
+    def get_document(self, file_id: int) -> Optional[Dict[Text, Any]]:
+        """
+        Retrieves manifest of a document, that is not deleted
+        :param file_id:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.execute(
+            f'SELECT {DOCUMENT_COLUMNS} FROM document_store WHERE id = ? AND status != ?',
+            (file_id, DocumentStatus.DELETED.value)
+        )
+        document: Optional[sqlite3.Row] = cursor.fetchone()
+        return {**dict(document), 'tags': json.loads(document['tags'] or '[]')} if document else None
+
+    def get_document_stats(self) -> Dict[Text, Any]:
+        """
+        Sums manifests of active documents
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        totals: sqlite3.Row = connection.execute(
+            'SELECT COUNT(*) AS documents, COALESCE(SUM(chunk_count), 0) AS chunks, '
+            'COALESCE(SUM(byte_size), 0) AS bytes, COALESCE(SUM(page_count), 0) AS pages '
+            'FROM document_store WHERE status = ?',
+            (DocumentStatus.ACTIVE.value,)
+        ).fetchone()
+        by_model: List[sqlite3.Row] = connection.execute(
+            "SELECT COALESCE(embedding_model, 'unknown') AS model, SUM(chunk_count) AS chunks "
+            'FROM document_store WHERE status = ? GROUP BY model',
+            (DocumentStatus.ACTIVE.value,)
+        ).fetchall()
+        return {**dict(totals), 'chunks_by_embedding_model': {row['model']: row['chunks'] for row in by_model}}
+
+    def insert_ingestion_job(
+            self,
+            job_id: str,
+            file_id: int,
+            filename: str,
+            file_path: str,
+            status: str,
+            replace_existing: bool = False
+    ) -> None:
+        """
+        Inserts new job record in ingestion_jobs table
+        :param job_id:
+        :param file_id:
+        :param filename:
+        :param file_path:
+        :param status:
+        :param replace_existing:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            connection.execute(
+                'INSERT INTO ingestion_jobs (id, file_id, filename, file_path, status, replace_existing) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, file_id, filename, file_path, status, int(replace_existing))
+            )
+
+    def update_ingestion_job(self, job_id: str, **fields: Any) -> None:
+        """
+        Updates status and progress counters of a job in ingestion_jobs table
+        :param job_id:
+        :param fields:
+        :return:
+        """
+
+        allowed_fields: List[str] = ['status', 'pages_parsed', 'chunks_total', 'chunks_embedded', 'error']
+        unknown_fields: List[str] = [field for field in fields if field not in allowed_fields]
+        if unknown_fields:
+            raise ValueError(f'Unknown ingestion job fields: {", ".join(unknown_fields)}')
+
+        assignments: str = ''.join(f'{field} = ?, ' for field in fields)
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            connection.execute(
+                f'UPDATE ingestion_jobs SET {assignments}updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+                (*fields.values(), job_id)
+            )
+
+    def claim_ingestion_job(self, job_id: str, expected_status: str) -> bool:
+        """
+        Marks job as running and resets its progress, if it still has the expected status.
+        The check and the update are a single statement, so a job is claimed only once
+        :param job_id:
+        :param expected_status:
+        :return: whether the job was claimed
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        with connection:
+            cursor: sqlite3.Cursor = connection.execute(
+                'UPDATE ingestion_jobs SET status = ?, pages_parsed = 0, chunks_total = 0, chunks_embedded = 0, '
+                'updated_at = CURRENT_TIMESTAMP WHERE id = ? AND status = ?',
+                (JobStatus.RUNNING.value, job_id, expected_status)
+            )
+            return cursor.rowcount == 1
+
+    def get_ingestion_job(self, job_id: str) -> Optional[Dict[Text, Any]]:
+        """
+        Retrieves job record from ingestion_jobs table
+        :param job_id:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.cursor()
+        cursor.execute('SELECT * FROM ingestion_jobs WHERE id = ?', (job_id,))
+        job: Optional[sqlite3.Row] = cursor.fetchone()
+        return dict(job) if job else None
+
+    def get_ingestion_jobs(self, statuses: Optional[List[str]] = None) -> List[Dict[Text, Any]]:
+        """
+        Retrieves job records from ingestion_jobs table,
+        optionally only the ones with given statuses
+        :param statuses:
+        :return:
+        """
+
+        connection: sqlite3.Connection = self.get_db_connection()
+        cursor: sqlite3.Cursor = connection.cursor()
+        if statuses:
+            cursor.execute(
+                f'SELECT * FROM ingestion_jobs WHERE status IN ({", ".join("?" for _ in statuses)}) '
+                f'ORDER BY created_at',
+                statuses
+            )
+        else:
+            cursor.execute('SELECT * FROM ingestion_jobs ORDER BY created_at DESC')
+        jobs: List[sqlite3.Row] = cursor.fetchall()
+        return [dict(job) for job in jobs]
+
+
+class AsyncDBUtils:
+    """
+    Async facade over DBUtils, that runs blocking SQLite calls
+    on a small dedicated thread pool instead of the request threadpool
+    """
+
+    MAX_WORKERS: int = 4
+
+    def __init__(self, db_utils: DBUtils, max_workers: int = MAX_WORKERS) -> None:
+        self.db_utils: DBUtils = db_utils
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='sqlite')
+
+    async def run(self, function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Runs blocking database function on the database thread pool
+        :param function:
+        :param args:
+        :param kwargs:
+        :return:
+        """
+
+        with metrics.span(f'db.{function.__name__}'):
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(function, *args, **kwargs)
+            )
+
+    async def insert_application_logs(self, session_id: str, user_query: str, gpt_response: str, model: str) -> None:
+        """
+        Async version of DBUtils.insert_application_logs
+        """
+
+        await self.run(self.db_utils.insert_application_logs, session_id, user_query, gpt_response, model)
+
+    async def insert_application_logs_batch(self, logs: List[Tuple[str, str, str, str]]) -> None:
+        """
+        Async version of DBUtils.insert_application_logs_batch
+        """
+
+        await self.run(self.db_utils.insert_application_logs_batch, logs)
+
+    async def get_chat_history(self, session_id: str, max_turns: Optional[int] = None) -> List[Dict[Text, Text]]:
+        """
+        Async version of DBUtils.get_chat_history
+        """
+
+        return await self.run(self.db_utils.get_chat_history, session_id, max_turns)
+
+    async def insert_document_record(
+            self,
+            filename: str,
+            content_hash: Optional[str] = None,
+            tags: Optional[List[str]] = None,
+            byte_size: Optional[int] = None
+    ) -> int:
+        """
+        Async version of DBUtils.insert_document_record
+        """
+
+        return await self.run(self.db_utils.insert_document_record, filename, content_hash, tags, byte_size)
+
+    async def update_document_tags(self, file_id: int, tags: List[str]) -> None:
+        """
+        Async version of DBUtils.update_document_tags
+        """
+
+        await self.run(self.db_utils.update_document_tags, file_id, tags)
+
+    async def get_file_ids_by_tags(self, tags: List[str]) -> List[int]:
+        """
+        Async version of DBUtils.get_file_ids_by_tags
+        """
+
+        return await self.run(self.db_utils.get_file_ids_by_tags, tags)
+
+    async def get_document_by_hash(self, content_hash: str) -> Optional[Dict[Text, Any]]:
+        """
+        Async version of DBUtils.get_document_by_hash
+        """
+
+        return await self.run(self.db_utils.get_document_by_hash, content_hash)
+
+    async def delete_document_record(self, file_id: int) -> bool:
+        """
+        Async version of DBUtils.delete_document_record
+        """
+
+        return await self.run(self.db_utils.delete_document_record, file_id)
+
+    async def get_all_documents(
+            self,
+            limit: Optional[int] = None,
+            offset: int = 0,
+            sort_by: str = 'upload_timestamp',
+            descending: bool = True
+    ) -> List[Dict[Text, Any]]:
+        """
+        Async version of DBUtils.get_all_documents
+        """
+
+        return await self.run(self.db_utils.get_all_documents, limit, offset, sort_by, descending)
+
+    async def count_documents(self) -> int:
+        """
+        Async version of DBUtils.count_documents
+        """
+
+        return await self.run(self.db_utils.count_documents)
+
+    async def get_document(self, file_id: int) -> Optional[Dict[Text, Any]]:
+        """
+        Async version of DBUtils.get_document
+        """
+
+        return await self.run(self.db_utils.get_document, file_id)
+
+    async def get_document_chunk_ids(self, file_id: int, limit: Optional[int] = None, offset: int = 0) -> List[str]:
+        """
+        Async version of DBUtils.get_document_chunk_ids
+        """
+
+        return await self.run(self.db_utils.get_document_chunk_ids, file_id, limit, offset)
+
+    async def get_document_stats(self) -> Dict[Text, Any]:
+        """
+        Async version of DBUtils.get_document_stats
+        """
+
+        return await self.run(self.db_utils.get_document_stats)
+
+    async def get_ingestion_job(self, job_id: str) -> Optional[Dict[Text, Any]]:
+        """
+        Async version of DBUtils.get_ingestion_job
+        """
+
+        return await self.run(self.db_utils.get_ingestion_job, job_id)
+
+    async def get_ingestion_jobs(self, statuses: Optional[List[str]] = None) -> List[Dict[Text, Any]]:
+        """
+        Async version of DBUtils.get_ingestion_jobs
+        """
+
+        return await self.run(self.db_utils.get_ingestion_jobs, statuses)
@@ -0,0 +1,249 @@
+"""
+This file contains document deletion and the compaction job.
+Documents are first marked as deleting, then their chunks are deleted
+from Chroma by the ids recorded in the database, and only then they are
+marked as deleted, so that an interrupted deletion can be resumed.
+Compaction reconciles chunks of Chroma with documents of the database.
+Only the process writing the indexes deletes chunks, other workers
+mark documents as deleting and wait for the writer
+"""
+
+from application_api.model.pydantic_models import DocumentStatus
+from application_api.utils.chroma_utils import ChromaUtils
+from application_api.utils.config import Config
+from application_api.utils.db_utils import DBUtils
+from application_api.utils.metrics import metrics
+
+from typing import Any, Callable, Dict, List, Optional, Set, Text
+import threading
+import time
+
+
+class DocumentDeleter:
+    """
+    Class, that deletes documents from both stores and removes chunks, that belong to no document
+    """
+
+    # Seconds between compaction runs, 0 runs it only once at startup
+    COMPACTION_INTERVAL_SECONDS: float = Config.COMPACTION_INTERVAL_SECONDS
+    POLL_INTERVAL_SECONDS: float = Config.POLL_INTERVAL_SECONDS
+    # Longest time a worker waits for the writer to delete documents it marked
+    WAIT_TIMEOUT_SECONDS: float = 60.0
+    DELETE_BATCH_SIZE: int = ChromaUtils.DELETE_BATCH_SIZE
+    PAGE_SIZE: int = ChromaUtils.REBUILD_PAGE_SIZE
+
+    def __init__(
+            self,
+            db_utils: DBUtils,
+            chroma_utils: ChromaUtils,
+            on_deleted: Optional[Callable[[int], None]] = None,
+            compaction_interval: float = COMPACTION_INTERVAL_SECONDS,
+            poll_interval: float = POLL_INTERVAL_SECONDS
+    ) -> None:
+        self.db_utils: DBUtils = db_utils
+        self.chroma_utils: ChromaUtils = chroma_utils
+        # Called with file_id once all chunks of a document have been deleted
+        self.on_deleted: Callable[[int], None] = on_deleted or (lambda file_id: None)
+        self.compaction_interval: float = compaction_interval
+        self.poll_interval: float = poll_interval
+        # Chunks are deleted only after start, in the process writing the indexes
+        self.is_writer: bool = False
+        # Deletions and compaction do not run at the same time
+        self._lock: threading.RLock = threading.RLock()
+        self._stopped: threading.Event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _delete_chunks(self, file_id: int) -> None:
+        """
+        Deletes chunks of a document from Chroma batch by batch, forgetting every batch once it is deleted
+        :param file_id:
+        :return:
+        """
+
+        deleted_any: bool = False
+        while True:
+            chunk_ids: List[str] = self.db_utils.get_document_chunk_ids(file_id, self.DELETE_BATCH_SIZE)
+            if not chunk_ids:
+                break
+            self.chroma_utils.delete_chunks(chunk_ids)
+            self.db_utils.delete_document_chunks(chunk_ids=chunk_ids)
+            deleted_any = True
+
+        # Documents indexed before chunk ids were recorded are deleted by their metadata
+        if not deleted_any:
+            self.chroma_utils.vector_store._collection.delete(where={'file_id': file_id})
+        self.chroma_utils.bm25_index.remove_file(file_id)
+
+    def remove_chunks(self, file_id: int, offset: int = 0, limit: Optional[int] = None) -> int:
+        """
+        Deletes chunks of a document, that is kept, from both stores batch by batch.
+        Chunks are taken in the order they were written, so that chunks of the previous
+        indexing (the first ones) or of the current one (the ones after them) can be deleted
+        :param file_id:
+        :param offset: number of the first written chunks, that are kept
+        :param limit: largest number of chunks to delete, None deletes all chunks after offset
+        :return: number of deleted chunks
+        """
+
+        deleted: int = 0
+        with self._lock:
+            try:
+                while limit is None or deleted < limit:
+                    batch_size: int = self.DELETE_BATCH_SIZE if limit is None else min(
+                        self.DELETE_BATCH_SIZE, limit - deleted
+                    )
+                    # Deleted records are gone, so the next batch starts at the same offset
+                    chunk_ids: List[str] = self.db_utils.get_document_chunk_ids(file_id, batch_size, offset)
+                    if not chunk_ids:
+                        break
+                    self.chroma_utils.delete_chunks(chunk_ids)
+                    self.chroma_utils.bm25_index.remove_chunks(chunk_ids)
+                    self.db_utils.delete_document_chunks(chunk_ids=chunk_ids)
+                    deleted += len(chunk_ids)
+            finally:
+                self.chroma_utils.bm25_index.save()
+        return deleted
+
+    def delete_documents(self, file_ids: List[int]) -> Dict[int, bool]:
+        """
+        Deletes documents with given ids from Chroma and the database.
+        Documents, that do not exist or are already deleted, are reported as not deleted
+        :param file_ids:
+        :return: whether every document has been deleted, by file_id
+        """
+
+        if not self.is_writer:
+            return self._wait_for_writer(file_ids)
+
+        results: Dict[int, bool] = {file_id: False for file_id in file_ids}
+        with self._lock, metrics.span('document_deletion'):
+            marked: List[int] = self.db_utils.set_documents_status(
+                list(results), DocumentStatus.DELETING.value
+            )
+            try:
+                for file_id in marked:
+                    try:
+                        self._delete_chunks(file_id)
+                        self.db_utils.set_documents_status([file_id], DocumentStatus.DELETED.value)
+                        self.on_deleted(file_id)
+                        results[file_id] = True
+                    except Exception as e:
+                        # Document stays marked as deleting and is deleted again by the next compaction
+                        print(f'Error deleting document with file_id {file_id}: {str(e)}')
+            finally:
+                self.chroma_utils.bm25_index.save()
+        return results
+
+    def _wait_for_writer(self, file_ids: List[int]) -> Dict[int, bool]:
+        """
+        Marks documents as deleting and waits until the writer process has deleted them
+        :param file_ids:
+        :return: whether every document has been deleted in time, by file_id
+        """
+
+        results: Dict[int, bool] = {file_id: False for file_id in file_ids}
+        marked: List[int] = self.db_utils.set_documents_status(list(results), DocumentStatus.DELETING.value)
+
+        deadline: float = time.monotonic() + self.WAIT_TIMEOUT_SECONDS
+        while marked and time.monotonic() < deadline:
+            time.sleep(self.poll_interval / 4)
+            statuses: Dict[int, str] = self.db_utils.get_document_statuses(marked)
+            # Records of deleted documents may already be purged
+            for file_id in marked:
+                results[file_id] = statuses.get(file_id, DocumentStatus.DELETED.value) == DocumentStatus.DELETED.value
+            marked = [file_id for file_id in marked if not results[file_id]]
+        return results
+
+    def resume_unfinished_deletions(self) -> int:
+        """
+        Finishes deletions, that were interrupted
+        :return: number of finished deletions
+        """
+
+        file_ids: List[int] = self.db_utils.get_file_ids_by_status(DocumentStatus.DELETING.value)
+        return sum(self.delete_documents(file_ids).values())
+
+    def compact(self) -> Dict[Text, int]:
+        """
+        Deletes chunks of Chroma, that belong to no active document, records chunk ids
+        of documents indexed before they were recorded and corrects their chunk counts,
+        forgets chunk ids of documents, that no longer exist, and removes records of deleted documents
+        :return: counts of the changes
+        """
+
+        with self._lock, metrics.span('compaction'):
+            stats: Dict[Text, int] = {'deletions_resumed': self.resume_unfinished_deletions()}
+
+            known: Set[int] = set(self.db_utils.get_file_ids_by_status(DocumentStatus.ACTIVE.value))
+            candidates: Dict[Any, List[str]] = {}
+            page_ids: List[str] = []
+            page_file_ids: List[int] = []
+            for chunk_id, file_id in self.chroma_utils.iterate_chunk_files():
+                if file_id in known:
+                    page_ids.append(chunk_id)
+                    page_file_ids.append(file_id)
+                    if len(page_ids) == self.PAGE_SIZE:
+                        self.db_utils.insert_document_chunks(page_ids, page_file_ids)
+                        page_ids, page_file_ids = [], []
+                else:
+                    candidates.setdefault(file_id, []).append(chunk_id)
+            self.db_utils.insert_document_chunks(page_ids, page_file_ids)
+            stats['chunk_counts_corrected'] = self.db_utils.refresh_chunk_counts()
+
+            # Records are inserted before their chunks are written, so chunks of documents uploaded
+            # while the collection was read are spared by reading the records again
+            known = set(self.db_utils.get_file_ids_by_status(DocumentStatus.ACTIVE.value))
+            orphans: Dict[Any, List[str]] = {
+                file_id: chunk_ids for file_id, chunk_ids in candidates.items() if file_id not in known
+            }
+            for file_id, chunk_ids in orphans.items():
+                self.chroma_utils.delete_chunks(chunk_ids)
+                self.db_utils.delete_document_chunks(chunk_ids=chunk_ids)
+                self.chroma_utils.bm25_index.remove_file(file_id)
+            stats['orphaned_chunks_deleted'] = sum(len(chunk_ids) for chunk_ids in orphans.values())
+
+            stats['chunk_records_deleted'] = self.db_utils.delete_orphaned_document_chunks()
+            stats['deleted_documents_purged'] = self.db_utils.purge_deleted_documents()
+
+            self.chroma_utils.bm25_index.save()
+
+        print(f'Compaction finished: {stats}')
+        return stats
+
+    def _run(self) -> None:
+        """
+        Runs compaction at startup and then every compaction interval until stopped,
+        deletions requested by other workers are finished every poll interval
+        :return:
+        """
+
+        compacted_at: Optional[float] = None
+        while not self._stopped.is_set():
+            try:
+                if compacted_at is None or 0 < self.compaction_interval <= time.monotonic() - compacted_at:
+                    compacted_at = time.monotonic()
+                    self.compact()
+                else:
+                    self.resume_unfinished_deletions()
+            except Exception as e:
+                print(f'Error running compaction: {str(e)}')
+            self._stopped.wait(self.poll_interval)
+
+    def start(self) -> None:
+        """
+        Makes this process delete chunks and starts the background compaction thread
+        :return:
+        """
+
+        self.is_writer = True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='compaction', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stops the background compaction thread after its current run
+        :return:
+        """
+
+        self._stopped.set()
@@ -0,0 +1,193 @@
+"""
+This file contains the persistent embedding cache, that sits
+in front of the embedding model, so that identical chunks and
+queries are never embedded twice
+"""
+
+from application_api.utils.config import Config
+
+from langchain_core.embeddings import Embeddings
+from array import array
+from typing import Dict, List, Optional, Text, Tuple
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper, that keeps vectors in SQLite keyed by
+    hash of (model name, text) and evicts least recently used ones
+    """
+
+    CACHE_PATH: str = Config.EMBEDDING_CACHE_PATH
+    MAX_ENTRIES: int = 200_000
+
+    # SQLite limits number of parameters in a single statement
+    _QUERY_BATCH_SIZE: int = 500
+
+    def __init__(
+            self,
+            embeddings: Embeddings,
+            model_name: str,
+            cache_path: str = CACHE_PATH,
+            max_entries: int = MAX_ENTRIES
+    ) -> None:
+        self.embeddings: Embeddings = embeddings
+        self.model_name: str = model_name
+        self.max_entries: int = max_entries
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+        self._connection: sqlite3.Connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS embedding_cache
+                                    (key TEXT PRIMARY KEY,
+                                     vector BLOB,
+                                     last_used REAL)''')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS idx_embedding_cache_last_used ON embedding_cache (last_used)'
+        )
+        self._connection.commit()
+        self._entries: int = self._connection.execute('SELECT COUNT(*) FROM embedding_cache').fetchone()[0]
+
+    def _get_key(self, kind: str, text: str) -> str:
+        """
+        Returns cache key of a text, query and document
+        embeddings are kept apart as models may encode them differently
+        :param kind:
+        :param text:
+        :return:
+        """
+
+        return hashlib.sha256(f'{self.model_name}\0{kind}\0{text}'.encode('utf-8')).hexdigest()
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        """
+        Returns cached vectors for given keys and marks them as recently used
+        :param keys:
+        :return:
+        """
+
+        vectors: Dict[str, List[float]] = {}
+        now: float = time.time()
+
+        with self._lock:
+            for start in range(0, len(keys), CachedEmbeddings._QUERY_BATCH_SIZE):
+                batch: List[str] = keys[start:start + CachedEmbeddings._QUERY_BATCH_SIZE]
+                placeholders: str = ', '.join('?' for _ in batch)
+                rows: List[Tuple[str, bytes]] = self._connection.execute(
+                    f'SELECT key, vector FROM embedding_cache WHERE key IN ({placeholders})', batch
+                ).fetchall()
+                for key, vector in rows:
+                    vectors[key] = array('f', vector).tolist()
+
+                self._connection.execute(
+                    f'UPDATE embedding_cache SET last_used = ? WHERE key IN ({placeholders})', (now, *batch)
+                )
+            self._connection.commit()
+
+        return vectors
+
+    def _store(self, vectors: Dict[str, List[float]]) -> None:
+        """
+        Stores new vectors and evicts least recently used ones above the size cap
+        :param vectors:
+        :return:
+        """
+
+        now: float = time.time()
+        with self._lock:
+            cursor: sqlite3.Cursor = self._connection.executemany(
+                'INSERT OR IGNORE INTO embedding_cache (key, vector, last_used) VALUES (?, ?, ?)',
+                [(key, array('f', vector).tobytes(), now) for key, vector in vectors.items()]
+            )
+            self._entries += cursor.rowcount
+
+            if self._entries > self.max_entries:
+                # Evicting a bit more than needed, so eviction does not run on every insert
+                overflow: int = self._entries - int(self.max_entries * 0.95)
+                self._connection.execute(
+                    'DELETE FROM embedding_cache WHERE key IN '
+                    '(SELECT key FROM embedding_cache ORDER BY last_used LIMIT ?)',
+                    (overflow,)
+                )
+                self._entries -= overflow
+            self._connection.commit()
+
+    def _embed(self, kind: str, texts: List[str], batch_queries: bool = False) -> List[List[float]]:
+        """
+        Embeds texts, computing only the ones missing in cache
+        :param kind:
+        :param texts:
+        :param batch_queries: compute missing queries in one batch instead of one by one
+        :return:
+        """
+
+        keys: List[str] = [self._get_key(kind, text) for text in texts]
+        vectors: Dict[str, List[float]] = self._lookup(list(set(keys)))
+
+        missing: Dict[str, str] = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            if kind == 'query' and not batch_queries:
+                computed: List[List[float]] = [self.embeddings.embed_query(text) for text in missing.values()]
+            else:
+                computed: List[List[float]] = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors: Dict[str, List[float]] = dict(zip(missing.keys(), computed))
+            self._store(new_vectors)
+            vectors.update(new_vectors)
+
+        with self._lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+
+        return [vectors[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds document chunks through the cache
+        :param texts:
+        :return:
+        """
+
+        return self._embed('document', texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds query through the cache
+        :param text:
+        :return:
+        """
+
+        return self._embed('query', [text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds several queries through the cache, computing the missing ones in a single batch.
+        Vectors are cached as queries, so embed_query of the same text hits them.
+        The configured model encodes queries and documents the same way
+        :param texts:
+        :return:
+        """
+
+        return self._embed('query', texts, batch_queries=True)
+
+    def get_stats(self) -> Dict[Text, Optional[float]]:
+        """
+        Returns hit/miss counters of the cache
+        :return:
+        """
+
+        with self._lock:
+            lookups: int = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'entries': self._entries,
+                'max_entries': self.max_entries
+            }
@@ -0,0 +1,160 @@
+"""
+This file contains the chat history policy, that bounds
+how much of a session's history is passed to the prompts,
+so that prompt size stays constant for long sessions
+"""
+
+from application_api.utils.context_packer import ContextPacker
+from application_api.utils.db_utils import DBUtils
+from application_api.utils.langchain_utils import LangChainUtils
+from application_api.utils.token_utils import TokenUtils
+
+from enum import Enum
+from typing import Any, Dict, List, Optional, Text
+
+
+class HistoryMode(str, Enum):
+    """
+    Defines the available chat history policies
+    """
+
+    # Whole session history
+    FULL = 'full'
+    # Last MAX_TURNS question/answer turns and up to WINDOW_STEP_TURNS - 1 older ones
+    WINDOW = 'window'
+    # Latest turns fitting into TOKEN_BUDGET tokens
+    TOKEN_BUDGET = 'token_budget'
+    # Rolling summary of older turns followed by the turns it does not cover yet
+    SUMMARY = 'summary'
+
+
+class ChatHistoryManager:
+    """
+    Class, that selects chat history passed to the RAG chain
+    according to the configured history policy
+    """
+
+    MODE: HistoryMode = HistoryMode.WINDOW
+    MAX_TURNS: int = 6
+    # Window start moves by this many turns at once, so that history stays a prefix
+    # of the previous prompt between the moves and Ollama reuses its prompt cache.
+    # The context packer trims history by the same step, so that its trims fall on the same turns
+    WINDOW_STEP_TURNS: int = ContextPacker.HISTORY_STEP_TURNS
+    TOKEN_BUDGET: int = 1500
+    # Turns, that fall out of the window, are summarized in batches of this size
+    SUMMARY_BATCH_TURNS: int = 6
+
+    def __init__(
+            self,
+            db_utils: DBUtils,
+            langchain_utils: LangChainUtils,
+            mode: HistoryMode = MODE,
+            max_turns: int = MAX_TURNS,
+            token_budget: int = TOKEN_BUDGET,
+            window_step_turns: int = WINDOW_STEP_TURNS
+    ) -> None:
+        self.db_utils: DBUtils = db_utils
+        self.langchain_utils: LangChainUtils = langchain_utils
+        self.mode: HistoryMode = mode
+        self.max_turns: int = max_turns
+        self.token_budget: int = token_budget
+        self.window_step_turns: int = max(1, window_step_turns)
+
+    def get_chat_history(self, session_id: str) -> List[Dict[Text, Text]]:
+        """
+        Returns chat history of a session according to the history policy
+        :param session_id:
+        :return:
+        """
+
+        if self.mode == HistoryMode.FULL:
+            return self.db_utils.get_chat_history(session_id)
+
+        if self.mode == HistoryMode.TOKEN_BUDGET:
+            messages: List[Dict[Text, Text]] = self.db_utils.get_chat_history(session_id, self.max_turns)
+            # Dropping oldest turns until the rest fits into the budget
+            while messages and TokenUtils.count_message_tokens(messages) > self.token_budget:
+                messages = messages[2:]
+            return messages
+
+        if self.mode == HistoryMode.WINDOW:
+            return self.db_utils.get_chat_history(session_id, self._get_window_turns(session_id))
+
+        summary: Optional[Dict[Text, Any]] = self.db_utils.get_session_summary(session_id)
+        # Turns not yet folded into the summary are passed verbatim
+        turns: List[Dict[Text, Any]] = self.db_utils.get_chat_turns(
+            session_id,
+            self.max_turns + self.SUMMARY_BATCH_TURNS,
+            after_id=summary['summarized_until'] if summary else 0
+        )
+
+        messages: List[Dict[Text, Text]] = self._to_messages(turns)
+        if summary:
+            messages.insert(0, {
+                'role': 'system',
+                'content': f'Summary of the earlier conversation: {summary["summary"]}'
+            })
+        return messages
+
+    def _get_window_turns(self, session_id: str) -> int:
+        """
+        Returns number of latest turns in the window: the oldest turns are dropped
+        window_step_turns at a time, so the window holds from max_turns
+        to max_turns + window_step_turns - 1 turns
+        :param session_id:
+        :return:
+        """
+
+        outdated_turns: int = max(0, self.db_utils.count_chat_turns(session_id) - self.max_turns)
+        return self.max_turns + outdated_turns % self.window_step_turns
+
+    @staticmethod
+    def _to_messages(turns: List[Dict[Text, Any]]) -> List[Dict[Text, Text]]:
+        """
+        Converts question/answer turns to chat messages
+        :param turns:
+        :return:
+        """
+
+        messages: List[Dict[Text, Text]] = []
+        for turn in turns:
+            messages.extend([
+                {'role': 'human', 'content': turn['user_query']},
+                {'role': 'ai', 'content': turn['gpt_response']}
+            ])
+        return messages
+
+    def refresh_summary(self, session_id: str, model: str) -> None:
+        """
+        Folds turns, that fell out of the history window, into the
+        session's rolling summary. Meant to run after the response is sent
+        :param session_id:
+        :param model:
+        :return:
+        """
+
+        if self.mode != HistoryMode.SUMMARY:
+            return
+
+        summary: Optional[Dict[Text, Any]] = self.db_utils.get_session_summary(session_id)
+        summarized_until: int = summary['summarized_until'] if summary else 0
+
+        turns: List[Dict[Text, Any]] = self.db_utils.get_chat_turns(
+            session_id,
+            self.max_turns + self.SUMMARY_BATCH_TURNS * 2,
+            after_id=summarized_until
+        )
+        # Turns inside the window are still passed verbatim
+        outdated_turns: List[Dict[Text, Any]] = turns[:-self.max_turns] if self.max_turns else turns
+        if len(outdated_turns) < self.SUMMARY_BATCH_TURNS:
+            return
+
+        try:
+            new_summary: str = self.langchain_utils.summarize_history(
+                model, summary['summary'] if summary else '', self._to_messages(outdated_turns)
+            )
+        except Exception as e:
+            print(f'Error summarizing history of session {session_id}: {str(e)}')
+            return
+
+        self.db_utils.upsert_session_summary(session_id, new_summary, outdated_turns[-1]['id'])
@@ -0,0 +1,230 @@
+"""
+This file contains the hybrid retriever, that merges results
+of vector similarity search and BM25 lexical search
+with reciprocal-rank fusion and optionally reranks them
+with a cross-encoder
+"""
+
+from application_api.utils.bm25_index import BM25Index
+from application_api.utils.metrics import metrics
+from application_api.utils.reranker import CrossEncoderReranker
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
+from typing import Any, Dict, List, Optional, Tuple
+import asyncio
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever, that ranks chunks found by both vector and lexical
+    search by the sum of 1 / (rrf_k + rank) over the two rankings.
+    With a reranker, rerank_fetch_k fused candidates are reranked down to k
+    """
+
+    # Chroma or the quantized store
+    vector_store: VectorStore
+    bm25_index: BM25Index
+    k: int = 2
+    # Number of candidates taken from each of the two searches before fusion
+    fetch_k: int = 10
+    rrf_k: int = 60
+    reranker: Optional[CrossEncoderReranker] = None
+    rerank_fetch_k: int = 40
+
+    @property
+    def candidate_count(self) -> int:
+        """
+        Returns number of fused candidates kept for the final ranking
+        :return:
+        """
+
+        return self.rerank_fetch_k if self.reranker is not None else self.k
+
+    @property
+    def search_k(self) -> int:
+        """
+        Returns number of candidates taken from each of the two searches
+        :return:
+        """
+
+        return max(self.fetch_k, self.candidate_count)
+
+    @staticmethod
+    def fuse(rankings: List[List[str]], rrf_k: int) -> List[Tuple[str, float]]:
+        """
+        Merges rankings of chunk ids with reciprocal-rank fusion
+        :param rankings:
+        :param rrf_k:
+        :return: chunk ids with fused scores, best first
+        """
+
+        scores: Dict[str, float] = {}
+        for ranking in rankings:
+            for rank, chunk_id in enumerate(ranking, start=1):
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (rrf_k + rank)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+    def _select(
+            self,
+            vector_documents: List[Document],
+            lexical_ids: List[str]
+    ) -> Tuple[List[str], Dict[str, Document]]:
+        """
+        Fuses both rankings and returns ids of the candidates kept and documents already at hand
+        :param vector_documents:
+        :param lexical_ids:
+        :return:
+        """
+
+        fused: List[Tuple[str, float]] = self.fuse(
+            [[document.id for document in vector_documents], lexical_ids], self.rrf_k
+        )
+        return (
+            [chunk_id for chunk_id, _ in fused[:self.candidate_count]],
+            {document.id: document for document in vector_documents}
+        )
+
+    @staticmethod
+    def get_filter(file_ids: Optional[List[int]]) -> Optional[Dict[str, Any]]:
+        """
+        Returns Chroma where clause, that limits search to chunks of given files
+        :param file_ids: None to search all files
+        :return:
+        """
+
+        if file_ids is None:
+            return None
+        if len(file_ids) == 1:
+            return {'file_id': file_ids[0]}
+        return {'file_id': {'$in': list(file_ids)}}
+
+    def _get_relevant_documents(
+            self,
+            query: str,
+            *,
+            run_manager: CallbackManagerForRetrieverRun,
+            file_ids: Optional[List[int]] = None
+    ) -> List[Document]:
+        # An empty selection of files matches no chunks
+        if file_ids is not None and not file_ids:
+            return []
+
+        with metrics.span('vector_search'):
+            vector_documents: List[Document] = self.vector_store.similarity_search(
+                query, k=self.search_k, filter=self.get_filter(file_ids)
+            )
+        with metrics.span('bm25_search'):
+            lexical_ids: List[str] = [
+                chunk_id for chunk_id, _ in self.bm25_index.search(query, self.search_k, file_ids)
+            ]
+
+        selected_ids, documents = self._select(vector_documents, lexical_ids)
+        missing_ids: List[str] = [chunk_id for chunk_id in selected_ids if chunk_id not in documents]
+        if missing_ids:
+            documents.update({document.id: document for document in self.vector_store.get_by_ids(missing_ids)})
+        candidates: List[Document] = [documents[chunk_id] for chunk_id in selected_ids if chunk_id in documents]
+
+        if self.reranker is None:
+            return candidates
+        with metrics.span('rerank'):
+            return self.reranker.rerank(query, candidates, self.k)
+
+    async def _aget_relevant_documents(
+            self,
+            query: str,
+            *,
+            run_manager: AsyncCallbackManagerForRetrieverRun,
+            file_ids: Optional[List[int]] = None
+    ) -> List[Document]:
+        if file_ids is not None and not file_ids:
+            return []
+
+        with metrics.span('vector_search'):
+            vector_documents: List[Document] = await self.vector_store.asimilarity_search(
+                query, k=self.search_k, filter=self.get_filter(file_ids)
+            )
+        with metrics.span('bm25_search'):
+            lexical_ids: List[str] = [
+                chunk_id for chunk_id, _ in self.bm25_index.search(query, self.search_k, file_ids)
+            ]
+
+        selected_ids, documents = self._select(vector_documents, lexical_ids)
+        missing_ids: List[str] = [chunk_id for chunk_id in selected_ids if chunk_id not in documents]
+        if missing_ids:
+            documents.update({
+                document.id: document for document in await self.vector_store.aget_by_ids(missing_ids)
+            })
+        candidates: List[Document] = [documents[chunk_id] for chunk_id in selected_ids if chunk_id in documents]
+
+        if self.reranker is None:
+            return candidates
+        # Cross-encoder scoring is CPU-bound, so it is kept off the event loop
+        with metrics.span('rerank'):
+            return await asyncio.get_running_loop().run_in_executor(
+                None, self.reranker.rerank, query, candidates, self.k
+            )
+
+    def retrieve_batch(
+            self,
+            queries: List[str],
+            embeddings: List[List[float]],
+            file_ids: Optional[List[Optional[List[int]]]] = None
+    ) -> List[List[Document]]:
+        """
+        Retrieves documents for several already embedded queries with one multi-vector
+        Chroma query per distinct file selection and a single lookup of chunks found only by BM25
+        :param queries:
+        :param embeddings:
+        :param file_ids: files every query is limited to, None for no limits
+        :return: documents of every query, in the order of queries
+        """
+
+        file_ids = file_ids or [None] * len(queries)
+        # Chroma applies one where clause to all query vectors, so queries are grouped by their selection
+        groups: Dict[Optional[Tuple[int, ...]], List[int]] = {}
+        for position, selection in enumerate(file_ids):
+            if selection is None or selection:
+                groups.setdefault(None if selection is None else tuple(sorted(set(selection))), []).append(position)
+
+        selections: List[List[str]] = [[] for _ in queries]
+        documents: Dict[str, Document] = {}
+        for selection, positions in groups.items():
+            with metrics.span('vector_search'):
+                results: Dict[str, Any] = self.vector_store._collection.query(
+                    query_embeddings=[embeddings[position] for position in positions],
+                    n_results=self.search_k,
+                    where=self.get_filter(None if selection is None else list(selection)),
+                    include=['documents', 'metadatas']
+                )
+            with metrics.span('bm25_search'):
+                lexical_rankings: List[List[str]] = [
+                    [chunk_id for chunk_id, _ in self.bm25_index.search(queries[position], self.search_k, selection)]
+                    for position in positions
+                ]
+
+            for position, ids, texts, metadatas, lexical_ids in zip(
+                    positions, results['ids'], results['documents'], results['metadatas'], lexical_rankings
+            ):
+                vector_documents: List[Document] = [
+                    Document(id=chunk_id, page_content=text, metadata=metadata or {})
+                    for chunk_id, text, metadata in zip(ids, texts, metadatas)
+                ]
+                selections[position], found = self._select(vector_documents, lexical_ids)
+                documents.update(found)
+
+        missing_ids: List[str] = list({
+            chunk_id for selected_ids in selections for chunk_id in selected_ids if chunk_id not in documents
+        })
+        if missing_ids:
+            documents.update({document.id: document for document in self.vector_store.get_by_ids(missing_ids)})
+        candidates: List[List[Document]] = [
+            [documents[chunk_id] for chunk_id in selected_ids if chunk_id in documents] for selected_ids in selections
+        ]
+
+        if self.reranker is None:
+            return candidates
+        with metrics.span('rerank'):
+            return [self.reranker.rerank(query, found, self.k) for query, found in zip(queries, candidates)]
@@ -0,0 +1,234 @@
+"""
+This file contains the staged document ingestion pipeline.
+Pages are loaded, split, embedded in fixed-size batches and
+written to the vector store in batches, with the stages linked
+by bounded queues, so that memory stays flat for any document size
+"""
+
+from application_api.utils.metrics import metrics
+
+from langchain_core.documents import Document
+from langchain_text_splitters import TextSplitter
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import deque
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional
+import os
+import queue
+import threading
+
+
+class IngestionPipeline:
+    """
+    Class, that runs load -> split -> embed -> write stages concurrently
+    """
+
+    BATCH_SIZE: int = 64
+    QUEUE_SIZE: int = 8
+    EMBEDDING_WORKERS: int = os.cpu_count() or 1
+
+    # Marks the end of a stage's output in a queue
+    _END: object = object()
+
+    def __init__(
+            self,
+            text_splitter: TextSplitter,
+            embed_documents: Callable[[List[str]], List[List[float]]],
+            write_batch: Callable[[List[Document], List[List[float]]], List[str]],
+            batch_size: int = BATCH_SIZE,
+            embedding_workers: int = EMBEDDING_WORKERS
+    ) -> None:
+        self.text_splitter: TextSplitter = text_splitter
+        self.embed_documents: Callable[[List[str]], List[List[float]]] = embed_documents
+        self.write_batch: Callable[[List[Document], List[List[float]]], List[str]] = write_batch
+        self.batch_size: int = batch_size
+        self.embedding_workers: int = embedding_workers
+
+    def run(
+            self,
+            pages: Iterable[Document],
+            file_id: int,
+            progress_callback: Optional[Callable[..., None]] = None
+    ) -> List[str]:
+        """
+        Indexes pages of a document and returns ids of written chunks.
+        Progress (pages_parsed, chunks_total, chunks_embedded)
+        is reported through progress_callback if it is given
+        :param pages:
+        :param file_id:
+        :param progress_callback:
+        :return:
+        """
+
+        report: Callable[..., None] = progress_callback or (lambda **progress: None)
+        stop: threading.Event = threading.Event()
+        page_queue: queue.Queue = queue.Queue(maxsize=IngestionPipeline.QUEUE_SIZE)
+        batch_queue: queue.Queue = queue.Queue(maxsize=IngestionPipeline.QUEUE_SIZE)
+
+        stages: List[threading.Thread] = [
+            threading.Thread(target=self._load_stage, args=(pages, page_queue, stop), daemon=True),
+            threading.Thread(
+                target=self._split_stage, args=(page_queue, batch_queue, file_id, report, stop), daemon=True
+            )
+        ]
+        for stage in stages:
+            stage.start()
+
+        chunk_ids: List[str] = []
+        in_flight: Deque[Future] = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=self.embedding_workers, thread_name_prefix='embedding') as executor:
+                while True:
+                    batch: Any = batch_queue.get()
+                    if batch is IngestionPipeline._END:
+                        break
+                    if isinstance(batch, BaseException):
+                        raise batch
+
+                    in_flight.append(executor.submit(self._embed_batch, batch))
+                    # Bounded number of batches being embedded keeps memory flat
+                    while len(in_flight) >= self.embedding_workers:
+                        chunk_ids.extend(self._write(in_flight.popleft(), chunk_ids, report))
+
+                while in_flight:
+                    chunk_ids.extend(self._write(in_flight.popleft(), chunk_ids, report))
+        finally:
+            stop.set()
+            for future in in_flight:
+                future.cancel()
+            for stage in stages:
+                stage.join()
+
+        return chunk_ids
+
+    def split_page(self, page: Document, page_number: int) -> List[Document]:
+        """
+        Splits a page into chunks, that keep number of the page they come from
+        :param page:
+        :param page_number: 1-based position of the page in the document
+        :return:
+        """
+
+        with metrics.span('ingestion_split'):
+            splits: List[Document] = self.text_splitter.split_documents([page])
+        for split in splits:
+            split.metadata['page_number'] = page_number
+        return splits
+
+    def _write(self, future: Future, chunk_ids: List[str], report: Callable[..., None]) -> List[str]:
+        """
+        Waits for an embedded batch and writes it to the vector store
+        :param future:
+        :param chunk_ids:
+        :param report:
+        :return:
+        """
+
+        batch, embeddings = future.result()
+        with metrics.span('ingestion_write'):
+            written_ids: List[str] = self.write_batch(batch, embeddings)
+        report(chunks_embedded=len(chunk_ids) + len(written_ids))
+        return written_ids
+
+    def _embed_batch(self, batch: List[Document]) -> Any:
+        """
+        Embeds texts of a batch of chunks
+        :param batch:
+        :return:
+        """
+
+        with metrics.span('ingestion_embed'):
+            return batch, self.embed_documents([chunk.page_content for chunk in batch])
+
+    @staticmethod
+    def _put(target: queue.Queue, item: Any, stop: threading.Event) -> bool:
+        """
+        Puts item into bounded queue, giving up when the pipeline is stopped
+        :param target:
+        :param item:
+        :param stop:
+        :return:
+        """
+
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _load_stage(self, pages: Iterable[Document], page_queue: queue.Queue, stop: threading.Event) -> None:
+        """
+        Pulls pages from the loader into page queue
+        :param pages:
+        :param page_queue:
+        :param stop:
+        :return:
+        """
+
+        try:
+            page_iterator: Iterator[Document] = iter(pages)
+            while True:
+                with metrics.span('ingestion_load'):
+                    page: Optional[Document] = next(page_iterator, None)
+                if page is None:
+                    break
+                if not self._put(page_queue, page, stop):
+                    return
+            self._put(page_queue, IngestionPipeline._END, stop)
+        except Exception as e:
+            self._put(page_queue, e, stop)
+
+    def _split_stage(
+            self,
+            page_queue: queue.Queue,
+            batch_queue: queue.Queue,
+            file_id: int,
+            report: Callable[..., None],
+            stop: threading.Event
+    ) -> None:
+        """
+        Splits pages into chunks and groups chunks into fixed-size batches
+        :param page_queue:
+        :param batch_queue:
+        :param file_id:
+        :param report:
+        :param stop:
+        :return:
+        """
+
+        pages_parsed: int = 0
+        chunk_index: int = 0
+        batch: List[Document] = []
+
+        try:
+            while not stop.is_set():
+                try:
+                    page: Any = page_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if page is IngestionPipeline._END:
+                    break
+                if isinstance(page, BaseException):
+                    raise page
+
+                pages_parsed += 1
+                for split in self.split_page(page, pages_parsed):
+                    # Adding metadata, that links chunk back to database record
+                    split.metadata['file_id'] = file_id
+                    split.metadata['chunk_index'] = chunk_index
+                    chunk_index += 1
+
+                    batch.append(split)
+                    if len(batch) == self.batch_size:
+                        if not self._put(batch_queue, batch, stop):
+                            return
+                        batch = []
+
+                report(pages_parsed=pages_parsed, chunks_total=chunk_index)
+
+            if batch and not self._put(batch_queue, batch, stop):
+                return
+            self._put(batch_queue, IngestionPipeline._END, stop)
+        except Exception as e:
+            self._put(batch_queue, e, stop)
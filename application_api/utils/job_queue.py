@@ -0,0 +1,264 @@
+"""
+This file contains the background queue for document ingestion.
+Uploaded files are spooled to disk and indexed by a bounded
+worker pool, while job state is kept in the SQLite database.
+Jobs are run only by the process writing the indexes, jobs
+queued by other workers are picked up from the database
+"""
+
+from application_api.model.pydantic_models import JobStatus
+from application_api.utils.chroma_utils import ChromaUtils
+from application_api.utils.config import Config
+from application_api.utils.db_utils import DBUtils
+from application_api.utils.document_deleter import DocumentDeleter
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set, Text
+import os
+import threading
+import time
+
+
+class IngestionJobQueue:
+    """
+    Class, that runs document ingestion jobs in the background
+    """
+
+    # Uploads wait here until indexed, RAG_UPLOAD_DIRECTORY moves them to a disk sized for them
+    UPLOAD_DIRECTORY: str = Config.UPLOAD_DIRECTORY
+    MAX_CONCURRENT_JOBS: int = 2
+    POLL_INTERVAL_SECONDS: float = Config.POLL_INTERVAL_SECONDS
+    # Chunks re-embedded per call to the embedding model
+    REEMBED_BATCH_SIZE: int = 256
+
+    def __init__(
+            self,
+            db_utils: DBUtils,
+            chroma_utils: ChromaUtils,
+            document_deleter: DocumentDeleter,
+            max_workers: int = MAX_CONCURRENT_JOBS,
+            on_indexed: Optional[Callable[[int], None]] = None,
+            poll_interval: float = POLL_INTERVAL_SECONDS
+    ) -> None:
+        self.db_utils: DBUtils = db_utils
+        self.chroma_utils: ChromaUtils = chroma_utils
+        # Removes chunks and records of documents, that could not be indexed
+        self.document_deleter: DocumentDeleter = document_deleter
+        # Called with file_id once a document's chunks have been (re)written
+        self.on_indexed: Callable[[int], None] = on_indexed or (lambda file_id: None)
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='ingestion'
+        )
+        self.poll_interval: float = poll_interval
+        # Jobs are run only after start, in the process writing the indexes
+        self.is_writer: bool = False
+        self._scheduled: Set[str] = set()
+        self._lock: threading.Lock = threading.Lock()
+        os.makedirs(IngestionJobQueue.UPLOAD_DIRECTORY, exist_ok=True)
+
+    @staticmethod
+    def get_upload_path(job_id: str, file_extension: str) -> str:
+        """
+        Returns path, where uploaded file of the job is kept until it is indexed
+        :param job_id:
+        :param file_extension:
+        :return:
+        """
+
+        return os.path.join(IngestionJobQueue.UPLOAD_DIRECTORY, f'{job_id}{file_extension}')
+
+    def submit(
+            self,
+            job_id: str,
+            file_id: int,
+            filename: str,
+            file_path: str,
+            replace_existing: bool = False
+    ) -> None:
+        """
+        Records new job in database and schedules it for execution, or leaves it
+        queued for the writer process if this process does not write the indexes.
+        With replace_existing, chunks already indexed for the file_id are replaced
+        :param job_id:
+        :param file_id:
+        :param filename:
+        :param file_path:
+        :param replace_existing:
+        :return:
+        """
+
+        self.db_utils.insert_ingestion_job(
+            job_id, file_id, filename, file_path, JobStatus.QUEUED.value, replace_existing
+        )
+        if self.is_writer:
+            self._schedule(job_id, False)
+
+    def _schedule(self, job_id: str, interrupted: bool) -> None:
+        """
+        Submits job to the worker pool unless it is already submitted
+        :param job_id:
+        :param interrupted:
+        :return:
+        """
+
+        with self._lock:
+            if job_id in self._scheduled:
+                return
+            self._scheduled.add(job_id)
+        self.executor.submit(self._run_job, job_id, interrupted)
+
+    def resume_unfinished_jobs(self) -> int:
+        """
+        Schedules jobs, that were queued or running when the previous writer stopped
+        :return:
+        """
+
+        jobs: List[Dict[Text, Any]] = self.db_utils.get_ingestion_jobs(
+            [JobStatus.QUEUED.value, JobStatus.RUNNING.value]
+        )
+        for job in jobs:
+            self._schedule(job['id'], job['status'] == JobStatus.RUNNING.value)
+        return len(jobs)
+
+    def _poll(self) -> None:
+        """
+        Schedules jobs queued by other workers every poll interval
+        :return:
+        """
+
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                for job in self.db_utils.get_ingestion_jobs([JobStatus.QUEUED.value]):
+                    self._schedule(job['id'], False)
+            except Exception as e:
+                print(f'Error polling ingestion jobs: {str(e)}')
+
+    def start(self) -> None:
+        """
+        Makes this process run the jobs: resumes unfinished ones and picks up jobs queued by other workers
+        :return:
+        """
+
+        self.is_writer = True
+        self.resume_unfinished_jobs()
+        threading.Thread(target=self._poll, name='ingestion-poll', daemon=True).start()
+
+    def _run_job(self, job_id: str, interrupted: bool) -> None:
+        """
+        Indexes the job's file to Chroma, reporting progress to database
+        :param job_id:
+        :param interrupted:
+        :return:
+        """
+
+        job: Optional[Dict[Text, Any]] = self.db_utils.get_ingestion_job(job_id)
+        # A job already taken by another run is left to it
+        expected_status: str = JobStatus.RUNNING.value if interrupted else JobStatus.QUEUED.value
+        if job is None or not self.db_utils.claim_ingestion_job(job_id, expected_status):
+            with self._lock:
+                self._scheduled.discard(job_id)
+            return
+
+        last_progress: Dict[Text, int] = {}
+
+        def report_progress(**progress: int) -> None:
+            last_progress.update(progress)
+            self.db_utils.update_ingestion_job(job_id, **progress)
+
+        # Chunks of the previous indexing, that a replacing job deletes once the new ones are written
+        previous_chunks: int = 0
+        # Number of chunks written before the job's own ones, while these can still be removed on failure
+        written_after: Optional[int] = None
+        # Number of chunks the job wrote, once the previous chunks are being removed
+        new_chunks: Optional[int] = None
+        try:
+            if not os.path.exists(job['file_path']):
+                self._discard(job, None, 'Uploaded file is no longer available')
+                return
+
+            # Chunks written before the interruption would otherwise be duplicated
+            if interrupted:
+                self.chroma_utils.delete_doc_from_chroma(job['file_id'])
+                self.db_utils.delete_document_chunks(file_id=job['file_id'])
+            elif job['replace_existing']:
+                previous_chunks = self.db_utils.count_document_chunks(job['file_id'])
+                # Chunks indexed before their ids were recorded are found only by file_id, like the new ones
+                if not previous_chunks:
+                    self.chroma_utils.delete_doc_from_chroma(job['file_id'])
+            written_after = previous_chunks
+
+            success: bool = self.chroma_utils.index_document_to_chroma(
+                job['file_path'], job['file_id'], progress_callback=report_progress
+            )
+            if success:
+                if previous_chunks:
+                    new_chunks = self.db_utils.count_document_chunks(job['file_id']) - previous_chunks
+                # The new chunks are kept from here on, even if the job fails
+                written_after = None
+                if previous_chunks:
+                    self.document_deleter.remove_chunks(job['file_id'], limit=previous_chunks)
+                    new_chunks = None
+                self.db_utils.update_document_manifest(
+                    job['file_id'], self.chroma_utils.embedding_function.model_name,
+                    page_count=last_progress.get('pages_parsed', 0)
+                )
+                self.db_utils.update_ingestion_job(job_id, status=JobStatus.COMPLETED.value)
+                self.on_indexed(job['file_id'])
+            else:
+                self._discard(job, written_after, f'Failed to index {job["filename"]}')
+        except Exception as e:
+            print(f'Error running ingestion job {job_id}: {str(e)}')
+            try:
+                # Previous chunks partly removed cannot be restored, the rest of them is removed instead
+                if new_chunks is not None:
+                    self.document_deleter.remove_chunks(
+                        job['file_id'], limit=self.db_utils.count_document_chunks(job['file_id']) - new_chunks
+                    )
+                self._discard(job, written_after, str(e))
+            except Exception as discard_error:
+                print(f'Error discarding ingestion job {job_id}: {str(discard_error)}')
+                self.db_utils.update_ingestion_job(job_id, status=JobStatus.FAILED.value, error=str(e))
+        finally:
+            if os.path.exists(job['file_path']):
+                os.remove(job['file_path'])
+            with self._lock:
+                self._scheduled.discard(job_id)
+
+    def _discard(self, job: Dict[Text, Any], written_after: Optional[int], error: str) -> None:
+        """
+        Marks job as failed and removes what it wrote. A new document is deleted with its chunks,
+        a replaced document keeps its record and the chunks indexed before the job
+        :param job:
+        :param written_after: number of chunks the document had before the job, None if it wrote none
+        :param error:
+        :return:
+        """
+
+        if not job['replace_existing']:
+            self.document_deleter.delete_documents([job['file_id']])
+        elif written_after is not None:
+            self.document_deleter.remove_chunks(job['file_id'], offset=written_after)
+            self.db_utils.refresh_chunk_counts()
+        self.db_utils.update_ingestion_job(job['id'], status=JobStatus.FAILED.value, error=error)
+
+    def reembed_document(self, file_id: int) -> int:
+        """
+        Embeds chunks of an indexed document again with the current embedding model.
+        Chunks are found by their recorded ids, so the uploaded file is not needed
+        :param file_id:
+        :return: number of re-embedded chunks
+        """
+
+        reembedded: int = 0
+        offset: int = 0
+        while True:
+            chunk_ids: List[str] = self.db_utils.get_document_chunk_ids(file_id, self.REEMBED_BATCH_SIZE, offset)
+            if not chunk_ids:
+                break
+            reembedded += self.chroma_utils.reembed_chunks(chunk_ids)
+            offset += len(chunk_ids)
+
+        self.db_utils.update_document_manifest(file_id, self.chroma_utils.embedding_function.model_name)
+        self.on_indexed(file_id)
+        return reembedded
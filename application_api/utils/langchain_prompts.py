@@ -4,23 +4,44 @@
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 
 
-contextualize_q_system_prompt = (
-    "Given a chat history and the latest user question "
+qa_system_prompt = "You are a helpful AI assistant. Use the following context to answer the user's question."
+
+contextualize_q_instruction = (
+    "Given the chat history above and the latest user question below, "
     "which might reference context in the chat history, "
     "formulate a standalone question which can be understood "
     "without the chat history. Do NOT answer the question, "
     "just reformulate it if needed and otherwise return it as is."
 )
 
+# Ollama caches one prompt per model unless it runs parallel requests, so the rewrite prompt starts like
+# the question-answering prompt (system prompt, then chat history) and leaves that prefix in the cache.
+# The instruction comes with the question in the last message
 contextualize_q_prompt = ChatPromptTemplate.from_messages([
-    ('system', contextualize_q_system_prompt),
+    ('system', qa_system_prompt),
     MessagesPlaceholder('chat_history'),
-    ('human', '{input}')
+    ('human', contextualize_q_instruction + '\n\nQuestion: {input}')
 ])
 
+# Context changes with every question, so it is passed with the question after the chat history:
+# the system prompt and earlier turns form a prefix, that stays the same from turn to turn
+# and is not evaluated again by Ollama
 qa_prompt = ChatPromptTemplate.from_messages([
-    ('system', "You are a helpful AI assistant. Use the following context to answer the user's question."),
-    ('system', 'Context: {context}'),
+    ('system', qa_system_prompt),
     MessagesPlaceholder(variable_name='chat_history'),
-    ('human', '{input}')
+    ('human', 'Context: {context}\n\nQuestion: {input}')
+])
+
+summarize_history_system_prompt = (
+    "Summarize the conversation between a user and an AI assistant below. "
+    "If a previous summary is given, extend it with the new messages. "
+    "Keep names, numbers, identifiers and open questions, "
+    "be concise and return only the summary."
+)
+
+summarize_history_prompt = ChatPromptTemplate.from_messages([
+    ('system', summarize_history_system_prompt),
+    ('system', 'Previous summary: {summary}'),
+    MessagesPlaceholder('chat_history'),
+    ('human', 'Summarize the conversation so far.')
 ])
@@ -4,16 +4,28 @@ such as creating the RAG chain and
 configuring the language model
 """
 
-from application_api.utils.chroma_utils import ChromaUtils
-from application_api.utils.langchain_prompts import contextualize_q_prompt, qa_prompt
+from application_api.model.pydantic_models import ModelName
+from application_api.utils.model_registry import ModelRegistry
+from application_api.utils.config import Config
+from application_api.utils.langchain_prompts import contextualize_q_prompt, qa_prompt, summarize_history_prompt
+from application_api.utils.rewrite_utils import QuestionRewriter
+from application_api.utils.answer_cache import SemanticAnswerCache
+from application_api.utils.hybrid_retriever import HybridRetriever
+from application_api.utils.reranker import CrossEncoderReranker
+from application_api.utils.context_packer import ContextPacker
+from application_api.utils.metrics import metrics
+from application_api.utils.token_utils import TokenUtils
 
-from langchain_ollama import OllamaLLM
 from langchain_core.output_parsers import StrOutputParser
-from langchain.chains import create_history_aware_retriever
+from langchain_core.runnables import Runnable, RunnableLambda, RunnablePassthrough
+from langchain_core.documents import Document
 from langchain.chains.retrieval import create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_chroma import Chroma
-from typing import Any
+from langchain_core.vectorstores import VectorStore
+from starlette.concurrency import run_in_threadpool
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Set, Text, Tuple
+import asyncio
+import threading
+import time
 
 
 class LangChainUtils:
@@ -21,19 +33,504 @@ class LangChainUtils:
     Implementation of core component of RAG system using LangChain
     """
 
-    def __init__(self, vector_store: Chroma = ChromaUtils().vector_store) -> None:
-        self.retriever = vector_store.as_retriever(search_kwargs={'k': 2})
+    # Over-fetched candidates are reranked by a cross-encoder when RAG_RERANK=1
+    RERANK: bool = Config.RERANK
+    # Generations of a batch running at once for every model
+    BATCH_CONCURRENCY: int = 4
+
+    def __init__(self, vector_store: Optional[VectorStore] = None, rerank: bool = RERANK) -> None:
+        vector_store = vector_store or ModelRegistry.get_vector_store()
+        self.retriever: HybridRetriever = HybridRetriever(
+            vector_store=vector_store,
+            bm25_index=ModelRegistry.get_bm25_index(),
+            k=2,
+            reranker=CrossEncoderReranker() if rerank else None
+        )
         self.output_parser = StrOutputParser()
+        self.question_rewriter: QuestionRewriter = QuestionRewriter()
+        self.answer_cache: SemanticAnswerCache = SemanticAnswerCache(vector_store.embeddings)
+        self.context_packer: ContextPacker = ContextPacker(prompt_tokens=self._count_prompt_tokens())
+
+        self._chains: Dict[Tuple[str, str], Any] = {}
+        self._chains_lock: threading.Lock = threading.Lock()
+
+    def _get_chain(self, name: str, model: str, create_chain: Callable[[str], Any]) -> Any:
+        """
+        Returns chain of the given kind for the given model, building it
+        once and reusing it for every following request
+        :param name:
+        :param model:
+        :param create_chain:
+        :return:
+        """
+
+        if (name, model) not in self._chains:
+            with self._chains_lock:
+                if (name, model) not in self._chains:
+                    self._chains[(name, model)] = create_chain(model)
+        return self._chains[(name, model)]
+
+    def get_rewrite_chain(self, model: str = ModelName.LLAMA3.value) -> Runnable:
+        """
+        Returns chain, that reformulates question into a standalone one using chat history
+        :param model:
+        :return:
+        """
+
+        return self._get_chain(
+            'rewrite', model, lambda name: contextualize_q_prompt | ModelRegistry.get_llm(name) | self.output_parser
+        )
+
+    @staticmethod
+    def _count_prompt_tokens() -> int:
+        """
+        Returns number of tokens of the question-answering prompt without context, history and question
+        :return:
+        """
+
+        return TokenUtils.count_message_tokens([
+            {'role': message.type, 'content': message.content}
+            for message in qa_prompt.format_messages(context='', chat_history=[], input='')
+        ])
+
+    @staticmethod
+    def _format_documents(inputs: Dict[Text, Any]) -> str:
+        """
+        Joins contents of retrieved documents into the prompt context
+        :param inputs:
+        :return:
+        """
+
+        return ContextPacker.CHUNK_SEPARATOR.join(document.page_content for document in inputs['context'])
+
+    def get_prompt_chain(self) -> Runnable:
+        """
+        Returns chain, that stuffs retrieved documents and chat history into the question-answering prompt
+        :return:
+        """
+
+        return self._get_chain(
+            'prompt', '', lambda _: RunnablePassthrough.assign(context=self._format_documents) | qa_prompt
+        )
+
+    def get_generation_chain(self, model: str = ModelName.LLAMA3.value) -> Runnable:
+        """
+        Returns chain, that generates answer text for a prompt
+        :param model:
+        :return:
+        """
+
+        return self._get_chain('generation', model, lambda name: ModelRegistry.get_llm(name) | self.output_parser)
 
-    def get_rag_chain(self, model='llama3') -> Any:
+    def get_qa_chain(self, model: str = ModelName.LLAMA3.value) -> Runnable:
         """
-        Creates RAG chain using LLM, history-aware retriever and question-answering chain
+        Returns question-answering chain, that stuffs retrieved documents into the prompt
+        and generates the answer. Prompt and generation chains are also used separately,
+        so that the two stages are timed apart
         :param model:
         :return:
         """
 
-        llm: OllamaLLM = OllamaLLM(model=model)
-        history_aware_retriever = create_history_aware_retriever(llm, self.retriever, contextualize_q_prompt)
-        question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
-        rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
+        return self._get_chain('qa', model, lambda name: self.get_prompt_chain() | self.get_generation_chain(name))
+
+    def get_rag_chain(self, model: str = ModelName.LLAMA3.value) -> Any:
+        """
+        Returns RAG chain for the given model, building it once
+        and reusing it for every following request
+        :param model:
+        :return:
+        """
+
+        return self._get_chain('rag', model, self._create_rag_chain)
+
+    def _create_rag_chain(self, model: str) -> Any:
+        """
+        Creates RAG chain using LLM, history-aware retriever and question-answering chain.
+        The question is reformulated with chat history only when the rewrite policy needs it
+        :param model:
+        :return:
+        """
+
+        rewrite_chain: Runnable = self.get_rewrite_chain(model)
+        history_aware_retriever = RunnableLambda(
+            lambda inputs: self.question_rewriter.get_standalone_question(
+                rewrite_chain, model, inputs['input'], inputs['chat_history']
+            )
+        ).with_config(run_name='rewrite_question') | self.retriever
+        rag_chain = create_retrieval_chain(history_aware_retriever, self.get_qa_chain(model))
         return rag_chain
+
+    def retrieve(
+            self,
+            question: str,
+            chat_history: List[Dict[Text, Text]],
+            model: str = ModelName.LLAMA3.value,
+            file_ids: Optional[List[int]] = None
+    ) -> Tuple[str, List[Document]]:
+        """
+        Reformulates question if needed and retrieves documents for it
+        :param question:
+        :param chat_history:
+        :param model:
+        :param file_ids: files to search in, all files if None
+        :return:
+        """
+
+        with metrics.span('rewrite'):
+            # History is trimmed like in the answer prompt, so that both prompts share their prefix
+            standalone_question: str = self.question_rewriter.get_standalone_question(
+                self.get_rewrite_chain(model), model, question, self.context_packer.trim_history(model, chat_history)
+            )
+        with metrics.span('retrieval'):
+            context: List[Document] = self.retriever.invoke(standalone_question, file_ids=file_ids)
+        metrics.observe('rag_retrieved_chunks', len(context), buckets=metrics.COUNT_BUCKETS)
+        return standalone_question, context
+
+    def _lookup_cached_answer(self, model: str, standalone_question: str, context: List[Document]) -> Optional[str]:
+        """
+        Looks up answer cache, timing the lookup
+        :param model:
+        :param standalone_question:
+        :param context:
+        :return:
+        """
+
+        with metrics.span('answer_cache_lookup'):
+            return self.answer_cache.lookup(model, standalone_question, context)
+
+    def _store_answer(self, model: str, standalone_question: str, context: List[Document], answer: str) -> None:
+        """
+        Stores answer in answer cache, timing the store
+        :param model:
+        :param standalone_question:
+        :param context:
+        :param answer:
+        :return:
+        """
+
+        with metrics.span('answer_cache_store'):
+            self.answer_cache.store(model, standalone_question, context, answer)
+
+    def _stuff_prompt(
+            self,
+            model: str,
+            question: str,
+            chat_history: List[Dict[Text, Text]],
+            context: List[Document]
+    ) -> Any:
+        """
+        Packs history and retrieved documents into the model's token budget
+        and formats the question-answering prompt with them
+        :param model:
+        :param question:
+        :param chat_history:
+        :param context:
+        :return:
+        """
+
+        with metrics.span('prompt_stuffing'):
+            history, packed_context = self.context_packer.pack(model, question, chat_history, context)
+            prompt: Any = self.get_prompt_chain().invoke({
+                'input': question,
+                'chat_history': history,
+                'context': packed_context
+            })
+        metrics.observe(
+            'rag_prompt_tokens', TokenUtils.count_tokens(prompt.to_string()), buckets=metrics.TOKEN_BUCKETS
+        )
+        return prompt
+
+    def answer(
+            self,
+            question: str,
+            chat_history: List[Dict[Text, Text]],
+            model: str = ModelName.LLAMA3.value,
+            file_ids: Optional[List[int]] = None
+    ) -> Dict[Text, Any]:
+        """
+        Answers question using retrieved documents, returning
+        a cached answer when a similar question was answered
+        from the same documents
+        :param question:
+        :param chat_history:
+        :param model:
+        :param file_ids: files to search in, all files if None
+        :return:
+        """
+
+        standalone_question, context = self.retrieve(question, chat_history, model, file_ids)
+
+        cached_answer: Optional[str] = self._lookup_cached_answer(model, standalone_question, context)
+        if cached_answer is not None:
+            return {'answer': cached_answer, 'context': context, 'cached': True}
+
+        prompt: Any = self._stuff_prompt(model, question, chat_history, context)
+
+        started: float = time.perf_counter()
+        answer: str = self.get_generation_chain(model).invoke(prompt)
+        elapsed: float = time.perf_counter() - started
+        metrics.record('generation', elapsed)
+        metrics.record_generation(TokenUtils.count_tokens(answer), elapsed)
+
+        self._store_answer(model, standalone_question, context, answer)
+        return {'answer': answer, 'context': context, 'cached': False}
+
+    def stream_answer(
+            self,
+            question: str,
+            chat_history: List[Dict[Text, Text]],
+            model: str = ModelName.LLAMA3.value,
+            file_ids: Optional[List[int]] = None
+    ) -> Iterator[Dict[Text, Any]]:
+        """
+        Streams retrieved documents first and then answer tokens,
+        returning a cached answer at once when there is one
+        :param question:
+        :param chat_history:
+        :param model:
+        :param file_ids: files to search in, all files if None
+        :return:
+        """
+
+        standalone_question, context = self.retrieve(question, chat_history, model, file_ids)
+        yield {'context': context}
+
+        cached_answer: Optional[str] = self._lookup_cached_answer(model, standalone_question, context)
+        if cached_answer is not None:
+            yield {'answer': cached_answer}
+            return
+
+        prompt: Any = self._stuff_prompt(model, question, chat_history, context)
+
+        answer_parts: List[str] = []
+        started: float = time.perf_counter()
+        for token in self.get_generation_chain(model).stream(prompt):
+            if not answer_parts:
+                metrics.record('time_to_first_token', time.perf_counter() - started)
+            answer_parts.append(token)
+            yield {'answer': token}
+        elapsed: float = time.perf_counter() - started
+        metrics.record('generation', elapsed)
+        metrics.record_generation(len(answer_parts), elapsed)
+
+        self._store_answer(model, standalone_question, context, ''.join(answer_parts))
+
+    async def aretrieve(
+            self,
+            question: str,
+            chat_history: List[Dict[Text, Text]],
+            model: str = ModelName.LLAMA3.value,
+            file_ids: Optional[List[int]] = None
+    ) -> Tuple[str, List[Document]]:
+        """
+        Async version of retrieve, query embedding and
+        similarity search run in the retriever's executor
+        :param question:
+        :param chat_history:
+        :param model:
+        :param file_ids: files to search in, all files if None
+        :return:
+        """
+
+        with metrics.span('rewrite'):
+            # History is trimmed like in the answer prompt, so that both prompts share their prefix
+            standalone_question: str = await self.question_rewriter.aget_standalone_question(
+                self.get_rewrite_chain(model), model, question, self.context_packer.trim_history(model, chat_history)
+            )
+        with metrics.span('retrieval'):
+            context: List[Document] = await self.retriever.ainvoke(standalone_question, file_ids=file_ids)
+        metrics.observe('rag_retrieved_chunks', len(context), buckets=metrics.COUNT_BUCKETS)
+        return standalone_question, context
+
+    async def aanswer(
+            self,
+            question: str,
+            chat_history: List[Dict[Text, Text]],
+            model: str = ModelName.LLAMA3.value,
+            file_ids: Optional[List[int]] = None
+    ) -> Dict[Text, Any]:
+        """
+        Async version of answer
+        :param question:
+        :param chat_history:
+        :param model:
+        :param file_ids: files to search in, all files if None
+        :return:
+        """
+
+        standalone_question, context = await self.aretrieve(question, chat_history, model, file_ids)
+
+        # Cache lookup embeds the question, so it is kept off the event loop
+        cached_answer: Optional[str] = await run_in_threadpool(
+            self._lookup_cached_answer, model, standalone_question, context
+        )
+        if cached_answer is not None:
+            return {'answer': cached_answer, 'context': context, 'cached': True}
+
+        # Packing and formatting are CPU-only and cheap, so they run on the event loop
+        prompt: Any = self._stuff_prompt(model, question, chat_history, context)
+
+        started: float = time.perf_counter()
+        answer: str = await self.get_generation_chain(model).ainvoke(prompt)
+        elapsed: float = time.perf_counter() - started
+        metrics.record('generation', elapsed)
+        metrics.record_generation(TokenUtils.count_tokens(answer), elapsed)
+
+        await run_in_threadpool(self._store_answer, model, standalone_question, context, answer)
+        return {'answer': answer, 'context': context, 'cached': False}
+
+    async def abatch_answer(
+            self,
+            queries: List[Tuple[str, List[Dict[Text, Text]], str, Optional[List[int]]]],
+            max_concurrency: int = BATCH_CONCURRENCY
+    ) -> AsyncIterator[Tuple[int, Dict[Text, Any]]]:
+        """
+        Answers a batch of (question, chat_history, model, file_ids) and yields (position, result)
+        as every answer is ready. Questions are embedded in one batch and searched with
+        one multi-vector query, generations run with at most max_concurrency in flight
+        for every model. A failed question yields a result with error instead of answer
+        :param queries:
+        :param max_concurrency:
+        :return:
+        """
+
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def rewrite(question: str, chat_history: List[Dict[Text, Text]], model: str) -> str:
+            async with semaphore:
+                return await self.question_rewriter.aget_standalone_question(
+                    self.get_rewrite_chain(model), model, question,
+                    self.context_packer.trim_history(model, chat_history)
+                )
+
+        with metrics.span('rewrite'):
+            rewritten: List[Any] = await asyncio.gather(
+                *(rewrite(question, chat_history, model) for question, chat_history, model, _ in queries),
+                return_exceptions=True
+            )
+        failed: Dict[int, BaseException] = {
+            position: result for position, result in enumerate(rewritten) if isinstance(result, BaseException)
+        }
+        positions: List[int] = [position for position in range(len(queries)) if position not in failed]
+        standalone_questions: List[str] = [rewritten[position] for position in positions]
+
+        with metrics.span('retrieval'):
+            embeddings: List[List[float]] = await run_in_threadpool(
+                self.retriever.vector_store.embeddings.embed_queries, standalone_questions
+            )
+            contexts: Dict[int, List[Document]] = dict(zip(positions, await run_in_threadpool(
+                self.retriever.retrieve_batch, standalone_questions, embeddings,
+                [queries[position][3] for position in positions]
+            )))
+        for context in contexts.values():
+            metrics.observe('rag_retrieved_chunks', len(context), buckets=metrics.COUNT_BUCKETS)
+
+        cached_answers: List[Optional[str]] = await run_in_threadpool(lambda: [
+            self._lookup_cached_answer(queries[position][2], rewritten[position], contexts[position])
+            for position in positions
+        ])
+
+        for position, error in failed.items():
+            yield position, {'error': str(error)}
+
+        pending: Dict[str, List[int]] = {}
+        prompts: Dict[int, Any] = {}
+        for position, cached_answer in zip(positions, cached_answers):
+            question, chat_history, model, _ = queries[position]
+            if cached_answer is not None:
+                yield position, {'answer': cached_answer, 'context': contexts[position], 'cached': True}
+                continue
+            prompts[position] = self._stuff_prompt(model, question, chat_history, contexts[position])
+            pending.setdefault(model, []).append(position)
+
+        results: asyncio.Queue = asyncio.Queue()
+
+        async def generate(model: str, model_positions: List[int]) -> None:
+            reported: Set[int] = set()
+            try:
+                async for number, output in self.get_generation_chain(model).abatch_as_completed(
+                        [prompts[position] for position in model_positions],
+                        config={'max_concurrency': max_concurrency},
+                        return_exceptions=True
+                ):
+                    reported.add(number)
+                    await results.put((model_positions[number], output))
+            except Exception as e:
+                for number, position in enumerate(model_positions):
+                    if number not in reported:
+                        await results.put((position, e))
+
+        tasks: List[asyncio.Task] = [
+            asyncio.create_task(generate(model, model_positions)) for model, model_positions in pending.items()
+        ]
+        try:
+            for _ in range(len(prompts)):
+                position, output = await results.get()
+                if isinstance(output, BaseException):
+                    yield position, {'error': str(output)}
+                    continue
+
+                metrics.add('rag_generated_tokens_total', TokenUtils.count_tokens(output))
+                await run_in_threadpool(
+                    self._store_answer, queries[position][2], rewritten[position], contexts[position], output
+                )
+                yield position, {'answer': output, 'context': contexts[position], 'cached': False}
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def astream_answer(
+            self,
+            question: str,
+            chat_history: List[Dict[Text, Text]],
+            model: str = ModelName.LLAMA3.value,
+            file_ids: Optional[List[int]] = None
+    ) -> AsyncIterator[Dict[Text, Any]]:
+        """
+        Async version of stream_answer
+        :param question:
+        :param chat_history:
+        :param model:
+        :param file_ids: files to search in, all files if None
+        :return:
+        """
+
+        standalone_question, context = await self.aretrieve(question, chat_history, model, file_ids)
+        yield {'context': context}
+
+        cached_answer: Optional[str] = await run_in_threadpool(
+            self._lookup_cached_answer, model, standalone_question, context
+        )
+        if cached_answer is not None:
+            yield {'answer': cached_answer}
+            return
+
+        # Packing and formatting are CPU-only and cheap, so they run on the event loop
+        prompt: Any = self._stuff_prompt(model, question, chat_history, context)
+
+        answer_parts: List[str] = []
+        started: float = time.perf_counter()
+        async for token in self.get_generation_chain(model).astream(prompt):
+            if not answer_parts:
+                metrics.record('time_to_first_token', time.perf_counter() - started)
+            answer_parts.append(token)
+            yield {'answer': token}
+        elapsed: float = time.perf_counter() - started
+        metrics.record('generation', elapsed)
+        metrics.record_generation(len(answer_parts), elapsed)
+
+        await run_in_threadpool(
+            self._store_answer, model, standalone_question, context, ''.join(answer_parts)
+        )
+
+    def summarize_history(self, model: str, summary: str, chat_history: List[Dict[Text, Text]]) -> str:
+        """
+        Extends summary of a conversation with new chat history messages
+        :param model:
+        :param summary:
+        :param chat_history:
+        :return:
+        """
+
+        summarize_chain = summarize_history_prompt | ModelRegistry.get_llm(model) | self.output_parser
+        return summarize_chain.invoke({'summary': summary or 'none', 'chat_history': chat_history})
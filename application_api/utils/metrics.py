@@ -0,0 +1,273 @@
+"""
+This file contains the in-process metrics: latency spans around
+the stages of chat, ingestion and database calls, counters and gauges,
+rendered in the Prometheus text format by the /metrics endpoint.
+Spans can also be collected per request for the timing breakdown in responses
+"""
+
+from application_api.utils.config import Config
+
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, ContextManager, Dict, Iterator, List, MutableMapping, Optional, Text, \
+    Tuple
+import threading
+import time
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+# Timings of the request being handled, set only when its breakdown was asked for
+_request_timings: ContextVar[Optional[Dict[Text, float]]] = ContextVar('request_timings', default=None)
+
+
+class Metrics:
+    """
+    Class, that keeps histograms, counters and gauges of the process
+    """
+
+    # Metrics are on unless RAG_METRICS=0, turned off spans return a shared no-op context
+    ENABLED: bool = Config.METRICS_ENABLED
+
+    LATENCY_BUCKETS: Tuple[float, ...] = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+    )
+    COUNT_BUCKETS: Tuple[float, ...] = (0, 1, 2, 3, 4, 5, 8, 10, 20, 50)
+    RATE_BUCKETS: Tuple[float, ...] = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500)
+    TOKEN_BUCKETS: Tuple[float, ...] = (128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+    DESCRIPTIONS: Dict[str, Tuple[str, str]] = {
+        'rag_stage_duration_seconds': ('histogram', 'Duration of chat, ingestion and database stages'),
+        'rag_http_request_duration_seconds': ('histogram', 'Duration of HTTP requests until the response is sent'),
+        'rag_retrieved_chunks': ('histogram', 'Number of chunks retrieved for a question'),
+        'rag_prompt_tokens': ('histogram', 'Estimated tokens of question-answering prompts'),
+        'rag_generation_tokens_per_second': ('histogram', 'Generation speed of answers'),
+        'rag_generated_tokens_total': ('counter', 'Number of generated answer tokens'),
+        'rag_requests_in_flight': ('gauge', 'Number of HTTP requests being handled'),
+        'rag_upload_size_bytes': ('histogram', 'Size of spooled uploads'),
+        'rag_upload_rejections_total': ('counter', 'Number of uploads rejected before being stored'),
+        'rag_cache_hits_total': ('counter', 'Number of cache hits'),
+        'rag_cache_misses_total': ('counter', 'Number of cache misses'),
+        'rag_cache_hit_ratio': ('gauge', 'Share of cache lookups, that were hits')
+    }
+
+    _NOOP: ContextManager = nullcontext()
+
+    def __init__(self, enabled: bool = ENABLED) -> None:
+        self.enabled: bool = enabled
+        self._lock: threading.Lock = threading.Lock()
+        # (name, labels) -> [bucket counts..., sum, count]
+        self._histograms: Dict[Tuple[str, LabelSet], List[float]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._values: Dict[Tuple[str, LabelSet], float] = {}
+
+    @staticmethod
+    def _labels(labels: Optional[Dict[str, Any]]) -> LabelSet:
+        return tuple(sorted((key, str(value)) for key, value in (labels or {}).items()))
+
+    def observe(
+            self,
+            name: str,
+            value: float,
+            labels: Optional[Dict[str, Any]] = None,
+            buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ) -> None:
+        """
+        Records value in a histogram
+        :param name:
+        :param value:
+        :param labels:
+        :param buckets:
+        :return:
+        """
+
+        if not self.enabled:
+            return
+
+        key: Tuple[str, LabelSet] = (name, self._labels(labels))
+        with self._lock:
+            histogram: Optional[List[float]] = self._histograms.get(key)
+            if histogram is None:
+                self._buckets.setdefault(name, buckets)
+                histogram = self._histograms[key] = [0.0] * (len(self._buckets[name]) + 2)
+            for number, bound in enumerate(self._buckets[name]):
+                if value <= bound:
+                    histogram[number] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def add(self, name: str, amount: float = 1.0, labels: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Adds amount to a counter or gauge, negative amounts decrease gauges
+        :param name:
+        :param amount:
+        :param labels:
+        :return:
+        """
+
+        if not self.enabled:
+            return
+
+        key: Tuple[str, LabelSet] = (name, self._labels(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def span(self, stage: str) -> ContextManager:
+        """
+        Returns context, that times a stage into the stage histogram
+        and into the timing breakdown of the current request
+        :param stage:
+        :return:
+        """
+
+        if not self.enabled and _request_timings.get() is None:
+            return self._NOOP
+        return self._timed(stage)
+
+    @contextmanager
+    def _timed(self, stage: str) -> Iterator[None]:
+        started: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def record(self, stage: str, seconds: float) -> None:
+        """
+        Records duration of a stage measured elsewhere
+        :param stage:
+        :param seconds:
+        :return:
+        """
+
+        self.observe('rag_stage_duration_seconds', seconds, {'stage': stage})
+        timings: Optional[Dict[Text, float]] = _request_timings.get()
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + seconds, 6)
+
+    def record_generation(self, tokens: int, seconds: float) -> None:
+        """
+        Records number of generated tokens and generation speed
+        :param tokens:
+        :param seconds:
+        :return:
+        """
+
+        if not self.enabled or not tokens:
+            return
+        self.add('rag_generated_tokens_total', tokens)
+        if seconds > 0:
+            self.observe('rag_generation_tokens_per_second', tokens / seconds, buckets=self.RATE_BUCKETS)
+
+    @contextmanager
+    def collect_timings(self, timings: Optional[Dict[Text, float]]) -> Iterator[Optional[Dict[Text, float]]]:
+        """
+        Collects durations of the stages run inside the context into timings
+        :param timings: dict to collect into, None to not collect
+        :return:
+        """
+
+        token: Any = _request_timings.set(timings)
+        try:
+            yield timings
+        finally:
+            _request_timings.reset(token)
+
+    @staticmethod
+    def _format_labels(labels: LabelSet, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs: LabelSet = labels + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+    def render(self, cache_counts: Optional[Dict[str, Tuple[int, int]]] = None) -> str:
+        """
+        Renders all metrics in the Prometheus text exposition format
+        :param cache_counts: (hits, misses) by cache name
+        :return:
+        """
+
+        values: Dict[Tuple[str, LabelSet], float] = {}
+        with self._lock:
+            histograms: Dict[Tuple[str, LabelSet], List[float]] = {
+                key: list(histogram) for key, histogram in self._histograms.items()
+            }
+            values.update(self._values)
+
+        for cache, (hits, misses) in (cache_counts or {}).items():
+            labels: LabelSet = (('cache', cache),)
+            values[('rag_cache_hits_total', labels)] = hits
+            values[('rag_cache_misses_total', labels)] = misses
+            if hits + misses:
+                values[('rag_cache_hit_ratio', labels)] = hits / (hits + misses)
+
+        lines: List[str] = []
+        names: List[str] = sorted({name for name, _ in histograms} | {name for name, _ in values})
+        for name in names:
+            kind, description = self.DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(self._buckets[name], histogram):
+                    lines.append(f'{name}_bucket{self._format_labels(labels, (("le", str(bound)),))} {int(count)}')
+                lines.append(f'{name}_bucket{self._format_labels(labels, (("le", "+Inf"),))} {int(histogram[-1])}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {histogram[-2]}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {int(histogram[-1])}')
+
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{self._format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics: Metrics = Metrics()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware, that counts requests in flight and records their duration
+    by route until the last body chunk is sent, streamed responses included
+    """
+
+    def __init__(self, app: Callable[..., Awaitable[None]]) -> None:
+        self.app: Callable[..., Awaitable[None]] = app
+
+    async def __call__(
+            self,
+            scope: MutableMapping[str, Any],
+            receive: Callable[[], Awaitable[Any]],
+            send: Callable[[Any], Awaitable[None]]
+    ) -> None:
+        if scope['type'] != 'http' or not metrics.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        started: float = time.perf_counter()
+        finished: bool = False
+        metrics.add('rag_requests_in_flight', 1)
+
+        def finish() -> None:
+            nonlocal finished
+            finished = True
+            metrics.add('rag_requests_in_flight', -1)
+            # Route template instead of the path keeps labels like /jobs/{job_id} bounded
+            route: Any = scope.get('route')
+            metrics.observe(
+                'rag_http_request_duration_seconds', time.perf_counter() - started,
+                {'route': getattr(route, 'path', 'unmatched')}
+            )
+
+        async def send_and_record(message: Any) -> None:
+            await send(message)
+            # Background tasks run after the last chunk and are not counted as part of the request
+            if message['type'] == 'http.response.body' and not message.get('more_body', False) and not finished:
+                finish()
+
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            if not finished:
+                finish()
@@ -0,0 +1,164 @@
+"""
+This file contains the process-wide registry of heavy
+objects (embedding model, vector store, language models),
+so that each of them is created only once and lazily
+"""
+
+from application_api.utils.config import Config
+from application_api.utils.embedding_cache import CachedEmbeddings
+from application_api.utils.remote_embeddings import RemoteEmbeddings
+from application_api.utils.bm25_index import BM25Index
+from application_api.utils.context_packer import ContextPacker
+from application_api.utils.prompt_eval_callback import PromptEvalCallback
+from application_api.utils.quantized_vector_store import QuantizedVectorStore
+
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_ollama import ChatOllama
+from typing import Any, Dict, Optional
+import chromadb
+import threading
+
+
+class ModelRegistry:
+    """
+    Class, that lazily creates and shares models across the process
+    """
+
+    EMBEDDING_MODEL_NAME: str = Config.EMBEDDING_MODEL_NAME
+    CHROMA_DIRECTORY: str = Config.CHROMA_DIRECTORY
+    BM25_INDEX_PATH: str = Config.BM25_INDEX_PATH
+    CROSS_ENCODER_MODEL_NAME: str = Config.CROSS_ENCODER_MODEL_NAME
+
+    _lock: threading.Lock = threading.Lock()
+    _embedding_function: Optional[Embeddings] = None
+    _local_embedding_function: Optional[CachedEmbeddings] = None
+    _vector_store: Optional[VectorStore] = None
+    _bm25_index: Optional[BM25Index] = None
+    _cross_encoder: Optional[Any] = None
+    _llms: Dict[str, ChatOllama] = {}
+
+    @classmethod
+    def get_local_embedding_function(cls) -> CachedEmbeddings:
+        """
+        Returns embedding model of this process behind the embedding cache,
+        loading it on first use
+        :return:
+        """
+
+        if cls._local_embedding_function is None:
+            with cls._lock:
+                if cls._local_embedding_function is None:
+                    cls._local_embedding_function = CachedEmbeddings(
+                        HuggingFaceEmbeddings(model_name=cls.EMBEDDING_MODEL_NAME),
+                        model_name=cls.EMBEDDING_MODEL_NAME
+                    )
+        return cls._local_embedding_function
+
+    @classmethod
+    def get_embedding_function(cls) -> Embeddings:
+        """
+        Returns shared embeddings: client of the embedding service if
+        RAG_EMBEDDING_SERVICE_URL is set, embedding model of this process otherwise
+        :return:
+        """
+
+        if cls._embedding_function is None:
+            if Config.EMBEDDING_SERVICE_URL:
+                with cls._lock:
+                    if cls._embedding_function is None:
+                        cls._embedding_function = RemoteEmbeddings(Config.EMBEDDING_SERVICE_URL)
+            else:
+                local_embedding_function: CachedEmbeddings = cls.get_local_embedding_function()
+                with cls._lock:
+                    if cls._embedding_function is None:
+                        cls._embedding_function = local_embedding_function
+        return cls._embedding_function
+
+    @classmethod
+    def get_vector_store(cls) -> VectorStore:
+        """
+        Returns shared vector store, opening it on first use: the quantized store
+        if RAG_VECTOR_STORE=quantized, Chroma otherwise. Chroma is reached through
+        the Chroma server if RAG_CHROMA_HOST is set, several processes may only
+        write to the same collection through a server. Workers sharing the quantized
+        store read the chunks the writer adds once per poll interval
+        :return:
+        """
+
+        if cls._vector_store is None:
+            if Config.VECTOR_STORE == 'quantized' and Config.CHROMA_HOST:
+                raise ValueError('RAG_CHROMA_HOST is set, but RAG_VECTOR_STORE=quantized keeps chunks in '
+                                 'RAG_QUANTIZED_DIRECTORY: unset one of them')
+            embedding_function: Embeddings = cls.get_embedding_function()
+            with cls._lock:
+                if cls._vector_store is None and Config.VECTOR_STORE == 'quantized':
+                    cls._vector_store = QuantizedVectorStore(
+                        Config.QUANTIZED_DIRECTORY, embedding_function, rescore=Config.QUANTIZED_RESCORE,
+                        reload_interval=Config.POLL_INTERVAL_SECONDS
+                    )
+                elif cls._vector_store is None and Config.CHROMA_HOST:
+                    cls._vector_store = Chroma(
+                        client=chromadb.HttpClient(host=Config.CHROMA_HOST, port=Config.CHROMA_PORT),
+                        embedding_function=embedding_function
+                    )
+                elif cls._vector_store is None:
+                    cls._vector_store = Chroma(
+                        persist_directory=cls.CHROMA_DIRECTORY,
+                        embedding_function=embedding_function
+                    )
+        return cls._vector_store
+
+    @classmethod
+    def get_bm25_index(cls) -> BM25Index:
+        """
+        Returns shared lexical index of the chunks, loading it on first use
+        :return:
+        """
+
+        if cls._bm25_index is None:
+            with cls._lock:
+                if cls._bm25_index is None:
+                    bm25_index: BM25Index = BM25Index(cls.BM25_INDEX_PATH, reload_interval=Config.POLL_INTERVAL_SECONDS)
+                    bm25_index.load()
+                    cls._bm25_index = bm25_index
+        return cls._bm25_index
+
+    @classmethod
+    def get_cross_encoder(cls) -> Any:
+        """
+        Returns shared cross-encoder used for reranking, loading it on first use
+        :return:
+        """
+
+        if cls._cross_encoder is None:
+            with cls._lock:
+                if cls._cross_encoder is None:
+                    # Imported here, so that the model library is loaded only when reranking is on
+                    from sentence_transformers import CrossEncoder
+                    cls._cross_encoder = CrossEncoder(cls.CROSS_ENCODER_MODEL_NAME, device='cpu')
+        return cls._cross_encoder
+
+    @classmethod
+    def get_llm(cls, model: str) -> ChatOllama:
+        """
+        Returns shared chat model client for the given model name. Ollama runs the model
+        with the context window the context packer budgets for and keeps it loaded
+        for OLLAMA_KEEP_ALIVE, so that prompts sharing a prefix with the previous one
+        are evaluated only from where they differ
+        :param model:
+        :return:
+        """
+
+        if model not in cls._llms:
+            with cls._lock:
+                if model not in cls._llms:
+                    cls._llms[model] = ChatOllama(
+                        model=model,
+                        keep_alive=Config.OLLAMA_KEEP_ALIVE,
+                        num_ctx=ContextPacker.CONTEXT_WINDOWS.get(model, ContextPacker.DEFAULT_CONTEXT_WINDOW),
+                        callbacks=[PromptEvalCallback()]
+                    )
+        return cls._llms[model]
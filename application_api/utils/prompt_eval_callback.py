@@ -0,0 +1,37 @@
+"""
+This file contains the callback, that records how long Ollama spent
+evaluating prompts. Ollama evaluates only the part of a prompt after
+the prefix it still holds in its prompt cache, so prompt evaluation
+time shows how much of the previous prompt was reused
+"""
+
+from application_api.utils.metrics import metrics
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from typing import Any, Dict, Optional, Text
+
+
+class PromptEvalCallback(BaseCallbackHandler):
+    """
+    Class, that records prompt tokens evaluated by Ollama and the time it took
+    """
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        """
+        Reads prompt evaluation statistics, that Ollama returns with the last chunk of an answer
+        :param response:
+        :param kwargs:
+        :return:
+        """
+
+        for generations in response.generations:
+            for generation in generations:
+                generation_info: Optional[Dict[Text, Any]] = generation.generation_info
+                if not generation_info or generation_info.get('prompt_eval_count') is None:
+                    continue
+                metrics.observe(
+                    'rag_prompt_eval_tokens', generation_info['prompt_eval_count'], buckets=metrics.TOKEN_BUCKETS
+                )
+                # Durations are reported in nanoseconds
+                metrics.record('prompt_eval', generation_info.get('prompt_eval_duration', 0) / 1e9)
@@ -0,0 +1,679 @@
+"""
+This file contains the quantized vector store, an alternative to Chroma
+for large corpora. Embeddings are kept as int8 codes with a scale per vector
+in memory-mapped files, so that the store opens without loading them and
+takes a quarter of the memory of float32 vectors. Search scans the codes
+with NumPy, the best candidates are optionally scored again with float32
+vectors, that are read from disk row by row. Chunk texts and metadata are kept in SQLite
+"""
+
+from application_api.utils.config import Config
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from typing import Any, Callable, Dict, IO, Iterable, List, Optional, Text, Tuple
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+class QuantizedCollection:
+    """
+    Class, that stores chunks with their quantized embeddings. Offers the part of
+    the Chroma collection API the backend uses (upsert, update, get, query, delete, count).
+    Where clauses may only select chunks by file_id. Distances are squared L2, like in Chroma
+    """
+
+    # Rows of codes converted to float32 at once while scanning, 6 MB for 384 dimensions
+    SCAN_BLOCK_ROWS: int = 4096
+    # Candidates scored again with float32 vectors for every requested result
+    RESCORE_FACTOR: int = 4
+    # Smallest number of rows the vector files are allocated for, and how much they grow when full
+    MIN_CAPACITY: int = 1024
+    GROWTH_FACTOR: float = 1.5
+    # Largest number of parameters bound to a single SQLite statement
+    SQL_BATCH_SIZE: int = 500
+
+    def __init__(self, directory: str, rescore: bool = True, reload_interval: Optional[float] = None) -> None:
+        """
+        :param directory:
+        :param rescore: score candidates again with float32 vectors, which are then also written to disk.
+        Stores created without float32 vectors are searched by their codes only
+        :param reload_interval: seconds between checks, whether another process wrote to the store
+        and its slots have to be read again before searching, None to check only before writing
+        """
+
+        os.makedirs(directory, exist_ok=True)
+        self.directory: str = directory
+        self.reload_interval: Optional[float] = reload_interval
+        self._checked_at: float = 0.0
+        self._lock: threading.RLock = threading.RLock()
+        self._connection: sqlite3.Connection = sqlite3.connect(
+            os.path.join(directory, 'chunks.db'), check_same_thread=False
+        )
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS chunks
+                                    (slot INTEGER PRIMARY KEY,
+                                     chunk_id TEXT UNIQUE NOT NULL,
+                                     file_id INTEGER,
+                                     document TEXT,
+                                     metadata TEXT)''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS idx_chunks_file_id ON chunks (file_id)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+        self._connection.commit()
+
+        self._requested_rescore: bool = rescore
+        self.dimension: Optional[int] = None
+        self.float_vectors: bool = rescore
+        self.rescore: bool = rescore
+
+        self._capacity: int = 0
+        self._codes: Optional[np.memmap] = None
+        # Scale of every vector's codes and squared norm of the vector
+        self._scales: Optional[np.memmap] = None
+        # Float32 vectors are read and written with file calls instead of being mapped, so that the few
+        # rows read for rescoring do not map their neighbours into the memory of the process
+        self._vectors: Optional[IO] = None
+        self._vectors_lock: threading.Lock = threading.Lock()
+        self._slot_count: int = 0
+        self._file_ids: np.ndarray = np.zeros(0, dtype=np.int64)
+        self._live: np.ndarray = np.zeros(0, dtype=bool)
+        self._free_slots: List[int] = []
+        # Changes, when another connection commits to the database
+        self._data_version: int = self._get_data_version()
+        self._load()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _get_data_version(self) -> int:
+        return self._connection.execute('PRAGMA data_version').fetchone()[0]
+
+    def _load(self) -> None:
+        """
+        Reads settings, slots and file ids of the chunks and maps the vector files, must be called with lock held.
+        Vectors stay on disk until they are searched
+        :return:
+        """
+
+        settings: Dict[str, str] = dict(self._connection.execute('SELECT key, value FROM settings').fetchall())
+        self.dimension = int(settings['dimension']) if 'dimension' in settings else None
+        # Float32 vectors are written only by stores created with rescoring
+        self.float_vectors = settings.get('float_vectors', '1' if self._requested_rescore else '0') == '1'
+        self.rescore = self._requested_rescore and self.float_vectors
+        if self.dimension is not None:
+            self._map_files(max(self._capacity, os.path.getsize(self._path('codes.i8')) // self.dimension))
+
+        rows: np.ndarray = np.array(
+            self._connection.execute('SELECT slot, file_id FROM chunks').fetchall(), dtype=np.int64
+        ).reshape(-1, 2)
+        self._slot_count = int(rows[:, 0].max()) + 1 if len(rows) else 0
+        # Arrays are replaced rather than changed, searches running meanwhile keep the ones they took
+        file_ids: np.ndarray = np.zeros(max(self._capacity, self._slot_count), dtype=np.int64)
+        live: np.ndarray = np.zeros(len(file_ids), dtype=bool)
+        file_ids[rows[:, 0]] = rows[:, 1]
+        live[rows[:, 0]] = True
+        self._file_ids, self._live = file_ids, live
+        self._free_slots = np.flatnonzero(~live[:self._slot_count]).tolist()
+
+    def reload_if_changed(self, force: bool = False) -> bool:
+        """
+        Reads slots of the chunks again if another process wrote to the store since this process
+        last read or wrote them. Several workers share the store this way: one of them writes,
+        the others see its chunks after at most one reload interval.
+        Checks are made at most once per reload interval, unless forced
+        :param force: check regardless of the interval, done before every write
+        :return: whether the slots were read again
+        """
+
+        now: float = time.monotonic()
+        if not force and (self.reload_interval is None or now - self._checked_at < self.reload_interval):
+            return False
+        with self._lock:
+            self._checked_at = now
+            data_version: int = self._get_data_version()
+            if data_version == self._data_version:
+                return False
+            self._data_version = data_version
+            self._load()
+        return True
+
+    def _map_file(self, name: str, dtype: Any, columns: int, capacity: int) -> np.memmap:
+        """
+        Maps file with capacity rows of the given width, growing the file if it is smaller
+        :param name:
+        :param dtype:
+        :param columns:
+        :param capacity:
+        :return:
+        """
+
+        path: str = self._path(name)
+        size: int = capacity * columns * np.dtype(dtype).itemsize
+        with open(path, 'ab'):
+            pass
+        if os.path.getsize(path) < size:
+            os.truncate(path, size)
+        return np.memmap(path, dtype=dtype, mode='r+', shape=(capacity, columns))
+
+    def _map_files(self, capacity: int) -> None:
+        """
+        Maps vector files with room for capacity rows, must be called with lock held.
+        Arrays mapped before stay valid, so that searches running meanwhile are not affected
+        :param capacity:
+        :return:
+        """
+
+        self._codes = self._map_file('codes.i8', np.int8, self.dimension, capacity)
+        self._scales = self._map_file('scales.f32', np.float32, 2, capacity)
+        if self.float_vectors:
+            with self._vectors_lock:
+                if self._vectors is None:
+                    with open(self._path('vectors.f32'), 'ab'):
+                        pass
+                    self._vectors = open(self._path('vectors.f32'), 'r+b')
+                if os.fstat(self._vectors.fileno()).st_size < capacity * self.dimension * 4:
+                    self._vectors.truncate(capacity * self.dimension * 4)
+        self._capacity = capacity
+
+    def _reserve(self, rows: int) -> None:
+        """
+        Grows vector files and slot arrays to hold at least the given number of rows
+        :param rows:
+        :return:
+        """
+
+        if rows > self._capacity:
+            self._map_files(max(rows, self.MIN_CAPACITY, int(self._capacity * self.GROWTH_FACTOR)))
+        if rows > len(self._live):
+            self._file_ids = np.concatenate([self._file_ids, np.zeros(self._capacity - len(self._file_ids), np.int64)])
+            self._live = np.concatenate([self._live, np.zeros(self._capacity - len(self._live), dtype=bool)])
+
+    def _set_dimension(self, dimension: int) -> None:
+        """
+        Fixes dimension of the store on the first write and checks it on the following ones
+        :param dimension:
+        :return:
+        """
+
+        if self.dimension is None:
+            self.dimension = dimension
+            self._connection.executemany('INSERT INTO settings (key, value) VALUES (?, ?)', [
+                ('dimension', str(dimension)), ('float_vectors', '1' if self.float_vectors else '0')
+            ])
+        elif dimension != self.dimension:
+            raise ValueError(f'Embedding dimension {dimension} does not match dimension {self.dimension} of the store')
+
+    @staticmethod
+    def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Quantizes every vector to int8 codes with its own scale
+        :param vectors:
+        :return: codes and scales
+        """
+
+        scales: np.ndarray = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes: np.ndarray = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    def _write_vectors(self, slots: List[int], vectors: np.ndarray) -> None:
+        """
+        Writes vectors to their slots and flushes them, must be called with lock held
+        :param slots:
+        :param vectors:
+        :return:
+        """
+
+        codes, scales = self.quantize(vectors)
+        self._codes[slots] = codes
+        self._scales[slots] = np.stack([scales, (vectors * vectors).sum(axis=1)], axis=1)
+        self._codes.flush()
+        self._scales.flush()
+        if self._vectors is None:
+            return
+        with self._vectors_lock:
+            # Chunks of a batch usually take consecutive slots and are written at once
+            if slots == list(range(slots[0], slots[0] + len(slots))):
+                self._vectors.seek(slots[0] * self.dimension * 4)
+                self._vectors.write(vectors.tobytes())
+            else:
+                for slot, vector in zip(slots, vectors):
+                    self._vectors.seek(slot * self.dimension * 4)
+                    self._vectors.write(vector.tobytes())
+            self._vectors.flush()
+
+    def _read_vectors(self, slots: Iterable[int]) -> np.ndarray:
+        """
+        Reads float32 vectors of given slots
+        :param slots:
+        :return:
+        """
+
+        row_bytes: int = self.dimension * 4
+        with self._vectors_lock:
+            rows: List[bytes] = []
+            for slot in slots:
+                self._vectors.seek(int(slot) * row_bytes)
+                rows.append(self._vectors.read(row_bytes))
+        return np.frombuffer(b''.join(rows), dtype=np.float32).reshape(-1, self.dimension)
+
+    def _select(self, columns: str, condition: str, values: List[Any]) -> List[Tuple[Any, ...]]:
+        """
+        Selects rows of chunks, where condition with a placeholder for a list holds for the values,
+        binding the values in batches
+        :param columns:
+        :param condition:
+        :param values:
+        :return:
+        """
+
+        rows: List[Tuple[Any, ...]] = []
+        for start in range(0, len(values), self.SQL_BATCH_SIZE):
+            batch: List[Any] = values[start:start + self.SQL_BATCH_SIZE]
+            rows.extend(self._connection.execute(
+                f'SELECT {columns} FROM chunks WHERE {condition.format(", ".join("?" * len(batch)))}', batch
+            ).fetchall())
+        return rows
+
+    @staticmethod
+    def get_file_ids(where: Optional[Dict[str, Any]]) -> Optional[List[int]]:
+        """
+        Returns file ids a Chroma where clause selects, None if it selects all chunks
+        :param where:
+        :return:
+        """
+
+        if not where:
+            return None
+        if list(where) != ['file_id']:
+            raise ValueError(f'Unsupported where clause: {where}')
+        condition: Any = where['file_id']
+        if isinstance(condition, dict):
+            if list(condition) != ['$in']:
+                raise ValueError(f'Unsupported where clause: {where}')
+            return list(condition['$in'])
+        return [condition]
+
+    def count(self) -> int:
+        """
+        Returns number of stored chunks
+        :return:
+        """
+
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM chunks').fetchone()[0]
+
+    def upsert(
+            self,
+            ids: List[str],
+            embeddings: List[List[float]],
+            metadatas: Optional[List[Dict[str, Any]]] = None,
+            documents: Optional[List[str]] = None
+    ) -> None:
+        """
+        Adds chunks, chunks with existing ids are replaced in place
+        :param ids:
+        :param embeddings:
+        :param metadatas:
+        :param documents:
+        :return:
+        """
+
+        if not ids:
+            return
+        vectors: np.ndarray = np.asarray(embeddings, dtype=np.float32)
+        metadatas = metadatas or [{} for _ in ids]
+        documents = documents or ['' for _ in ids]
+
+        with self._lock:
+            # Slots taken by another process, that wrote before, must not be handed out again
+            self.reload_if_changed(force=True)
+            self._set_dimension(vectors.shape[1])
+            existing: Dict[str, int] = {
+                chunk_id: slot for slot, chunk_id in self._select('slot, chunk_id', 'chunk_id IN ({})', list(ids))
+            }
+            slots: List[int] = []
+            for chunk_id in ids:
+                if chunk_id in existing:
+                    slots.append(existing[chunk_id])
+                elif self._free_slots:
+                    slots.append(self._free_slots.pop())
+                else:
+                    slots.append(self._slot_count)
+                    self._slot_count += 1
+            self._reserve(self._slot_count)
+
+            # Vectors are written first, so that every recorded chunk has its vector after a crash
+            self._write_vectors(slots, vectors)
+            file_ids: List[Optional[int]] = [metadata.get('file_id') for metadata in metadatas]
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO chunks (slot, chunk_id, file_id, document, metadata) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (slot, chunk_id, file_id, document, json.dumps(metadata))
+                    for slot, chunk_id, file_id, document, metadata in zip(slots, ids, file_ids, documents, metadatas)
+                ]
+            )
+            self._connection.commit()
+            self._file_ids[slots] = [-1 if file_id is None else file_id for file_id in file_ids]
+            self._live[slots] = True
+
+    def update(self, ids: List[str], embeddings: List[List[float]]) -> None:
+        """
+        Replaces embeddings of existing chunks, unknown ids are skipped
+        :param ids:
+        :param embeddings:
+        :return:
+        """
+
+        vectors: Dict[str, List[float]] = dict(zip(ids, embeddings))
+        with self._lock:
+            self.reload_if_changed(force=True)
+            rows: List[Tuple[Any, ...]] = self._select('slot, chunk_id', 'chunk_id IN ({})', list(ids))
+            if rows:
+                self._write_vectors(
+                    [slot for slot, _ in rows],
+                    np.asarray([vectors[chunk_id] for _, chunk_id in rows], dtype=np.float32)
+                )
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Deletes chunks with given ids or of the files the where clause selects,
+        their slots are reused by the following chunks
+        :param ids:
+        :param where:
+        :return:
+        """
+
+        file_ids: Optional[List[int]] = self.get_file_ids(where)
+        with self._lock:
+            self.reload_if_changed(force=True)
+            if ids is not None:
+                slots: List[int] = [slot for slot, in self._select('slot', 'chunk_id IN ({})', list(ids))]
+            elif file_ids is not None:
+                slots = [slot for slot, in self._select('slot', 'file_id IN ({})', file_ids)]
+            else:
+                raise ValueError('Either ids or where clause has to be given')
+
+            self._live[slots] = False
+            for start in range(0, len(slots), self.SQL_BATCH_SIZE):
+                batch: List[int] = slots[start:start + self.SQL_BATCH_SIZE]
+                self._connection.execute(f'DELETE FROM chunks WHERE slot IN ({", ".join("?" * len(batch))})', batch)
+            self._connection.commit()
+            self._free_slots.extend(slots)
+
+    def _read_rows(self, slots: List[int]) -> Dict[int, Tuple[str, str, Dict[str, Any]]]:
+        """
+        Reads (chunk_id, document, metadata) of chunks in given slots, deleted chunks are left out
+        :param slots:
+        :return:
+        """
+
+        with self._lock:
+            rows: List[Tuple[Any, ...]] = self._select(
+                'slot, chunk_id, document, metadata', 'slot IN ({})', list(slots)
+            )
+        return {slot: (chunk_id, document, json.loads(metadata)) for slot, chunk_id, document, metadata in rows}
+
+    def get(
+            self,
+            ids: Optional[List[str]] = None,
+            where: Optional[Dict[str, Any]] = None,
+            limit: Optional[int] = None,
+            offset: Optional[int] = None,
+            include: Iterable[str] = ('documents', 'metadatas')
+    ) -> Dict[Text, Any]:
+        """
+        Returns chunks with given ids or of the selected files, page by page in the order of their slots
+        :param ids:
+        :param where:
+        :param limit:
+        :param offset:
+        :param include: 'documents', 'metadatas' and 'embeddings'
+        :return:
+        """
+
+        file_ids: Optional[List[int]] = self.get_file_ids(where)
+        self.reload_if_changed()
+        with self._lock:
+            if ids is not None:
+                rows: List[Tuple[Any, ...]] = self._select(
+                    'slot, chunk_id, document, metadata', 'chunk_id IN ({})', list(ids)
+                )
+            else:
+                condition: str = '' if file_ids is None else f'WHERE file_id IN ({", ".join("?" * len(file_ids))})'
+                rows = self._connection.execute(
+                    f'SELECT slot, chunk_id, document, metadata FROM chunks {condition} '
+                    'ORDER BY slot LIMIT ? OFFSET ?',
+                    [*(file_ids or []), -1 if limit is None else limit, offset or 0]
+                ).fetchall()
+            embeddings: Optional[np.ndarray] = None
+            if 'embeddings' in include and rows:
+                slots: List[int] = [row[0] for row in rows]
+                embeddings = self._read_vectors(slots) if self._vectors is not None else (
+                    self._codes[slots].astype(np.float32) * self._scales[slots, :1]
+                )
+
+        return {
+            'ids': [row[1] for row in rows],
+            'documents': [row[2] for row in rows] if 'documents' in include else None,
+            'metadatas': [json.loads(row[3]) for row in rows] if 'metadatas' in include else None,
+            'embeddings': embeddings.tolist() if embeddings is not None else ([] if 'embeddings' in include else None)
+        }
+
+    def search(
+            self,
+            query_embeddings: List[List[float]],
+            k: int,
+            file_ids: Optional[List[int]] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """
+        Finds k nearest chunks for every query: codes of the chunks are scanned block by block,
+        keeping the best candidates, that are scored again with float32 vectors if rescoring is on
+        :param query_embeddings:
+        :param k:
+        :param file_ids: search only chunks of these files, all chunks if None
+        :return: (slot, squared distance) of the nearest chunks of every query, nearest first
+        """
+
+        queries: np.ndarray = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        self.reload_if_changed()
+        # Arrays are taken under the lock and scanned without it, writes only add rows or replace whole rows
+        with self._lock:
+            if self.dimension is None or not len(queries):
+                return [[] for _ in queries]
+            codes, scales = self._codes, self._scales
+            live: np.ndarray = self._live[:self._slot_count].copy()
+            if file_ids is not None:
+                live &= np.isin(self._file_ids[:self._slot_count], file_ids)
+        slots: np.ndarray = np.flatnonzero(live)
+        candidate_count: int = min(len(slots), k * self.RESCORE_FACTOR if self.rescore else k)
+        if not candidate_count:
+            return [[] for _ in queries]
+
+        query_norms: np.ndarray = (queries * queries).sum(axis=1)
+        best_slots: np.ndarray = np.zeros((len(queries), 0), dtype=np.int64)
+        best_distances: np.ndarray = np.zeros((len(queries), 0), dtype=np.float32)
+        for start in range(0, len(slots), self.SCAN_BLOCK_ROWS):
+            block: np.ndarray = slots[start:start + self.SCAN_BLOCK_ROWS]
+            # Contiguous blocks are read as slices, which is much faster than gathering rows
+            rows: Any = slice(block[0], block[-1] + 1) if block[-1] - block[0] + 1 == len(block) else block
+            block_scales: np.ndarray = scales[rows]
+            products: np.ndarray = queries @ codes[rows].astype(np.float32).T
+            distances: np.ndarray = (
+                block_scales[:, 1][None, :] - 2 * block_scales[:, 0][None, :] * products + query_norms[:, None]
+            )
+            best_slots = np.concatenate([best_slots, np.broadcast_to(block, distances.shape)], axis=1)
+            best_distances = np.concatenate([best_distances, distances], axis=1)
+            if best_distances.shape[1] > candidate_count:
+                kept: np.ndarray = np.argpartition(best_distances, candidate_count - 1, axis=1)[:, :candidate_count]
+                best_slots = np.take_along_axis(best_slots, kept, axis=1)
+                best_distances = np.take_along_axis(best_distances, kept, axis=1)
+
+        results: List[List[Tuple[int, float]]] = []
+        for query, candidates, distances in zip(queries, best_slots, best_distances):
+            if self.rescore:
+                # Sorted slots are read from the file in order
+                candidates = np.sort(candidates)
+                differences: np.ndarray = self._read_vectors(candidates) - query
+                distances = (differences * differences).sum(axis=1)
+            order: np.ndarray = np.argsort(distances)[:k]
+            results.append([(int(candidates[number]), float(max(0.0, distances[number]))) for number in order])
+        return results
+
+    def query(
+            self,
+            query_embeddings: List[List[float]],
+            n_results: int = 10,
+            where: Optional[Dict[str, Any]] = None,
+            include: Iterable[str] = ('documents', 'metadatas', 'distances')
+    ) -> Dict[Text, Any]:
+        """
+        Returns n_results nearest chunks for every query embedding
+        :param query_embeddings:
+        :param n_results:
+        :param where:
+        :param include: 'documents', 'metadatas' and 'distances'
+        :return:
+        """
+
+        found: List[List[Tuple[int, float]]] = self.search(query_embeddings, n_results, self.get_file_ids(where))
+        rows: Dict[int, Tuple[str, str, Dict[str, Any]]] = self._read_rows(
+            list({slot for matches in found for slot, _ in matches})
+        )
+        # Chunks deleted since the search are left out
+        found = [[(slot, distance) for slot, distance in matches if slot in rows] for matches in found]
+        return {
+            'ids': [[rows[slot][0] for slot, _ in matches] for matches in found],
+            'documents': [[rows[slot][1] for slot, _ in matches] for matches in found]
+            if 'documents' in include else None,
+            'metadatas': [[rows[slot][2] for slot, _ in matches] for matches in found]
+            if 'metadatas' in include else None,
+            'distances': [[distance for _, distance in matches] for matches in found]
+            if 'distances' in include else None
+        }
+
+
+class QuantizedVectorStore(VectorStore):
+    """
+    LangChain vector store over a QuantizedCollection, used in place of Chroma
+    when RAG_VECTOR_STORE=quantized
+    """
+
+    def __init__(
+            self,
+            directory: str = Config.QUANTIZED_DIRECTORY,
+            embedding_function: Optional[Embeddings] = None,
+            rescore: bool = Config.QUANTIZED_RESCORE,
+            reload_interval: Optional[float] = None
+    ) -> None:
+        self._collection: QuantizedCollection = QuantizedCollection(directory, rescore, reload_interval)
+        self._embedding_function: Optional[Embeddings] = embedding_function
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding_function
+
+    def add_texts(
+            self,
+            texts: Iterable[str],
+            metadatas: Optional[List[Dict[str, Any]]] = None,
+            ids: Optional[List[str]] = None,
+            **kwargs: Any
+    ) -> List[str]:
+        """
+        Embeds texts and adds them to the store
+        :param texts:
+        :param metadatas:
+        :param ids:
+        :param kwargs:
+        :return: ids of the added texts
+        """
+
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        self._collection.upsert(ids, self._embedding_function.embed_documents(texts), metadatas, texts)
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> None:
+        self._collection.delete(ids=ids, where=kwargs.get('where'))
+
+    def get_by_ids(self, ids: List[str], /) -> List[Document]:
+        page: Dict[Text, Any] = self._collection.get(ids=list(ids))
+        return [
+            Document(id=chunk_id, page_content=text, metadata=metadata)
+            for chunk_id, text, metadata in zip(page['ids'], page['documents'], page['metadatas'])
+        ]
+
+    def similarity_search_by_vector_with_score(
+            self,
+            embedding: List[float],
+            k: int = 4,
+            filter: Optional[Dict[str, Any]] = None
+    ) -> List[Tuple[Document, float]]:
+        """
+        Returns k nearest chunks to the embedding with their squared distances
+        :param embedding:
+        :param k:
+        :param filter: Chroma where clause on file_id
+        :return:
+        """
+
+        results: Dict[Text, Any] = self._collection.query([embedding], n_results=k, where=filter)
+        return [
+            (Document(id=chunk_id, page_content=text, metadata=metadata), distance)
+            for chunk_id, text, metadata, distance in zip(
+                results['ids'][0], results['documents'][0], results['metadatas'][0], results['distances'][0]
+            )
+        ]
+
+    def similarity_search_with_score(
+            self,
+            query: str,
+            k: int = 4,
+            filter: Optional[Dict[str, Any]] = None,
+            **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding_function.embed_query(query), k, filter)
+
+    def similarity_search_by_vector(
+            self,
+            embedding: List[float],
+            k: int = 4,
+            filter: Optional[Dict[str, Any]] = None,
+            **kwargs: Any
+    ) -> List[Document]:
+        return [document for document, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search(
+            self,
+            query: str,
+            k: int = 4,
+            filter: Optional[Dict[str, Any]] = None,
+            **kwargs: Any
+    ) -> List[Document]:
+        return [document for document, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return self._euclidean_relevance_score_fn
+
+    @classmethod
+    def from_texts(
+            cls,
+            texts: List[str],
+            embedding: Embeddings,
+            metadatas: Optional[List[Dict[str, Any]]] = None,
+            *,
+            ids: Optional[List[str]] = None,
+            directory: str = Config.QUANTIZED_DIRECTORY,
+            **kwargs: Any
+    ) -> 'QuantizedVectorStore':
+        vector_store: QuantizedVectorStore = cls(directory, embedding)
+        vector_store.add_texts(texts, metadatas, ids)
+        return vector_store
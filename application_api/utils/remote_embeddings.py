@@ -0,0 +1,106 @@
+"""
+This file contains the client of the embedding service, so that
+API workers share one embedding model and one embedding cache
+instead of loading the model in every process
+"""
+
+from application_api.model.pydantic_models import EmbeddingKind
+
+from langchain_core.embeddings import Embeddings
+from typing import Any, Dict, List, Optional, Text
+import threading
+
+import httpx
+
+
+class RemoteEmbeddings(Embeddings):
+    """
+    Embeddings, that are computed by the embedding service.
+    Offers the same methods as CachedEmbeddings, the cache lives in the service
+    """
+
+    TIMEOUT_SECONDS: float = 120.0
+    # Texts sent in a single request, larger lists are split
+    BATCH_SIZE: int = 1000
+
+    def __init__(self, base_url: str, timeout: float = TIMEOUT_SECONDS) -> None:
+        self.base_url: str = base_url.rstrip('/')
+        # Connections are kept open and shared by the threads of the worker
+        self._client: httpx.Client = httpx.Client(base_url=self.base_url, timeout=timeout)
+        self._model_name: Optional[str] = None
+        self._lock: threading.Lock = threading.Lock()
+
+    @property
+    def model_name(self) -> str:
+        """
+        Returns name of the model the service embeds with, asking the service on first use
+        :return:
+        """
+
+        if self._model_name is None:
+            with self._lock:
+                if self._model_name is None:
+                    response: httpx.Response = self._client.get('/info')
+                    response.raise_for_status()
+                    self._model_name = response.json()['model_name']
+        return self._model_name
+
+    def _embed(self, kind: EmbeddingKind, texts: List[str]) -> List[List[float]]:
+        """
+        Sends texts to the embedding service in batches
+        :param kind:
+        :param texts:
+        :return:
+        """
+
+        vectors: List[List[float]] = []
+        for start in range(0, len(texts), self.BATCH_SIZE):
+            response: httpx.Response = self._client.post(
+                '/embed', json={'kind': kind.value, 'texts': texts[start:start + self.BATCH_SIZE]}
+            )
+            response.raise_for_status()
+            result: Dict[Text, Any] = response.json()
+            self._model_name = result['model_name']
+            vectors.extend(result['vectors'])
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds document chunks
+        :param texts:
+        :return:
+        """
+
+        return self._embed(EmbeddingKind.DOCUMENT, texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embeds query
+        :param text:
+        :return:
+        """
+
+        return self._embed(EmbeddingKind.QUERY, [text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds several queries in a single request
+        :param texts:
+        :return:
+        """
+
+        return self._embed(EmbeddingKind.QUERY, texts)
+
+    def get_stats(self) -> Dict[Text, Optional[float]]:
+        """
+        Returns hit/miss counters of the service's embedding cache
+        :return:
+        """
+
+        try:
+            response: httpx.Response = self._client.get('/stats')
+            response.raise_for_status()
+            return response.json()
+        except httpx.HTTPError as e:
+            print(f'Error getting embedding service stats: {str(e)}')
+            return {}
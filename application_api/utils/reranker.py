@@ -0,0 +1,164 @@
+"""
+This file contains the cross-encoder reranking stage, that reorders
+over-fetched retrieval candidates by scoring every (question, chunk)
+pair jointly, which is more accurate than comparing embeddings
+"""
+
+from application_api.utils.model_registry import ModelRegistry
+
+from langchain_core.documents import Document
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Text, Tuple
+import hashlib
+import threading
+import time
+
+
+class CrossEncoderReranker:
+    """
+    Class, that reranks documents with a cross-encoder in batches,
+    caching pair scores and falling back to the incoming order
+    when scoring does not fit into the latency budget
+    """
+
+    BATCH_SIZE: int = 16
+    MAX_CACHE_SIZE: int = 8192
+    LATENCY_BUDGET_SECONDS: float = 0.5
+
+    def __init__(
+            self,
+            model: Optional[Any] = None,
+            batch_size: int = BATCH_SIZE,
+            max_cache_size: int = MAX_CACHE_SIZE,
+            latency_budget_seconds: float = LATENCY_BUDGET_SECONDS
+    ) -> None:
+        self._model: Optional[Any] = model
+        self.batch_size: int = batch_size
+        self.max_cache_size: int = max_cache_size
+        self.latency_budget_seconds: float = latency_budget_seconds
+
+        self._cache: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+        self.cache_hits: int = 0
+        self.cache_misses: int = 0
+        self.fallbacks: int = 0
+
+    @property
+    def model(self) -> Any:
+        """
+        Returns cross-encoder model, loading the shared one on first use
+        :return:
+        """
+
+        if self._model is None:
+            self._model = ModelRegistry.get_cross_encoder()
+        return self._model
+
+    def warm_up(self) -> None:
+        """
+        Loads the model and scores a pair, so that the first reranked request
+        does not spend its latency budget on loading and initialization
+        :return:
+        """
+
+        self.model.predict([('warm up', 'warm up')], batch_size=1)
+
+    @staticmethod
+    def _get_cache_key(question: str, document: Document) -> str:
+        """
+        Returns cache key of a pair: hash of question and chunk id, or chunk content for chunks without id
+        :param question:
+        :param document:
+        :return:
+        """
+
+        chunk_key: str = document.id or document.page_content
+        return hashlib.sha256(f'{question}\0{chunk_key}'.encode('utf-8')).hexdigest()
+
+    def _score(self, question: str, documents: List[Document]) -> Optional[List[float]]:
+        """
+        Returns scores of documents for the question,
+        None when the latency budget ran out before all pairs were scored
+        :param question:
+        :param documents:
+        :return:
+        """
+
+        # Loading the model takes seconds, so it is not counted against the latency budget
+        model: Any = self.model
+        started: float = time.perf_counter()
+        keys: List[str] = [self._get_cache_key(question, document) for document in documents]
+        scores: List[Optional[float]] = []
+
+        with self._lock:
+            for key in keys:
+                score: Optional[float] = self._cache.get(key)
+                if score is not None:
+                    self._cache.move_to_end(key)
+                scores.append(score)
+        missing: List[int] = [number for number, score in enumerate(scores) if score is None]
+        with self._lock:
+            self.cache_hits += len(documents) - len(missing)
+            self.cache_misses += len(missing)
+
+        for start in range(0, len(missing), self.batch_size):
+            if time.perf_counter() - started > self.latency_budget_seconds:
+                return None
+
+            batch: List[int] = missing[start:start + self.batch_size]
+            batch_scores: Any = model.predict(
+                [(question, documents[number].page_content) for number in batch], batch_size=self.batch_size
+            )
+            with self._lock:
+                for number, score in zip(batch, batch_scores):
+                    scores[number] = float(score)
+                    self._cache[keys[number]] = float(score)
+                while len(self._cache) > self.max_cache_size:
+                    self._cache.popitem(last=False)
+
+        # Scoring of the last batch may overrun the budget as well
+        if missing and time.perf_counter() - started > self.latency_budget_seconds:
+            return None
+        return scores
+
+    def rerank(self, question: str, documents: List[Document], top_n: int) -> List[Document]:
+        """
+        Returns top_n documents best matching the question. The incoming order is
+        kept when the latency budget is exceeded, scores computed so far are cached
+        :param question:
+        :param documents:
+        :param top_n:
+        :return:
+        """
+
+        if len(documents) <= 1:
+            return documents[:top_n]
+
+        scores: Optional[List[float]] = self._score(question, documents)
+        if scores is None:
+            with self._lock:
+                self.fallbacks += 1
+            return documents[:top_n]
+
+        ranked: List[Tuple[float, int]] = sorted(
+            ((score, number) for number, score in enumerate(scores)), key=lambda item: item[0], reverse=True
+        )
+        return [documents[number] for _, number in ranked[:top_n]]
+
+    def get_stats(self) -> Dict[Text, Any]:
+        """
+        Returns cache and fallback counters of the reranker
+        :return:
+        """
+
+        with self._lock:
+            lookups: int = self.cache_hits + self.cache_misses
+            return {
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'hit_rate': self.cache_hits / lookups if lookups else None,
+                'fallbacks': self.fallbacks,
+                'entries': len(self._cache),
+                'max_entries': self.max_cache_size
+            }
@@ -0,0 +1,192 @@
+"""
+This file contains the question rewrite policy, that decides when
+the history-aware question reformulation by LLM can be skipped,
+and caches reformulated questions
+"""
+
+from langchain_core.runnables import Runnable
+from collections import OrderedDict
+from typing import Dict, FrozenSet, List, Optional, Text
+import hashlib
+import json
+import re
+import threading
+
+
+class QuestionRewriter:
+    """
+    Class, that produces standalone questions for retrieval,
+    calling the rewrite chain only when it is needed
+    """
+
+    MAX_CACHE_SIZE: int = 1024
+    # Shorter questions are usually follow-ups like "why?" or "and the second one?"
+    MIN_STANDALONE_WORDS: int = 5
+
+    # Words, that usually refer to something from the earlier conversation
+    REFERENCE_WORDS: FrozenSet[str] = frozenset({
+        'it', 'its', 'they', 'them', 'their', 'theirs', 'this', 'that', 'these', 'those',
+        'he', 'she', 'him', 'her', 'his', 'hers', 'above', 'previous', 'earlier', 'former',
+        'latter', 'same', 'aforementioned', 'mentioned', 'there', 'then', 'one', 'ones',
+        'else', 'again', 'another', 'other', 'others', 'more', 'further'
+    })
+    FOLLOW_UP_PREFIXES: tuple = ('and ', 'but ', 'so ', 'also ', 'what about ', 'how about ')
+
+    def __init__(self, max_cache_size: int = MAX_CACHE_SIZE) -> None:
+        self.max_cache_size: int = max_cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+        self.skipped_empty_history: int = 0
+        self.skipped_standalone: int = 0
+        self.cache_hits: int = 0
+        self.rewrites: int = 0
+
+    def is_standalone(self, question: str) -> bool:
+        """
+        Cheap heuristic, that marks questions understandable without chat history
+        :param question:
+        :return:
+        """
+
+        normalized: str = question.strip().lower()
+        words: List[str] = re.findall(r"[a-z0-9']+", normalized)
+
+        if len(words) < self.MIN_STANDALONE_WORDS or normalized.startswith(self.FOLLOW_UP_PREFIXES):
+            return False
+        return not any(word in self.REFERENCE_WORDS for word in words)
+
+    @staticmethod
+    def _get_cache_key(model: str, question: str, chat_history: List[Dict[Text, Text]]) -> str:
+        """
+        Returns cache key of a rewrite: hash of model, chat history and question
+        :param model:
+        :param question:
+        :param chat_history:
+        :return:
+        """
+
+        history_hash: str = hashlib.sha256(json.dumps(chat_history, sort_keys=True).encode('utf-8')).hexdigest()
+        return hashlib.sha256(f'{model}\0{history_hash}\0{question}'.encode('utf-8')).hexdigest()
+
+    def _skip_rewrite(self, question: str, chat_history: List[Dict[Text, Text]]) -> bool:
+        """
+        Checks if question can be used for retrieval as is, counting skipped rewrites
+        :param question:
+        :param chat_history:
+        :return:
+        """
+
+        if not chat_history:
+            with self._lock:
+                self.skipped_empty_history += 1
+            return True
+
+        if self.is_standalone(question):
+            with self._lock:
+                self.skipped_standalone += 1
+            return True
+
+        return False
+
+    def _get_cached(self, key: str) -> Optional[str]:
+        """
+        Returns cached rewrite and marks it as recently used
+        :param key:
+        :return:
+        """
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return self._cache[key]
+        return None
+
+    def _store(self, key: str, standalone_question: str) -> None:
+        """
+        Stores rewrite, evicting least recently used ones above the size cap
+        :param key:
+        :param standalone_question:
+        :return:
+        """
+
+        with self._lock:
+            self.rewrites += 1
+            self._cache[key] = standalone_question
+            while len(self._cache) > self.max_cache_size:
+                self._cache.popitem(last=False)
+
+    def get_standalone_question(
+            self,
+            rewrite_chain: Runnable,
+            model: str,
+            question: str,
+            chat_history: List[Dict[Text, Text]]
+    ) -> str:
+        """
+        Returns question, that can be understood without chat history,
+        running rewrite_chain only if it is needed and not cached
+        :param rewrite_chain:
+        :param model:
+        :param question:
+        :param chat_history:
+        :return:
+        """
+
+        if self._skip_rewrite(question, chat_history):
+            return question
+
+        key: str = self._get_cache_key(model, question, chat_history)
+        cached: Optional[str] = self._get_cached(key)
+        if cached is not None:
+            return cached
+
+        standalone_question: str = rewrite_chain.invoke({'input': question, 'chat_history': chat_history}).strip()
+        self._store(key, standalone_question)
+        return standalone_question
+
+    async def aget_standalone_question(
+            self,
+            rewrite_chain: Runnable,
+            model: str,
+            question: str,
+            chat_history: List[Dict[Text, Text]]
+    ) -> str:
+        """
+        Async version of get_standalone_question
+        :param rewrite_chain:
+        :param model:
+        :param question:
+        :param chat_history:
+        :return:
+        """
+
+        if self._skip_rewrite(question, chat_history):
+            return question
+
+        key: str = self._get_cache_key(model, question, chat_history)
+        cached: Optional[str] = self._get_cached(key)
+        if cached is not None:
+            return cached
+
+        standalone_question: str = (
+            await rewrite_chain.ainvoke({'input': question, 'chat_history': chat_history})
+        ).strip()
+        self._store(key, standalone_question)
+        return standalone_question
+
+    def get_stats(self) -> Dict[Text, int]:
+        """
+        Returns counters of skipped, cached and performed rewrites
+        :return:
+        """
+
+        with self._lock:
+            return {
+                'skipped_empty_history': self.skipped_empty_history,
+                'skipped_standalone': self.skipped_standalone,
+                'cache_hits': self.cache_hits,
+                'rewrites': self.rewrites,
+                'cache_entries': len(self._cache)
+            }
@@ -0,0 +1,41 @@
+"""
+This file contains utilities for estimating
+the number of tokens in prompts and messages
+"""
+
+from typing import Dict, List, Text
+import math
+
+
+class TokenUtils:
+    """
+    Class for cheap token count estimation without loading a tokenizer
+    """
+
+    # LLaMA tokenizers produce roughly one token per 4 characters of English text
+    CHARACTERS_PER_TOKEN: float = 4.0
+    # Role markers and separators added around every chat message
+    MESSAGE_OVERHEAD_TOKENS: int = 4
+
+    @staticmethod
+    def count_tokens(text: str) -> int:
+        """
+        Estimates number of tokens in a text
+        :param text:
+        :return:
+        """
+
+        return math.ceil(len(text) / TokenUtils.CHARACTERS_PER_TOKEN)
+
+    @staticmethod
+    def count_message_tokens(messages: List[Dict[Text, Text]]) -> int:
+        """
+        Estimates number of tokens in a list of chat messages
+        :param messages:
+        :return:
+        """
+
+        return sum(
+            TokenUtils.count_tokens(message['content']) + TokenUtils.MESSAGE_OVERHEAD_TOKENS
+            for message in messages
+        )
@@ -0,0 +1,206 @@
+"""
+This file contains the streaming upload spooler, that writes the file
+part of a multipart request straight into the upload directory in
+bounded chunks, hashing it on the way and stopping as soon as it
+exceeds the size limit, without an intermediate temporary copy
+"""
+
+from application_api.utils.config import Config
+from application_api.utils.metrics import metrics
+
+from fastapi import HTTPException, Request
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Text, Tuple
+import hashlib
+import os
+import shutil
+
+
+class SpooledUpload:
+    """
+    Class, that describes an uploaded file written to the upload directory
+    """
+
+    def __init__(self, filename: str, file_path: str, content_hash: str, size: int, fields: Dict[Text, str]) -> None:
+        self.filename: str = filename
+        self.file_path: str = file_path
+        self.content_hash: str = content_hash
+        self.size: int = size
+        # Other, non-file form fields of the request
+        self.fields: Dict[Text, str] = fields
+
+
+class UploadSpooler:
+    """
+    Class, that streams the file field of multipart uploads to disk.
+    At most flush_bytes of the file are held in memory per upload,
+    and every byte is written to disk exactly once
+    """
+
+    MAX_UPLOAD_BYTES: int = Config.MAX_UPLOAD_MB * 1024 * 1024
+    FLUSH_BYTES: int = 1024 * 1024
+    # Boundaries and part headers around the file content
+    MAX_MULTIPART_OVERHEAD_BYTES: int = 64 * 1024
+    MAX_FIELD_BYTES: int = 1024
+    FILE_FIELD: str = 'file'
+    # 1 KB to 64 GB
+    SIZE_BUCKETS: Tuple[float, ...] = tuple(float(4 ** power * 1024) for power in range(9))
+
+    def __init__(
+            self,
+            allowed_extensions: List[str],
+            max_upload_bytes: int = MAX_UPLOAD_BYTES,
+            flush_bytes: int = FLUSH_BYTES
+    ) -> None:
+        self.allowed_extensions: List[str] = allowed_extensions
+        self.max_upload_bytes: int = max_upload_bytes
+        self.flush_bytes: int = flush_bytes
+
+    def _too_large(self) -> HTTPException:
+        """
+        Returns error for uploads over the size limit
+        :return:
+        """
+
+        metrics.add('rag_upload_rejections_total', labels={'reason': 'too_large'})
+        return HTTPException(
+            status_code=413, detail=f'File is larger than {self.max_upload_bytes / (1024 * 1024):g} MB.'
+        )
+
+    def _check_request(self, request: Request, upload_directory: str) -> None:
+        """
+        Rejects requests, that are not multipart or are known to be too large before reading their body
+        :param request:
+        :param upload_directory:
+        :return:
+        """
+
+        content_type, _ = parse_options_header(request.headers.get('content-type'))
+        if content_type != b'multipart/form-data':
+            raise HTTPException(status_code=415, detail='Upload must be sent as multipart/form-data.')
+
+        content_length: Optional[str] = request.headers.get('content-length')
+        if content_length is None or not content_length.isdigit():
+            return
+        if int(content_length) > self.max_upload_bytes + self.MAX_MULTIPART_OVERHEAD_BYTES:
+            raise self._too_large()
+        if int(content_length) > shutil.disk_usage(upload_directory).free:
+            metrics.add('rag_upload_rejections_total', labels={'reason': 'no_space'})
+            raise HTTPException(status_code=507, detail='Not enough disk space to store the file.')
+
+    async def spool(self, request: Request, get_path: Callable[[str], str]) -> SpooledUpload:
+        """
+        Reads the request body as it arrives and writes its file field to disk
+        :param request:
+        :param get_path: returns path for the file given its extension
+        :return:
+        """
+
+        upload_directory: str = os.path.dirname(get_path(''))
+        self._check_request(request, upload_directory)
+        _, options = parse_options_header(request.headers['content-type'])
+        if b'boundary' not in options:
+            raise HTTPException(status_code=400, detail='Multipart boundary is missing.')
+
+        state: Dict[Text, Any] = {'header_field': b'', 'header_value': b'', 'headers': {}, 'name': None}
+        fields: Dict[Text, str] = {}
+        pending: bytearray = bytearray()
+        upload: Dict[Text, Any] = {'filename': None, 'path': None, 'file': None, 'size': 0, 'done': False}
+        hasher: Any = hashlib.sha256()
+
+        def on_part_begin() -> None:
+            state['headers'] = {}
+            state['name'] = None
+
+        def on_header_field(data: bytes, start: int, end: int) -> None:
+            state['header_field'] += data[start:end]
+
+        def on_header_value(data: bytes, start: int, end: int) -> None:
+            state['header_value'] += data[start:end]
+
+        def on_header_end() -> None:
+            state['headers'][state['header_field'].lower()] = state['header_value']
+            state['header_field'] = state['header_value'] = b''
+
+        def on_headers_finished() -> None:
+            _, disposition = parse_options_header(state['headers'].get(b'content-disposition'))
+            state['name'] = disposition.get(b'name', b'').decode('utf-8', 'replace')
+            if state['name'] == self.FILE_FIELD and upload['filename'] is None:
+                upload['filename'] = os.path.basename(disposition.get(b'filename', b'').decode('utf-8', 'replace'))
+            else:
+                fields[state['name']] = ''
+
+        def on_part_data(data: bytes, start: int, end: int) -> None:
+            if state['name'] == self.FILE_FIELD and not upload['done']:
+                pending.extend(data[start:end])
+                upload['size'] += end - start
+            elif state['name'] in fields and len(fields[state['name']]) < self.MAX_FIELD_BYTES:
+                fields[state['name']] += data[start:end].decode('utf-8', 'replace')
+
+        def on_part_end() -> None:
+            if state['name'] == self.FILE_FIELD:
+                upload['done'] = True
+
+        parser: MultipartParser = MultipartParser(options[b'boundary'], {
+            'on_part_begin': on_part_begin,
+            'on_header_field': on_header_field,
+            'on_header_value': on_header_value,
+            'on_header_end': on_header_end,
+            'on_headers_finished': on_headers_finished,
+            'on_part_data': on_part_data,
+            'on_part_end': on_part_end
+        })
+
+        def flush() -> None:
+            if upload['file'] is None:
+                upload['file'] = open(upload['path'], 'wb')
+            hasher.update(pending)
+            upload['file'].write(pending)
+            pending.clear()
+
+        try:
+            with metrics.span('upload_spool'):
+                async for chunk in request.stream():
+                    parser.write(chunk)
+
+                    if upload['filename'] is not None and upload['path'] is None:
+                        file_extension: str = os.path.splitext(upload['filename'])[1].lower()
+                        if file_extension not in self.allowed_extensions:
+                            raise HTTPException(
+                                status_code=400,
+                                detail=f"Unsupported file type. Allowed types are: {','.join(self.allowed_extensions)}"
+                            )
+                        upload['path'] = get_path(file_extension)
+                    if upload['size'] > self.max_upload_bytes:
+                        raise self._too_large()
+                    if len(pending) >= self.flush_bytes or (upload['done'] and pending):
+                        await run_in_threadpool(flush)
+                parser.finalize()
+
+                if upload['path'] is None:
+                    raise HTTPException(status_code=400, detail=f'Form field "{self.FILE_FIELD}" is missing.')
+                if pending or upload['file'] is None:
+                    await run_in_threadpool(flush)
+                await run_in_threadpool(upload['file'].close)
+        except BaseException:
+            # Partially written files are not kept, whether the client went away or the upload was rejected
+            await run_in_threadpool(self._discard, upload['file'], upload['path'])
+            raise
+
+        metrics.observe('rag_upload_size_bytes', upload['size'], buckets=self.SIZE_BUCKETS)
+        return SpooledUpload(upload['filename'], upload['path'], hasher.hexdigest(), upload['size'], fields)
+
+    @staticmethod
+    def _discard(file: Optional[BinaryIO], file_path: Optional[str]) -> None:
+        """
+        Closes and removes a partially written upload
+        :param file:
+        :param file_path:
+        :return:
+        """
+
+        if file is not None:
+            file.close()
+        if file_path is not None and os.path.exists(file_path):
+            os.remove(file_path)
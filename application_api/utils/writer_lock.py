@@ -0,0 +1,96 @@
+"""
+This file contains the writer lock, that elects the one process
+writing the indexes when several workers serve the API: it runs
+ingestion jobs, deletions and compaction, while the other workers
+only read the indexes and queue their writes in the database
+"""
+
+from application_api.utils.config import Config
+
+from typing import Callable, IO, Optional
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+class WriterLock:
+    """
+    Class, that holds an exclusive lock on a file for the lifetime of the process.
+    The operating system releases the lock when the process exits,
+    so another worker takes over the writes of a worker, that died
+    """
+
+    POLL_INTERVAL_SECONDS: float = Config.POLL_INTERVAL_SECONDS
+
+    def __init__(
+            self,
+            path: str,
+            on_acquired: Optional[Callable[[], None]] = None,
+            poll_interval: float = POLL_INTERVAL_SECONDS
+    ) -> None:
+        self.path: str = path
+        # Called once, when this process becomes the writer
+        self.on_acquired: Callable[[], None] = on_acquired or (lambda: None)
+        self.poll_interval: float = poll_interval
+        self.is_held: bool = False
+        self._file: Optional[IO] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def try_acquire(self) -> bool:
+        """
+        Tries to take the lock without waiting
+        :return: whether this process holds the lock
+        """
+
+        if self.is_held:
+            return True
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        file: IO = open(self.path, 'a+')
+        try:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            file.close()
+            return False
+
+        self._file = file
+        self.is_held = True
+        return True
+
+    def _wait_for_lock(self) -> None:
+        """
+        Tries to take the lock every poll interval until it is taken
+        :return:
+        """
+
+        while not self.try_acquire():
+            time.sleep(self.poll_interval)
+        print(f'Process {os.getpid()} became the index writer')
+        self.on_acquired()
+
+    def start(self) -> bool:
+        """
+        Takes the lock if it is free and calls on_acquired,
+        otherwise keeps trying in a background thread
+        :return: whether this process is the writer now
+        """
+
+        if self.try_acquire():
+            self.on_acquired()
+            return True
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._wait_for_lock, name='writer-lock', daemon=True)
+            self._thread.start()
+        return False
@@ -0,0 +1,271 @@
+"""
+This file load-tests the chat endpoint: for every concurrency level
+it runs that many chat sessions at once against the backend,
+while probing /list-docs latency to see whether generation starves it.
+
+Against a running backend:
+    python -m benchmarks.chat_load_test --base-url http://localhost:8000
+Self-hosted with the Ollama stub (offline, fake embeddings):
+    python -m benchmarks.chat_load_test --self-hosted --fake-embeddings
+Self-hosted with several uvicorn workers, the embedding service and a Chroma server:
+    python -m benchmarks.chat_load_test --self-hosted --fake-embeddings --workers 4
+"""
+
+from typing import Any, Dict, List, Optional, Text
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import httpx
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Returns percentile of values, None for no values
+    :param values:
+    :param fraction:
+    :return:
+    """
+
+    if not values:
+        return None
+    ordered: List[float] = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 4)
+
+
+async def run_session(client: httpx.AsyncClient, turns: int, latencies: List[float], errors: List[str]) -> None:
+    """
+    Runs one chat session with the given number of turns
+    :param client:
+    :param turns:
+    :param latencies:
+    :param errors:
+    :return:
+    """
+
+    session_id: str = str(uuid.uuid4())
+    for turn in range(turns):
+        started: float = time.perf_counter()
+        try:
+            response: httpx.Response = await client.post('/', json={
+                # Unique questions keep the answer cache out of the measurement
+                'question': f'What does the policy say about refunds for invoice {session_id[:8]}-{turn:04d}?',
+                'session_id': session_id
+            })
+            if response.status_code == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors.append(f'{response.status_code}: {response.text[:200]}')
+        except httpx.HTTPError as e:
+            errors.append(repr(e))
+
+
+async def probe_list_docs(client: httpx.AsyncClient, stop: asyncio.Event, latencies: List[float]) -> None:
+    """
+    Measures /list-docs latency until stopped
+    :param client:
+    :param stop:
+    :param latencies:
+    :return:
+    """
+
+    while not stop.is_set():
+        started: float = time.perf_counter()
+        try:
+            await client.get('/list-docs')
+            latencies.append(time.perf_counter() - started)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.1)
+
+
+async def run_level(base_url: str, concurrency: int, turns: int) -> Dict[Text, Any]:
+    """
+    Runs concurrency chat sessions at once and reports throughput and latencies
+    :param base_url:
+    :param concurrency:
+    :param turns:
+    :return:
+    """
+
+    chat_latencies: List[float] = []
+    list_latencies: List[float] = []
+    errors: List[str] = []
+    limits: httpx.Limits = httpx.Limits(max_connections=concurrency + 1)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=600, limits=limits) as client:
+        stop: asyncio.Event = asyncio.Event()
+        probe: asyncio.Task = asyncio.create_task(probe_list_docs(client, stop, list_latencies))
+
+        started: float = time.perf_counter()
+        await asyncio.gather(*(run_session(client, turns, chat_latencies, errors) for _ in range(concurrency)))
+        elapsed: float = time.perf_counter() - started
+
+        stop.set()
+        await probe
+
+    return {
+        'concurrency': concurrency,
+        'chats_per_second': round(len(chat_latencies) / elapsed, 2),
+        'chat_latency_p50': percentile(chat_latencies, 0.5),
+        'chat_latency_p95': percentile(chat_latencies, 0.95),
+        'list_docs_latency_p50': percentile(list_latencies, 0.5),
+        'list_docs_latency_p95': percentile(list_latencies, 0.95),
+        'list_docs_latency_mean': round(statistics.mean(list_latencies), 4) if list_latencies else None,
+        'errors': len(errors),
+        'error_samples': errors[:3]
+    }
+
+
+def start_self_hosted(port: int, stub_port: int, fake_embeddings: bool) -> None:
+    """
+    Starts the Ollama stub and the backend in background threads,
+    with all backend state in a temporary directory
+    :param port:
+    :param stub_port:
+    :param fake_embeddings:
+    :return:
+    """
+
+    working_directory: str = os.path.join(tempfile.mkdtemp(prefix='rag-load-test-'), 'run')
+    os.makedirs(working_directory)
+    os.chdir(working_directory)
+    os.environ['OLLAMA_HOST'] = f'http://127.0.0.1:{stub_port}'
+
+    from benchmarks.ollama_stub import OllamaStub
+    OllamaStub.start_in_thread(port=stub_port)
+
+    if fake_embeddings:
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from application_api.utils.embedding_cache import CachedEmbeddings
+        from application_api.utils.model_registry import ModelRegistry
+        ModelRegistry._embedding_function = CachedEmbeddings(DeterministicFakeEmbedding(size=384), 'fake')
+
+    import uvicorn
+    from application_api.api import app
+    server: uvicorn.Server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+
+def wait_for(url: str, timeout: float = 120.0) -> None:
+    """
+    Waits until url answers with a successful status
+    :param url:
+    :param timeout:
+    :return:
+    """
+
+    deadline: float = time.monotonic() + timeout
+    while True:
+        try:
+            if httpx.get(url, timeout=5).is_success:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'{url} did not start in {timeout} seconds')
+        time.sleep(0.2)
+
+
+def start_self_hosted_workers(
+        port: int,
+        stub_port: int,
+        fake_embeddings: bool,
+        workers: int,
+        embedding_port: int,
+        chroma_port: int
+) -> None:
+    """
+    Starts the Ollama stub and the embedding service in background threads,
+    a Chroma server and the backend with several uvicorn workers in subprocesses,
+    with all state in a temporary directory
+    :param port:
+    :param stub_port:
+    :param fake_embeddings:
+    :param workers:
+    :param embedding_port:
+    :param chroma_port:
+    :return:
+    """
+
+    data_directory: str = tempfile.mkdtemp(prefix='rag-load-test-')
+    os.environ.update({
+        'OLLAMA_HOST': f'http://127.0.0.1:{stub_port}',
+        'RAG_DATA_DIRECTORY': data_directory,
+        'RAG_DB_PATH': os.path.join(data_directory, 'rag_app.db'),
+        'RAG_EMBEDDING_SERVICE_URL': f'http://127.0.0.1:{embedding_port}',
+        'RAG_CHROMA_HOST': '127.0.0.1',
+        'RAG_CHROMA_PORT': str(chroma_port)
+    })
+
+    from benchmarks.ollama_stub import OllamaStub
+    OllamaStub.start_in_thread(port=stub_port)
+
+    if fake_embeddings:
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        from application_api.utils.embedding_cache import CachedEmbeddings
+        from application_api.utils.model_registry import ModelRegistry
+        ModelRegistry._local_embedding_function = CachedEmbeddings(DeterministicFakeEmbedding(size=384), 'fake')
+
+    import uvicorn
+    from application_api.embedding_service import app as embedding_app
+    embedding_server: uvicorn.Server = uvicorn.Server(
+        uvicorn.Config(embedding_app, host='127.0.0.1', port=embedding_port, log_level='warning')
+    )
+    threading.Thread(target=embedding_server.run, daemon=True).start()
+
+    processes: List[subprocess.Popen] = [
+        subprocess.Popen(
+            [shutil.which('chroma') or 'chroma', 'run', '--path', os.path.join(data_directory, 'chroma_db'),
+             '--port', str(chroma_port)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+    ]
+    atexit.register(lambda: [process.terminate() for process in processes])
+    wait_for(f'http://127.0.0.1:{chroma_port}/api/v2/heartbeat')
+
+    processes.append(subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'application_api.api:app', '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(workers), '--log-level', 'warning'],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    ))
+    wait_for(f'http://127.0.0.1:{port}/list-docs')
+
+
+if __name__ == '__main__':
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--base-url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64, 128])
+    parser.add_argument('--turns', type=int, default=2)
+    parser.add_argument('--self-hosted', action='store_true')
+    parser.add_argument('--fake-embeddings', action='store_true')
+    parser.add_argument('--stub-port', type=int, default=11435)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--embedding-port', type=int, default=8101)
+    parser.add_argument('--chroma-port', type=int, default=8102)
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.self_hosted and args.workers > 1:
+        start_self_hosted_workers(
+            int(args.base_url.rsplit(':', 1)[1]), args.stub_port, args.fake_embeddings, args.workers,
+            args.embedding_port, args.chroma_port
+        )
+    elif args.self_hosted:
+        start_self_hosted(int(args.base_url.rsplit(':', 1)[1]), args.stub_port, args.fake_embeddings)
+
+    results: List[Dict[Text, Any]] = [
+        asyncio.run(run_level(args.base_url, concurrency, args.turns)) for concurrency in args.concurrency
+    ]
+    print(json.dumps(results, indent=2))
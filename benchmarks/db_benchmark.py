@@ -0,0 +1,119 @@
+"""
+This file benchmarks the SQLite layer under mixed chat traffic:
+every simulated request reads the session's chat history and
+writes one log row, as the chat endpoint does.
+Compares per-call connections in the default journal mode
+(the previous DBUtils behaviour) with pooled WAL connections.
+
+Usage: python -m benchmarks.db_benchmark --threads 8 --requests 4000
+"""
+
+from application_api.utils.db_utils import DBUtils
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Dict, List, Optional, Text
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+
+class LegacyDBUtils(DBUtils):
+    """
+    DBUtils opening a fresh connection in default journal mode for every call
+    and closing it afterwards, as the benchmarked methods did before
+    """
+
+    @staticmethod
+    def get_db_connection() -> sqlite3.Connection:
+        connection: sqlite3.Connection = sqlite3.connect(DBUtils.DB_NAME)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def insert_application_logs(self, session_id: str, user_query: str, gpt_response: str, model: str) -> None:
+        with closing(self.get_db_connection()) as connection:
+            connection.execute(
+                'INSERT INTO application_logs (session_id, user_query, gpt_response, model) VALUES (?, ?, ?, ?)',
+                (session_id, user_query, gpt_response, model)
+            )
+            connection.commit()
+
+    def get_chat_history(self, session_id: str, max_turns: Optional[int] = None) -> List[Dict[Text, Text]]:
+        messages: List[Dict[Text, Text]] = []
+        with closing(self.get_db_connection()) as connection:
+            rows: List[sqlite3.Row] = connection.execute(
+                'SELECT user_query, gpt_response FROM application_logs WHERE session_id = ? ORDER BY created_at',
+                (session_id,)
+            ).fetchall()
+        for row in rows:
+            messages.extend([
+                {'role': 'human', 'content': row['user_query']},
+                {'role': 'ai', 'content': row['gpt_response']}
+            ])
+        return messages
+
+
+def run_traffic(db_utils: DBUtils, threads: int, requests: int, sessions: int) -> Dict[Text, float]:
+    """
+    Runs mixed get_chat_history/insert_application_logs traffic
+    :param db_utils:
+    :param threads:
+    :param requests:
+    :param sessions:
+    :return:
+    """
+
+    errors: List[str] = []
+
+    def chat_turn(number: int) -> None:
+        session_id: str = f'session-{number % sessions}'
+        try:
+            db_utils.get_chat_history(session_id)
+            db_utils.insert_application_logs(session_id, f'question {number}', f'answer {number}', 'llama3')
+        except sqlite3.OperationalError as e:
+            errors.append(str(e))
+
+    started: float = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(chat_turn, range(requests)))
+    elapsed: float = time.perf_counter() - started
+
+    return {'requests_per_second': round(requests / elapsed, 1), 'seconds': round(elapsed, 3), 'errors': len(errors)}
+
+
+def run_benchmark(threads: int, requests: int, sessions: int, history_rows: int) -> Dict[Text, Dict[Text, float]]:
+    """
+    Runs the same traffic against legacy and pooled database layers,
+    each on its own database file prefilled with chat history
+    :param threads:
+    :param requests:
+    :param sessions:
+    :param history_rows:
+    :return:
+    """
+
+    results: Dict[Text, Dict[Text, float]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, db_utils in [('legacy', LegacyDBUtils()), ('pooled_wal', DBUtils())]:
+            DBUtils.DB_NAME = os.path.join(directory, f'{name}.db')
+            db_utils.create_application_logs()
+            for number in range(history_rows * sessions):
+                db_utils.insert_application_logs(
+                    f'session-{number % sessions}', f'question {number}', f'answer {number}', 'llama3'
+                )
+            results[name] = run_traffic(db_utils, threads, requests, sessions)
+    return results
+
+
+if __name__ == '__main__':
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=4000)
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--history-rows', type=int, default=20)
+    args: argparse.Namespace = parser.parse_args()
+
+    print(json.dumps(run_benchmark(args.threads, args.requests, args.sessions, args.history_rows), indent=2))
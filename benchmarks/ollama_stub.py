@@ -0,0 +1,151 @@
+"""
+This file contains a local stand-in for the Ollama HTTP API,
+so that benchmarks run offline with predictable generation latency.
+It streams a fixed answer token by token and records received requests.
+Like Ollama, it keeps the last prompt and its answer of every model and
+evaluates only the part of a new prompt after their common prefix,
+reporting it in prompt_eval_count and prompt_eval_duration.
+
+Usage: uvicorn benchmarks.ollama_stub:app --port 11435
+then point the backend to it with OLLAMA_HOST=http://127.0.0.1:11435
+"""
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Text
+import asyncio
+import json
+import os
+import threading
+import uvicorn
+
+
+class OllamaStub:
+    """
+    Class, that holds stub settings and log of received requests
+    """
+
+    TOKEN_DELAY_SECONDS: float = 0.02
+    ANSWER_TOKENS: int = 50
+    # Time to evaluate one prompt token, prompts are evaluated for free by default
+    PROMPT_TOKEN_DELAY_SECONDS: float = 0.0
+    # Prompt text is counted in tokens of this many characters
+    CHARACTERS_PER_TOKEN: int = 4
+
+    requests: List[Dict[Text, Any]] = []
+    # Last evaluated sequence (prompt and answer) of every model
+    cached_sequences: Dict[str, str] = {}
+
+    @staticmethod
+    def render_prompt(body: Dict[Text, Any]) -> str:
+        """
+        Renders request into the text the model evaluates, chat messages with a chat template
+        :param body:
+        :return:
+        """
+
+        if 'messages' not in body:
+            return body.get('prompt', '')
+        return ''.join(
+            f'<|{message.get("role", "")}|>\n{message.get("content", "")}<|end|>\n' for message in body['messages']
+        ) + '<|assistant|>\n'
+
+    @staticmethod
+    def evaluate_prompt(model: str, prompt: str, answer: str) -> int:
+        """
+        Returns number of prompt tokens, that are not covered by the cached sequence
+        of the model, and caches prompt and answer in its place
+        :param model:
+        :param prompt:
+        :param answer:
+        :return:
+        """
+
+        common: int = len(os.path.commonprefix([OllamaStub.cached_sequences.get(model, ''), prompt]))
+        OllamaStub.cached_sequences[model] = prompt + answer
+        prompt_tokens: int = -(-len(prompt) // OllamaStub.CHARACTERS_PER_TOKEN)
+        # Cache is reused in whole tokens, the last prompt token is always evaluated
+        reused_tokens: int = max(0, min(common // OllamaStub.CHARACTERS_PER_TOKEN, prompt_tokens - 1))
+        return prompt_tokens - reused_tokens
+
+    @staticmethod
+    def start_in_thread(host: str = '127.0.0.1', port: int = 11435) -> uvicorn.Server:
+        """
+        Starts stub server in a background thread and waits until it accepts requests
+        :param host:
+        :param port:
+        :return:
+        """
+
+        server: uvicorn.Server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level='warning'))
+        threading.Thread(target=server.run, daemon=True).start()
+        while not server.started:
+            threading.Event().wait(0.05)
+        return server
+
+
+app: FastAPI = FastAPI()
+
+
+def _stream_tokens(body: Dict[Text, Any], chat: bool) -> AsyncIterator[Text]:
+    """
+    Evaluates the prompt and streams answer tokens in Ollama's NDJSON format
+    :param body:
+    :param chat:
+    :return:
+    """
+
+    model: str = body.get('model', '')
+    answer_tokens: List[str] = [f'token{number} ' for number in range(OllamaStub.ANSWER_TOKENS)]
+    prompt_eval_count: int = OllamaStub.evaluate_prompt(
+        model, OllamaStub.render_prompt(body), ''.join(answer_tokens)
+    )
+    prompt_eval_seconds: float = prompt_eval_count * OllamaStub.PROMPT_TOKEN_DELAY_SECONDS
+
+    async def generate() -> AsyncIterator[Text]:
+        await asyncio.sleep(prompt_eval_seconds)
+        for token in answer_tokens:
+            await asyncio.sleep(OllamaStub.TOKEN_DELAY_SECONDS)
+            chunk: Dict[Text, Any] = {
+                'model': model,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'done': False
+            }
+            if chat:
+                chunk['message'] = {'role': 'assistant', 'content': token}
+            else:
+                chunk['response'] = token
+            yield json.dumps(chunk) + '\n'
+
+        final: Dict[Text, Any] = {
+            'model': model,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'done': True,
+            'done_reason': 'stop',
+            'prompt_eval_count': prompt_eval_count,
+            'prompt_eval_duration': int(prompt_eval_seconds * 1e9),
+            'eval_count': OllamaStub.ANSWER_TOKENS,
+            'eval_duration': int(OllamaStub.ANSWER_TOKENS * OllamaStub.TOKEN_DELAY_SECONDS * 1e9)
+        }
+        if chat:
+            final['message'] = {'role': 'assistant', 'content': ''}
+        else:
+            final['response'] = ''
+        yield json.dumps(final) + '\n'
+
+    return generate()
+
+
+@app.post('/api/generate')
+async def generate(request: Request) -> StreamingResponse:
+    body: Dict[Text, Any] = await request.json()
+    OllamaStub.requests.append(body)
+    return StreamingResponse(_stream_tokens(body, chat=False), media_type='application/x-ndjson')
+
+
+@app.post('/api/chat')
+async def chat(request: Request) -> StreamingResponse:
+    body: Dict[Text, Any] = await request.json()
+    OllamaStub.requests.append(body)
+    return StreamingResponse(_stream_tokens(body, chat=True), media_type='application/x-ndjson')
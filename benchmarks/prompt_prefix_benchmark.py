@@ -0,0 +1,291 @@
+"""
+This file measures prompt evaluation Ollama saves by reusing its prompt cache
+across the turns of a chat session. Ollama evaluates only the part of a prompt
+after the prefix it shares with the previous prompt of the model, so the question
+rewrite and the answer prompts start with the system prompt and chat history,
+and history is trimmed by WINDOW_STEP_TURNS turns at a time.
+Every turn is answered by LangChainUtils.answer, as the API answers it: the question
+is rewritten when it needs the history, history is packed into the token budget and
+the answer is generated. Compares the previous layout (context before chat history,
+own rewrite system prompt, history trimmed by one turn) with the current one.
+The prefix itself is checked by tests/test_prompt_prefix.py.
+
+Offline with the Ollama stub, that emulates the prompt cache:
+    python -m benchmarks.prompt_prefix_benchmark
+Against a running Ollama:
+    python -m benchmarks.prompt_prefix_benchmark --base-url http://localhost:11434 --model llama3
+"""
+
+from application_api.utils.db_utils import DBUtils
+from application_api.utils.history_utils import ChatHistoryManager, HistoryMode
+from application_api.utils.langchain_utils import LangChainUtils
+from application_api.utils.model_registry import ModelRegistry
+from application_api.utils.quantized_vector_store import QuantizedVectorStore
+from benchmarks.ollama_stub import OllamaStub
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import LLMResult
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import Runnable, RunnablePassthrough
+from typing import Any, Dict, List, Optional, Text, Tuple
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+# Prompts as they were laid out before: context changed the answer prompt right after
+# the system prompt, and the rewrite prompt had a system prompt of its own
+legacy_contextualize_q_prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages([
+    ('system', 'Given a chat history and the latest user question which might reference context in the chat '
+               'history, formulate a standalone question which can be understood without the chat history. '
+               'Do NOT answer the question, just reformulate it if needed and otherwise return it as is.'),
+    MessagesPlaceholder('chat_history'),
+    ('human', '{input}')
+])
+legacy_qa_prompt: ChatPromptTemplate = ChatPromptTemplate.from_messages([
+    ('system', "You are a helpful AI assistant. Use the following context to answer the user's question."),
+    ('system', 'Context: {context}'),
+    MessagesPlaceholder(variable_name='chat_history'),
+    ('human', '{input}')
+])
+
+LAYOUTS: List[str] = ['legacy', 'prefix_stable']
+
+WORDS: List[str] = [
+    'invoice', 'contract', 'delivery', 'payment', 'warranty', 'supplier', 'customer', 'amount',
+    'deadline', 'clause', 'penalty', 'order', 'report', 'quarter', 'revenue', 'budget'
+]
+
+
+class LegacyLangChainUtils(LangChainUtils):
+    """
+    Class, that answers with the previous prompt layout
+    """
+
+    def get_rewrite_chain(self, model: str) -> Runnable:
+        return self._get_chain(
+            'rewrite', model,
+            lambda name: legacy_contextualize_q_prompt | ModelRegistry.get_llm(name) | self.output_parser
+        )
+
+    def get_prompt_chain(self) -> Runnable:
+        return self._get_chain(
+            'prompt', '', lambda _: RunnablePassthrough.assign(context=self._format_documents) | legacy_qa_prompt
+        )
+
+
+class PromptRecorder(BaseCallbackHandler):
+    """
+    Class, that records messages of every chat model call and prompt evaluation Ollama reports for it
+    """
+
+    def __init__(self) -> None:
+        self.calls: List[Dict[Text, Any]] = []
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], **kwargs: Any) -> None:
+        self.calls.append({'messages': messages[0], 'prompt_eval_count': 0, 'prompt_eval_seconds': 0.0})
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        generation_info: Dict[Text, Any] = response.generations[0][0].generation_info or {}
+        self.calls[-1]['prompt_eval_count'] = generation_info.get('prompt_eval_count') or 0
+        # Durations are reported in nanoseconds
+        self.calls[-1]['prompt_eval_seconds'] = (generation_info.get('prompt_eval_duration') or 0) / 1e9
+
+
+def make_text(rng: random.Random, tokens: int) -> str:
+    """
+    Returns random text of about the given number of tokens
+    :param rng:
+    :param tokens:
+    :return:
+    """
+
+    words: List[str] = []
+    characters: int = 0
+    # Four characters make a token on average
+    while characters < tokens * 4:
+        words.append(rng.choice(WORDS))
+        characters += len(words[-1]) + 1
+    return ' '.join(words)
+
+
+def make_question(rng: random.Random, turn: int) -> str:
+    """
+    Returns question of a turn: every other question is a follow-up, that is rewritten with chat history
+    :param rng:
+    :param turn:
+    :return:
+    """
+
+    if turn % 2:
+        return f'And what does it say about the {rng.choice(WORDS)}?'
+    return f'Which {rng.choice(WORDS)} terms apply to order {turn} in the {rng.choice(WORDS)} report?'
+
+
+def create_langchain_utils(layout: str, directory: str, chunks: int, chunk_tokens: int, seed: int) -> LangChainUtils:
+    """
+    Creates LangChainUtils answering with the layout from a store of random chunks
+    :param layout:
+    :param directory:
+    :param chunks:
+    :param chunk_tokens:
+    :param seed:
+    :return:
+    """
+
+    rng: random.Random = random.Random(seed)
+    vector_store: QuantizedVectorStore = QuantizedVectorStore(
+        os.path.join(directory, f'{layout}_index'), DeterministicFakeEmbedding(size=64)
+    )
+    vector_store.add_texts(
+        [make_text(rng, chunk_tokens) for _ in range(chunks)],
+        [{'file_id': 1, 'chunk_index': number} for number in range(chunks)]
+    )
+
+    langchain_utils: LangChainUtils = (LegacyLangChainUtils if layout == 'legacy' else LangChainUtils)(
+        vector_store=vector_store, rerank=False
+    )
+    if layout == 'legacy':
+        langchain_utils.context_packer.history_step_turns = 1
+    # Stub answers and the questions rewritten by it repeat, cached answers would skip generations
+    langchain_utils.answer_cache.similarity_threshold = float('inf')
+    return langchain_utils
+
+
+def run_session(
+        langchain_utils: LangChainUtils,
+        history_manager: ChatHistoryManager,
+        recorder: PromptRecorder,
+        session_id: str,
+        model: str,
+        turns: int,
+        seed: int
+) -> List[Dict[Text, Any]]:
+    """
+    Answers turns of one chat session and returns for every turn the recorded
+    model calls (the rewrite, if the question was rewritten, and the answer) and
+    whether the history of the answer prompt starts with the previous one
+    :param langchain_utils:
+    :param history_manager:
+    :param recorder:
+    :param session_id:
+    :param model:
+    :param turns:
+    :param seed:
+    :return:
+    """
+
+    rng: random.Random = random.Random(seed)
+    results: List[Dict[Text, Any]] = []
+    previous_history: Optional[List[Tuple[str, str]]] = None
+    for turn in range(turns):
+        question: str = make_question(rng, turn)
+        first_call: int = len(recorder.calls)
+        answer: Dict[Text, Any] = langchain_utils.answer(question, history_manager.get_chat_history(session_id), model)
+        history_manager.db_utils.insert_application_logs(session_id, question, answer['answer'], model)
+
+        calls: List[Dict[Text, Any]] = recorder.calls[first_call:]
+        # History is everything between the leading system prompt and the last message
+        history: List[Tuple[str, str]] = [
+            (message.type, message.content) for message in calls[-1]['messages'][1:-1]
+            if not message.content.startswith('Context: ')
+        ]
+        results.append({
+            'turn': turn,
+            'rewrite': calls[0] if len(calls) > 1 else None,
+            'answer': calls[-1],
+            'previous_history': previous_history,
+            'history_kept': previous_history is not None and history[:len(previous_history)] == previous_history
+        })
+        previous_history = history
+    return results
+
+
+def summarize_session(results: List[Dict[Text, Any]], seconds: float) -> Dict[Text, Any]:
+    """
+    Returns prompt evaluation totals of a session
+    :param results:
+    :param seconds:
+    :return:
+    """
+
+    calls: List[Dict[Text, Any]] = [
+        call for result in results for call in (result['rewrite'], result['answer']) if call is not None
+    ]
+    return {
+        'turns': len(results),
+        'model_calls': len(calls),
+        'seconds': round(seconds, 3),
+        'prompt_eval_tokens': sum(call['prompt_eval_count'] for call in calls),
+        'prompt_eval_seconds': round(sum(call['prompt_eval_seconds'] for call in calls), 3),
+        'prompt_eval_tokens_last_turn': results[-1]['answer']['prompt_eval_count'],
+        'history_trimmed_turns': [result['turn'] for result in results[1:] if not result['history_kept']]
+    }
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[Text, Any]:
+    """
+    Runs the same session with both prompt layouts and compares prompt evaluation
+    :param args:
+    :return:
+    """
+
+    if args.base_url is None:
+        OllamaStub.PROMPT_TOKEN_DELAY_SECONDS = args.prompt_token_ms / 1000
+        OllamaStub.TOKEN_DELAY_SECONDS = 0.001
+        OllamaStub.ANSWER_TOKENS = args.answer_tokens
+        OllamaStub.start_in_thread(port=args.stub_port)
+        args.base_url = f'http://127.0.0.1:{args.stub_port}'
+    # Read by the Ollama client, when the chat model is created
+    os.environ['OLLAMA_HOST'] = args.base_url
+
+    results: Dict[Text, Any] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        DBUtils.DB_NAME = os.path.join(directory, 'rag_app.db')
+        DBUtils().create_application_logs()
+        ModelRegistry.BM25_INDEX_PATH = os.path.join(directory, 'bm25_index.npz')
+        recorder: PromptRecorder = PromptRecorder()
+        ModelRegistry.get_llm(args.model).callbacks.append(recorder)
+
+        for layout in LAYOUTS:
+            OllamaStub.cached_sequences.clear()
+            langchain_utils: LangChainUtils = create_langchain_utils(
+                layout, directory, args.chunks, args.chunk_tokens, args.seed
+            )
+            history_manager: ChatHistoryManager = ChatHistoryManager(
+                DBUtils(), langchain_utils, mode=HistoryMode.WINDOW,
+                window_step_turns=1 if layout == 'legacy' else ChatHistoryManager.WINDOW_STEP_TURNS
+            )
+            started: float = time.perf_counter()
+            session: List[Dict[Text, Any]] = run_session(
+                langchain_utils, history_manager, recorder, f'{layout}-{args.seed}', args.model, args.turns, args.seed
+            )
+            results[layout] = summarize_session(session, time.perf_counter() - started)
+
+    legacy, current = results['legacy'], results['prefix_stable']
+    results['prompt_eval_tokens_saved'] = legacy['prompt_eval_tokens'] - current['prompt_eval_tokens']
+    results['prompt_eval_seconds_saved'] = round(legacy['prompt_eval_seconds'] - current['prompt_eval_seconds'], 3)
+    results['prompt_eval_saved_share'] = round(
+        results['prompt_eval_tokens_saved'] / max(1, legacy['prompt_eval_tokens']), 3
+    )
+    return results
+
+
+if __name__ == '__main__':
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--base-url', default=None, help='Ollama to run against, the stub is started if not set')
+    parser.add_argument('--model', default='llama3')
+    parser.add_argument('--turns', type=int, default=16)
+    parser.add_argument('--chunks', type=int, default=50)
+    parser.add_argument('--chunk-tokens', type=int, default=250)
+    parser.add_argument('--answer-tokens', type=int, default=200, help='answer words of the stub, about 2 tokens each')
+    parser.add_argument('--prompt-token-ms', type=float, default=1.0, help='prompt evaluation time of the stub')
+    parser.add_argument('--stub-port', type=int, default=11436)
+    parser.add_argument('--seed', type=int, default=0)
+    args: argparse.Namespace = parser.parse_args()
+
+    print(json.dumps(run_benchmark(args), indent=2))
@@ -0,0 +1,287 @@
+"""
+This file benchmarks ingestion and retrieval on a synthetic labelled corpus.
+Documents are made of filler text with facts about unique identifiers
+(product SKUs, invoice numbers, error codes) hidden in it, every query
+asks about one fact and is answered by the chunks containing its identifier.
+
+Reports ingestion throughput, retrieval latency percentiles, recall@k,
+MRR and peak RSS, and writes them as JSON, so that runs with different
+chunking, k or embedding model can be compared over time.
+Runs offline by default: a hashing bag-of-words embedding and a fake LLM
+stand in for the HuggingFace model and Ollama.
+
+Usage: python -m benchmarks.retrieval_benchmark --documents 50 --queries 200 --output results.json
+"""
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from typing import Any, Dict, List, Optional, Text, Tuple
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import resource
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+FILLER_WORDS: List[str] = (
+    'the customer account order payment shipping delivery warehouse support team process policy request '
+    'update report quarter review service contract billing department manager system record schedule '
+    'approval document statement balance transfer region supplier inventory product return refund'
+).split()
+
+FACT_TEMPLATES: List[Tuple[str, str]] = [
+    ('Product {id} ships from the {place} warehouse with a {number} month warranty.',
+     'Which warehouse ships product {id}?'),
+    ('Invoice {id} was issued to {place} and is due within {number} days.',
+     'When is invoice {id} due?'),
+    ('Error code {id} means the {place} service timed out after {number} seconds.',
+     'What does error code {id} mean?')
+]
+ID_PREFIXES: List[str] = ['SKU', 'INV', 'ERR']
+PLACES: List[str] = ['Berlin', 'Austin', 'Osaka', 'Lyon', 'Denver', 'Porto', 'Tallinn', 'Quito']
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic offline embedding: hashed bag of words, L2-normalized.
+    Texts sharing words get similar vectors, so vector search recall is meaningful
+    """
+
+    def __init__(self, size: int = 384) -> None:
+        self.size: int = size
+
+    def _embed(self, text: str) -> List[float]:
+        vector: np.ndarray = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r'\w+', text.lower()):
+            digest: bytes = hashlib.md5(word.encode('utf-8')).digest()
+            vector[int.from_bytes(digest[:4], 'little') % self.size] += 1.0 if digest[4] % 2 else -1.0
+        norm: float = float(np.linalg.norm(vector))
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def build_corpus(
+        documents: int,
+        pages: int,
+        facts_per_page: int,
+        seed: int
+) -> Tuple[Dict[int, List[Document]], List[Dict[Text, str]]]:
+    """
+    Generates pages of every document and labelled queries about facts in them
+    :param documents:
+    :param pages:
+    :param facts_per_page:
+    :param seed:
+    :return: pages by file_id and queries with the identifier relevant chunks contain
+    """
+
+    generator: random.Random = random.Random(seed)
+    corpus: Dict[int, List[Document]] = {}
+    facts: List[Dict[Text, str]] = []
+
+    for file_id in range(1, documents + 1):
+        corpus[file_id] = []
+        for page_number in range(pages):
+            sentences: List[str] = [
+                ' '.join(generator.choices(FILLER_WORDS, k=generator.randint(8, 20))).capitalize() + '.'
+                for _ in range(40)
+            ]
+            for _ in range(facts_per_page):
+                template_number: int = generator.randrange(len(FACT_TEMPLATES))
+                fact_id: str = f'{ID_PREFIXES[template_number]}-{len(facts):05d}'
+                values: Dict[Text, Any] = {
+                    'id': fact_id, 'place': generator.choice(PLACES), 'number': generator.randint(2, 60)
+                }
+                statement, question = FACT_TEMPLATES[template_number]
+                sentences.insert(generator.randrange(len(sentences)), statement.format(**values))
+                facts.append({'question': question.format(**values), 'relevant': fact_id})
+            corpus[file_id].append(Document(page_content=' '.join(sentences), metadata={'page': page_number}))
+
+    return corpus, facts
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """
+    Returns percentile of values in milliseconds, None for no values
+    :param values:
+    :param fraction:
+    :return:
+    """
+
+    if not values:
+        return None
+    ordered: List[float] = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000, 3)
+
+
+def get_git_commit() -> Optional[str]:
+    """
+    Returns commit of the benchmarked tree, if it is a git checkout
+    :return:
+    """
+
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[Text, Any]:
+    """
+    Ingests the corpus through ChromaUtils and runs the queries through LangChainUtils
+    :param args:
+    :return:
+    """
+
+    # Chroma, the embedding cache and the BM25 index are created next to the working directory
+    working_directory: str = os.path.join(tempfile.mkdtemp(prefix='rag-retrieval-benchmark-'), 'run')
+    os.makedirs(working_directory)
+    os.chdir(working_directory)
+
+    from application_api.utils.embedding_cache import CachedEmbeddings
+    from application_api.utils.model_registry import ModelRegistry
+    from application_api.model.pydantic_models import ModelName
+    from langchain_core.language_models import FakeListLLM
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    if args.embeddings == 'hashing':
+        ModelRegistry._embedding_function = CachedEmbeddings(HashingEmbeddings(), model_name='hashing')
+    if args.llm == 'fake':
+        for model in ModelName:
+            ModelRegistry._llms[model.value] = FakeListLLM(responses=['This is a deterministic fake answer.'])
+
+    from application_api.utils.chroma_utils import ChromaUtils
+    from application_api.utils.langchain_utils import LangChainUtils
+
+    chroma_utils: ChromaUtils = ChromaUtils()
+    chroma_utils.text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap, length_function=len
+    )
+    chroma_utils.ingestion_pipeline.text_splitter = chroma_utils.text_splitter
+
+    corpus, queries = build_corpus(args.documents, args.pages, args.facts_per_page, args.seed)
+    queries = random.Random(args.seed).sample(queries, min(args.queries, len(queries)))
+
+    corpus_bytes: int = sum(len(page.page_content.encode('utf-8')) for pages in corpus.values() for page in pages)
+    started: float = time.perf_counter()
+    chunk_count: int = 0
+    for file_id, pages in corpus.items():
+        chunk_count += len(chroma_utils.ingestion_pipeline.run(iter(pages), file_id))
+    chroma_utils.bm25_index.save()
+    ingestion_seconds: float = time.perf_counter() - started
+
+    langchain_utils: LangChainUtils = LangChainUtils(chroma_utils.vector_store)
+    langchain_utils.retriever.k = args.k
+    langchain_utils.retriever.fetch_k = args.fetch_k
+    if args.retriever == 'vector':
+        from application_api.utils.bm25_index import BM25Index
+        # Fusion with an empty lexical ranking keeps the vector search order
+        langchain_utils.retriever.bm25_index = BM25Index()
+    elif args.rerank:
+        from application_api.utils.reranker import CrossEncoderReranker
+        langchain_utils.retriever.reranker = CrossEncoderReranker()
+        langchain_utils.retriever.rerank_fetch_k = args.rerank_fetch_k
+
+    latencies: List[float] = []
+    hits: int = 0
+    reciprocal_ranks: List[float] = []
+    for query in queries:
+        started = time.perf_counter()
+        _, documents = langchain_utils.retrieve(query['question'], [], args.model)
+        latencies.append(time.perf_counter() - started)
+
+        ranks: List[int] = [
+            rank for rank, document in enumerate(documents[:args.k], start=1)
+            if query['relevant'] in document.page_content
+        ]
+        hits += 1 if ranks else 0
+        reciprocal_ranks.append(1.0 / ranks[0] if ranks else 0.0)
+
+    answer_latencies: List[float] = []
+    for query in queries[:args.answer_queries]:
+        started = time.perf_counter()
+        langchain_utils.answer(query['question'], [], args.model)
+        answer_latencies.append(time.perf_counter() - started)
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': get_git_commit(),
+        'config': {
+            'documents': args.documents,
+            'pages': args.pages,
+            'queries': len(queries),
+            'chunk_size': args.chunk_size,
+            'chunk_overlap': args.chunk_overlap,
+            'k': args.k,
+            'fetch_k': args.fetch_k,
+            'retriever': args.retriever,
+            'rerank_fetch_k': args.rerank_fetch_k if args.rerank else None,
+            'embeddings': args.embeddings,
+            'llm': args.llm,
+            'seed': args.seed
+        },
+        'ingestion': {
+            'chunks': chunk_count,
+            'seconds': round(ingestion_seconds, 3),
+            'chunks_per_second': round(chunk_count / ingestion_seconds, 1),
+            'megabytes_per_second': round(corpus_bytes / 1e6 / ingestion_seconds, 3)
+        },
+        'retrieval_latency_ms': {
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99)
+        },
+        'answer_latency_ms': {
+            'p50': percentile(answer_latencies, 0.5),
+            'p95': percentile(answer_latencies, 0.95),
+            'p99': percentile(answer_latencies, 0.99)
+        },
+        f'recall_at_{args.k}': round(hits / len(queries), 4),
+        'mrr': round(sum(reciprocal_ranks) / len(queries), 4),
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    }
+
+
+if __name__ == '__main__':
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--documents', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--facts-per-page', type=int, default=3)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--answer-queries', type=int, default=20)
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--chunk-overlap', type=int, default=200)
+    parser.add_argument('--k', type=int, default=2)
+    parser.add_argument('--fetch-k', type=int, default=10)
+    parser.add_argument('--retriever', choices=['hybrid', 'vector'], default='hybrid')
+    parser.add_argument('--rerank', action='store_true', help='rerank hybrid candidates with the cross-encoder')
+    parser.add_argument('--rerank-fetch-k', type=int, default=40)
+    parser.add_argument('--embeddings', choices=['hashing', 'huggingface'], default='hashing')
+    parser.add_argument('--llm', choices=['fake', 'ollama'], default='fake')
+    parser.add_argument('--model', default='llama3')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON file to write results to')
+    args: argparse.Namespace = parser.parse_args()
+
+    output_path: Optional[str] = os.path.abspath(args.output) if args.output else None
+    results: Dict[Text, Any] = run_benchmark(args)
+
+    print(json.dumps(results, indent=2))
+    if output_path:
+        with open(output_path, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,249 @@
+"""
+This file benchmarks the quantized vector store against Chroma on a synthetic
+corpus of clustered embeddings. For every backend it reports ingestion time,
+size on disk, startup time (opening the store and answering the first query
+in a fresh process), memory of the searching process, query latency and
+recall@k against exact float32 search.
+
+Usage: python -m benchmarks.vector_store_benchmark --chunks 100000 --queries 200
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Set, Text
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BACKENDS: List[str] = ['chroma', 'quantized', 'quantized_no_rescore']
+BATCH_SIZE: int = 1000
+
+
+def make_centers(chunks: int, dimension: int, seed: int) -> np.ndarray:
+    """
+    Returns centers of the clusters the corpus is made of, a cluster for every hundred chunks
+    :param chunks:
+    :param dimension:
+    :param seed:
+    :return:
+    """
+
+    return np.random.default_rng(seed).normal(size=(max(1, chunks // 100), dimension)).astype(np.float32)
+
+
+def make_corpus(centers: np.ndarray, chunks: int, seed: int) -> np.ndarray:
+    """
+    Returns unit vectors scattered around the centers, standing in for chunk embeddings
+    :param centers:
+    :param chunks:
+    :param seed:
+    :return:
+    """
+
+    rng: np.random.Generator = np.random.default_rng(seed + 2)
+    vectors: np.ndarray = np.empty((chunks, centers.shape[1]), dtype=np.float32)
+    for start in range(0, chunks, BATCH_SIZE):
+        end: int = min(chunks, start + BATCH_SIZE)
+        vectors[start:end] = centers[rng.integers(0, len(centers), end - start)]
+        vectors[start:end] += rng.normal(scale=0.7, size=(end - start, centers.shape[1]))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def make_queries(centers: np.ndarray, count: int, seed: int) -> np.ndarray:
+    """
+    Returns unit query vectors near the cluster centers, generated without the corpus,
+    so that the searching process does not hold the corpus in memory
+    :param centers:
+    :param count:
+    :param seed:
+    :return:
+    """
+
+    rng: np.random.Generator = np.random.default_rng(seed + 1)
+    queries: np.ndarray = centers[rng.integers(0, len(centers), count)] + rng.normal(
+        scale=0.7, size=(count, centers.shape[1])
+    ).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def get_rss_mb() -> Optional[float]:
+    """
+    Returns resident memory of this process, None where /proc is not available
+    :return:
+    """
+
+    try:
+        with open('/proc/self/statm') as file:
+            return round(int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
+    except OSError:
+        return None
+
+
+def get_collection_opener(backend: str) -> Callable[[str], Any]:
+    """
+    Imports a backend and returns function, that opens its collection in a directory.
+    Both backends are written and searched through the collection API
+    :param backend:
+    :return:
+    """
+
+    if backend == 'chroma':
+        from langchain_chroma import Chroma
+        return lambda directory: Chroma(persist_directory=directory)._collection
+
+    from application_api.utils.quantized_vector_store import QuantizedCollection
+    return lambda directory: QuantizedCollection(directory, rescore=backend == 'quantized')
+
+
+def build(args: argparse.Namespace) -> Dict[Text, Any]:
+    """
+    Writes the corpus into a new store of the backend
+    :param args:
+    :return:
+    """
+
+    vectors: np.ndarray = make_corpus(make_centers(args.chunks, args.dimension, args.seed), args.chunks, args.seed)
+    open_collection: Callable[[str], Any] = get_collection_opener(args.backend)
+    started: float = time.perf_counter()
+    collection: Any = open_collection(args.directory)
+    for start in range(0, len(vectors), BATCH_SIZE):
+        end: int = min(len(vectors), start + BATCH_SIZE)
+        collection.upsert(
+            ids=[str(number) for number in range(start, end)],
+            embeddings=vectors[start:end].tolist(),
+            metadatas=[{'file_id': number % args.files} for number in range(start, end)],
+            documents=[f'chunk {number}' for number in range(start, end)]
+        )
+    return {'ingestion_seconds': round(time.perf_counter() - started, 2)}
+
+
+def search(args: argparse.Namespace) -> Dict[Text, Any]:
+    """
+    Opens the store in this fresh process and runs the queries one by one
+    :param args:
+    :return:
+    """
+
+    queries: np.ndarray = make_queries(make_centers(args.chunks, args.dimension, args.seed), args.queries, args.seed)
+    # Modules are imported before measuring, so that only the store is measured
+    open_collection: Callable[[str], Any] = get_collection_opener(args.backend)
+    rss_before: Optional[float] = get_rss_mb()
+
+    started: float = time.perf_counter()
+    collection: Any = open_collection(args.directory)
+    collection.query(query_embeddings=[queries[0].tolist()], n_results=args.k)
+    startup_seconds: float = time.perf_counter() - started
+
+    found: List[List[str]] = []
+    latencies: List[float] = []
+    for query in queries:
+        query_started: float = time.perf_counter()
+        results: Dict[Text, Any] = collection.query(query_embeddings=[query.tolist()], n_results=args.k)
+        latencies.append(time.perf_counter() - query_started)
+        found.append(results['ids'][0])
+
+    rss_after: Optional[float] = get_rss_mb()
+    return {
+        'startup_seconds': round(startup_seconds, 3),
+        'query_latency_ms': {
+            'p50': round(float(np.percentile(latencies, 50)) * 1000, 2),
+            'p95': round(float(np.percentile(latencies, 95)) * 1000, 2)
+        },
+        # Peak memory is not reported, a child process inherits it from its parent on Linux
+        'store_rss_mb': round(rss_after - rss_before, 1) if rss_before is not None else None,
+        'found': found
+    }
+
+
+def run_phase(phase: str, backend: str, directory: str, args: argparse.Namespace) -> Dict[Text, Any]:
+    """
+    Runs a phase in a fresh process, so that startup and memory of every backend are measured apart
+    :param phase:
+    :param backend:
+    :param directory:
+    :param args:
+    :return:
+    """
+
+    output: str = subprocess.run([
+        sys.executable, '-m', 'benchmarks.vector_store_benchmark', '--phase', phase, '--backend', backend,
+        '--directory', directory, '--chunks', str(args.chunks), '--dimension', str(args.dimension),
+        '--queries', str(args.queries), '--k', str(args.k), '--files', str(args.files), '--seed', str(args.seed)
+    ], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def get_size_mb(directory: str) -> float:
+    """
+    Returns disk space taken by all files in a directory, unwritten parts of sparse files are not counted
+    :param directory:
+    :return:
+    """
+
+    # st_blocks is counted in 512-byte blocks
+    return round(sum(
+        os.stat(os.path.join(root, name)).st_blocks * 512 for root, _, names in os.walk(directory) for name in names
+    ) / 2 ** 20, 1)
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict[Text, Any]:
+    """
+    Builds a store of every backend, searches it in a fresh process and compares results with exact search
+    :param args:
+    :return:
+    """
+
+    centers: np.ndarray = make_centers(args.chunks, args.dimension, args.seed)
+    vectors: np.ndarray = make_corpus(centers, args.chunks, args.seed)
+    queries: np.ndarray = make_queries(centers, args.queries, args.seed)
+    # Squared distances without the constant norm of the query
+    norms: np.ndarray = (vectors * vectors).sum(axis=1)
+    exact: List[Set[str]] = [
+        {str(number) for number in np.argsort(norms - 2 * vectors @ query)[:args.k]} for query in queries
+    ]
+    del vectors
+
+    results: Dict[Text, Any] = {'chunks': args.chunks, 'dimension': args.dimension}
+    root: str = tempfile.mkdtemp()
+    try:
+        for backend in args.backends:
+            directory: str = os.path.join(root, backend)
+            backend_results: Dict[Text, Any] = run_phase('build', backend, directory, args)
+            backend_results['disk_mb'] = get_size_mb(directory)
+            backend_results.update(run_phase('search', backend, directory, args))
+            found: List[List[str]] = backend_results.pop('found')
+            backend_results[f'recall_at_{args.k}'] = round(float(np.mean([
+                len(exact_ids & set(found_ids)) / args.k for exact_ids, found_ids in zip(exact, found)
+            ])), 4)
+            results[backend] = backend_results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chunks', type=int, default=100000)
+    parser.add_argument('--dimension', type=int, default=384)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--phase', choices=['build', 'search'], default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--backend', choices=BACKENDS, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--directory', default=None, help=argparse.SUPPRESS)
+    args: argparse.Namespace = parser.parse_args()
+
+    if args.phase == 'build':
+        print(json.dumps(build(args)))
+    elif args.phase == 'search':
+        print(json.dumps(search(args)))
+    else:
+        print(json.dumps(run_benchmark(args), indent=2))
@@ -0,0 +1,112 @@
+"""
+This file tests, that the BM25 index saved by the writer as a snapshot and a journal
+is read by other workers with the same content, replaying only the changes
+"""
+
+from application_api.utils.bm25_index import BM25Index
+
+from typing import Any, List, Tuple
+import os
+import random
+
+WORDS: List[str] = ['invoice', 'refund', 'INV-2024-0042', 'delivery', 'warranty', 'penalty', 'clause', 'SKU-77']
+QUERIES: List[str] = ['invoice refund', 'INV-2024-0042', '0042 delivery', 'warranty clause penalty', 'SKU-77']
+
+
+def add_file(index: BM25Index, file_id: int, chunks: int, seed: int) -> None:
+    """
+    Adds chunks of random words of a file
+    :param index:
+    :param file_id:
+    :param chunks:
+    :param seed:
+    :return:
+    """
+
+    rng: random.Random = random.Random(seed)
+    index.add(
+        [f'{file_id}-{number}' for number in range(chunks)],
+        [' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 30))) for _ in range(chunks)],
+        [file_id] * chunks
+    )
+
+
+def search_all(index: BM25Index) -> List[List[Tuple[str, float]]]:
+    return [index.search(query, 10) for query in QUERIES] + [index.search('invoice', 10, file_ids=[2])]
+
+
+def assert_same(first: BM25Index, second: BM25Index) -> None:
+    assert len(first) == len(second)
+    assert first._chunk_ids == second._chunk_ids
+    assert first._deleted == second._deleted
+    assert search_all(first) == search_all(second)
+
+
+def test_reader_replays_journal(tmp_path: Any) -> None:
+    path: str = str(tmp_path / 'bm25_index.npz')
+    writer: BM25Index = BM25Index(path, reload_interval=0.0)
+    for file_id in range(1, 5):
+        add_file(writer, file_id, 40, seed=file_id)
+    writer.save()
+    reader: BM25Index = BM25Index(path, reload_interval=0.0)
+    assert reader.load()
+    snapshot_version: Tuple[int, int] = writer._get_file_version()
+
+    add_file(writer, 5, 10, seed=5)
+    writer.remove_chunks(['1-0', '1-1'])
+    writer.save()
+    # Enough removals to compact postings, which replaying the journal has to repeat
+    writer.remove_file(2)
+    writer.remove_file(3)
+    writer.save()
+
+    assert writer._get_file_version() == snapshot_version
+    assert reader.reload_if_changed()
+    assert_same(writer, reader)
+    assert not reader.reload_if_changed()
+
+    restarted: BM25Index = BM25Index(path)
+    assert restarted.load()
+    assert_same(writer, restarted)
+
+
+def test_rebuild_and_long_journal_write_snapshot(tmp_path: Any) -> None:
+    path: str = str(tmp_path / 'bm25_index.npz')
+    writer: BM25Index = BM25Index(path, reload_interval=0.0)
+    add_file(writer, 1, 20, seed=1)
+    writer.save()
+    reader: BM25Index = BM25Index(path, reload_interval=0.0)
+    reader.load()
+
+    snapshot_version: Tuple[int, int] = writer._get_file_version()
+    add_file(writer, 2, 200, seed=2)
+    writer.save()
+    assert writer._get_file_version() != snapshot_version
+    assert os.path.getsize(writer.journal_path) == writer._journal_offset
+    assert reader.reload_if_changed()
+    assert_same(writer, reader)
+
+    writer.rebuild([(f'3-{number}', 'invoice INV-2024-0042', 3) for number in range(5)])
+    assert not writer._pending
+    writer.save()
+    assert reader.reload_if_changed()
+    assert_same(writer, reader)
+
+
+def test_record_cut_off_is_read_when_complete(tmp_path: Any) -> None:
+    path: str = str(tmp_path / 'bm25_index.npz')
+    writer: BM25Index = BM25Index(path, reload_interval=0.0)
+    add_file(writer, 1, 20, seed=1)
+    writer.save()
+    reader: BM25Index = BM25Index(path, reload_interval=0.0)
+    reader.load()
+
+    writer.remove_chunks(['1-0'])
+    record: bytes = f'{writer._pending[0]}\n'.encode('utf-8')
+    with open(writer.journal_path, 'ab') as file:
+        file.write(record[:-5])
+    assert not reader.reload_if_changed()
+    with open(writer.journal_path, 'ab') as file:
+        file.write(record[-5:])
+    assert reader.reload_if_changed()
+    assert_same(writer, reader)
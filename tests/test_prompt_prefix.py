@@ -0,0 +1,105 @@
+"""
+This file tests, that prompts of a chat session answered by LangChainUtils.answer
+keep the previous prompt as prefix, so that Ollama evaluates only what is new.
+Turns are answered against the Ollama stub, that emulates the prompt cache
+"""
+
+from application_api.utils.db_utils import DBUtils
+from application_api.utils.history_utils import ChatHistoryManager
+from application_api.utils.langchain_utils import LangChainUtils
+from application_api.utils.model_registry import ModelRegistry
+from benchmarks.ollama_stub import OllamaStub
+from benchmarks.prompt_prefix_benchmark import PromptRecorder, create_langchain_utils, run_session
+
+from langchain_core.messages import BaseMessage
+from typing import Any, Dict, Iterator, List, Text
+import os
+import socket
+
+import pytest
+
+MODEL: str = 'llama3'
+TURNS: int = 16
+# Roles of LangChain messages in Ollama requests
+ROLES: Dict[str, str] = {'system': 'system', 'human': 'user', 'ai': 'assistant'}
+
+
+def count_stub_tokens(messages: List[BaseMessage]) -> int:
+    """
+    Returns number of tokens the stub evaluates for messages without a cached prefix
+    :param messages:
+    :return:
+    """
+
+    prompt: str = OllamaStub.render_prompt({
+        'messages': [{'role': ROLES[message.type], 'content': message.content} for message in messages]
+    })
+    return -(-len(prompt) // OllamaStub.CHARACTERS_PER_TOKEN)
+
+
+@pytest.fixture(scope='module')
+def session(tmp_path_factory: pytest.TempPathFactory) -> Iterator[List[Dict[Text, Any]]]:
+    """
+    Answers a chat session with answers of about 400 tokens, so that history is trimmed to the token budget
+    :param tmp_path_factory:
+    :return:
+    """
+
+    directory: str = str(tmp_path_factory.mktemp('prompt_prefix'))
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port: int = free_socket.getsockname()[1]
+
+    # Module scoped fixtures can't use the monkeypatch fixture, everything set here is restored on exit
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(OllamaStub, 'TOKEN_DELAY_SECONDS', 0.0)
+        monkeypatch.setattr(OllamaStub, 'ANSWER_TOKENS', 200)
+        monkeypatch.setattr(OllamaStub, 'cached_sequences', {})
+        monkeypatch.setenv('OLLAMA_HOST', f'http://127.0.0.1:{port}')
+        monkeypatch.setattr(DBUtils, 'DB_NAME', os.path.join(directory, 'rag_app.db'))
+        monkeypatch.setattr(ModelRegistry, 'BM25_INDEX_PATH', os.path.join(directory, 'bm25_index.npz'))
+        monkeypatch.setattr(ModelRegistry, '_bm25_index', None)
+        # A chat model created before is put back on exit, the one created here is removed
+        monkeypatch.delitem(ModelRegistry._llms, MODEL, raising=False)
+        DBUtils().create_application_logs()
+        server: Any = OllamaStub.start_in_thread(port=port)
+
+        try:
+            recorder: PromptRecorder = PromptRecorder()
+            ModelRegistry.get_llm(MODEL).callbacks.append(recorder)
+            langchain_utils: LangChainUtils = create_langchain_utils('prefix_stable', directory, 50, 250, 0)
+            yield run_session(
+                langchain_utils, ChatHistoryManager(DBUtils(), langchain_utils), recorder, 'session', MODEL, TURNS, 0
+            )
+        finally:
+            server.should_exit = True
+            ModelRegistry._llms.pop(MODEL, None)
+
+
+def test_history_is_trimmed_in_window_steps(session: List[Dict[Text, Any]]) -> None:
+    trimmed_turns: List[int] = [result['turn'] for result in session[1:] if not result['history_kept']]
+
+    assert trimmed_turns, 'the session is expected to outgrow the history budget'
+    for previous, following in zip(trimmed_turns, trimmed_turns[1:]):
+        assert following - previous >= ChatHistoryManager.WINDOW_STEP_TURNS
+
+
+def test_rewrite_keeps_answer_prefix_cached(session: List[Dict[Text, Any]]) -> None:
+    rewritten: List[Dict[Text, Any]] = [result for result in session if result['rewrite'] is not None]
+
+    assert rewritten, 'follow-up questions are expected to be rewritten'
+    for result in rewritten:
+        messages: List[BaseMessage] = result['answer']['messages']
+        # The rewrite evaluated the history, only the last message of the answer prompt is new
+        assert result['answer']['prompt_eval_count'] <= count_stub_tokens(messages[-1:]) + 1, result['turn']
+
+
+def test_only_new_turns_are_evaluated(session: List[Dict[Text, Any]]) -> None:
+    for result in session[1:]:
+        if not result['history_kept']:
+            continue
+        # Prompts start with the system prompt and the history of the previous prompt
+        cached_messages: int = 1 + len(result['previous_history'])
+        first_call: Dict[Text, Any] = result['rewrite'] or result['answer']
+        new_messages: List[BaseMessage] = first_call['messages'][cached_messages:]
+        assert first_call['prompt_eval_count'] <= count_stub_tokens(new_messages) + 1, result['turn']
@@ -0,0 +1,98 @@
+"""
+This file tests, that workers sharing the quantized store see each other's writes.
+Every worker is modelled by its own QuantizedCollection over the same directory,
+with its own SQLite connection and memory-mapped files
+"""
+
+from application_api.utils.config import Config
+from application_api.utils.model_registry import ModelRegistry
+from application_api.utils.quantized_vector_store import QuantizedCollection
+
+from typing import Any, Dict, List, Text
+
+import numpy as np
+import pytest
+
+DIMENSION: int = 8
+
+
+def make_chunks(file_id: int, count: int, seed: int) -> Dict[Text, Any]:
+    """
+    Returns upsert arguments for count random chunks of a file
+    :param file_id:
+    :param count:
+    :param seed:
+    :return:
+    """
+
+    rng: np.random.Generator = np.random.default_rng(seed)
+    return {
+        'ids': [f'{file_id}-{number}' for number in range(count)],
+        'embeddings': rng.normal(size=(count, DIMENSION)).tolist(),
+        'metadatas': [{'file_id': file_id} for _ in range(count)],
+        'documents': [f'chunk {number} of file {file_id}' for number in range(count)]
+    }
+
+
+def search_ids(collection: QuantizedCollection, embeddings: List[List[float]]) -> List[str]:
+    """
+    Returns id of the nearest chunk of every embedding
+    :param collection:
+    :param embeddings:
+    :return:
+    """
+
+    return [ids[0] if ids else None for ids in collection.query(embeddings, n_results=1)['ids']]
+
+
+def test_reader_sees_chunks_written_by_writer(tmp_path: Any) -> None:
+    # The reader opens the store before anything is written, so it does not know the dimension yet
+    reader: QuantizedCollection = QuantizedCollection(str(tmp_path), reload_interval=0.0)
+    writer: QuantizedCollection = QuantizedCollection(str(tmp_path), reload_interval=0.0)
+    first: Dict[Text, Any] = make_chunks(1, 10, seed=0)
+    writer.upsert(**first)
+    assert search_ids(reader, first['embeddings']) == first['ids']
+
+    # Enough chunks to grow the vector files past the capacity the reader has mapped
+    second: Dict[Text, Any] = make_chunks(2, QuantizedCollection.MIN_CAPACITY + 10, seed=1)
+    writer.upsert(**second)
+    assert search_ids(reader, second['embeddings'][-3:]) == second['ids'][-3:]
+    assert len(reader.get(where={'file_id': 2})['ids']) == len(second['ids'])
+
+    writer.delete(where={'file_id': 1})
+    assert all(chunk_id is None or chunk_id.startswith('2-') for chunk_id in search_ids(reader, first['embeddings']))
+
+
+def test_reader_waits_for_reload_interval(tmp_path: Any) -> None:
+    reader: QuantizedCollection = QuantizedCollection(str(tmp_path), reload_interval=3600.0)
+    writer: QuantizedCollection = QuantizedCollection(str(tmp_path))
+    chunks: Dict[Text, Any] = make_chunks(1, 5, seed=0)
+    reader.query(chunks['embeddings'][:1])
+    writer.upsert(**chunks)
+
+    assert search_ids(reader, chunks['embeddings']) == [None] * 5
+    assert reader.reload_if_changed(force=True)
+    assert search_ids(reader, chunks['embeddings']) == chunks['ids']
+
+
+def test_new_writer_does_not_reuse_taken_slots(tmp_path: Any) -> None:
+    # Both collections are opened empty, the second becomes the writer after the first wrote
+    first_writer: QuantizedCollection = QuantizedCollection(str(tmp_path))
+    second_writer: QuantizedCollection = QuantizedCollection(str(tmp_path))
+    first: Dict[Text, Any] = make_chunks(1, 10, seed=0)
+    second: Dict[Text, Any] = make_chunks(2, 10, seed=1)
+    first_writer.upsert(**first)
+    first_writer.delete(ids=first['ids'][:2])
+    second_writer.upsert(**second)
+
+    assert second_writer.count() == 18
+    assert search_ids(second_writer, first['embeddings'][2:]) == first['ids'][2:]
+    assert search_ids(second_writer, second['embeddings']) == second['ids']
+
+
+def test_quantized_store_refuses_chroma_server(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(Config, 'VECTOR_STORE', 'quantized')
+    monkeypatch.setattr(Config, 'CHROMA_HOST', '127.0.0.1')
+    monkeypatch.setattr(ModelRegistry, '_vector_store', None)
+    with pytest.raises(ValueError, match='RAG_CHROMA_HOST'):
+        ModelRegistry.get_vector_store()
@@ -5,7 +5,7 @@ This file implements user interaction with chat.
 from ui.utils.api_utils import APIUtils
 
 import streamlit as st
-from typing import Any
+from typing import Any, Dict, Text, Iterator
 
 
 class ChatInterface:
@@ -29,25 +29,47 @@ class ChatInterface:
             with st.chat_message('user'):
                 st.markdown(prompt)
 
-            # Get AI response
-            with st.spinner('Generating response...'):
-                response: Any = self.api_utils.get_api_response(
-                    question=prompt, session_id=st.session_state.session_id, model=st.session_state.model
-                )
-
-                if response:
-                    st.session_state.session_id = response.get('session_id')
-                    st.session_state.messages.append({'role': 'ai', 'content': response['answer']})
-
-                    with st.chat_message('ai'):
-                        st.markdown(response['answer'])
-
-                    with st.expander('Details'):
-                        st.subheader('Generated Answer')
-                        st.code(response['answer'])
-                        st.subheader('Model Used')
-                        st.code(response['model'])
-                        st.subheader('Session ID')
-                        st.code(response['session_id'])
-                else:
-                    st.error('Failed to get response from the API. Please try again.')
+            # Stream AI response
+            stream_info: Dict[Text, Any] = {}
+            with st.chat_message('ai'):
+                answer: Any = st.write_stream(self._stream_answer(prompt, stream_info))
+
+            if 'end' in stream_info:
+                st.session_state.session_id = stream_info['end'].get('session_id')
+                st.session_state.messages.append({'role': 'ai', 'content': answer})
+
+                with st.expander('Details'):
+                    st.subheader('Generated Answer')
+                    st.code(answer)
+                    st.subheader('Model Used')
+                    st.code(stream_info['end']['model'])
+                    st.subheader('Session ID')
+                    st.code(stream_info['end']['session_id'])
+                    if 'context' in stream_info:
+                        st.subheader('Context IDs')
+                        st.code('\n'.join(str(context_id) for context_id in stream_info['context']['context_ids']))
+            else:
+                st.error(stream_info.get('error', 'Failed to get response from the API. Please try again.'))
+
+    def _stream_answer(self, prompt: str, stream_info: Dict[Text, Any]) -> Iterator[Text]:
+        """
+        Yields answer tokens from the streaming API and keeps
+        the remaining events (context, end, error) in stream_info
+        :param prompt:
+        :param stream_info:
+        :return:
+        """
+
+        for event in self.api_utils.stream_api_response(
+            question=prompt,
+            session_id=st.session_state.session_id,
+            model=st.session_state.model,
+            file_ids=st.session_state.selected_file_ids,
+            tags=st.session_state.selected_tags
+        ):
+            if event['type'] == 'token':
+                yield event['content']
+            elif event['type'] == 'error':
+                stream_info['error'] = f"Generation failed: {event['detail']}"
+            else:
+                stream_info[event['type']] = event
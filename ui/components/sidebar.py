@@ -6,7 +6,7 @@ Sidebar handles document managing and model selection.
 from ui.utils.api_utils import APIUtils
 
 import streamlit as st
-from typing import List, Text, Any
+from typing import List, Text, Any, Dict
 
 
 class Sidebar:
@@ -25,12 +25,20 @@ class Sidebar:
 
         # Document upload
         uploaded_file = st.sidebar.file_uploader('Choose a file', type=['pdf', 'docx', 'html'])
+        tags: str = st.sidebar.text_input('Tags (comma-separated)')
+        force_reindex: bool = st.sidebar.checkbox('Re-index if already uploaded')
         if uploaded_file and st.sidebar.button('Upload'):
             with st.spinner('Uploading...'):
-                upload_response: Any = self.api_utils.upload_document(uploaded_file)
-                if upload_response:
-                    st.sidebar.success(f"File uploaded successfully with ID {upload_response['file_id']}.")
-                    st.session_state.documents = self.api_utils.list_documents()
+                upload_response: Any = self.api_utils.upload_document(uploaded_file, force=force_reindex, tags=tags)
+                if upload_response and upload_response.get('duplicate'):
+                    st.sidebar.info(f"File is already indexed with ID {upload_response['file_id']}.")
+                elif upload_response:
+                    st.sidebar.info(f"File uploaded with ID {upload_response['file_id']}, indexing has started.")
+                    st.session_state.pending_jobs[upload_response['job_id']] = uploaded_file.name
+
+        # Progress of documents being indexed
+        with st.sidebar:
+            self.display_ingestion_jobs()
 
         # List and delete documents
         st.sidebar.header('Uploaded Documents')
@@ -40,7 +48,10 @@ class Sidebar:
         # Display document list and delete functionality
         if 'documents' in st.session_state and st.session_state.documents:
             for doc in st.session_state.documents:
-                st.sidebar.text(f"{doc['filename']} (ID {doc['id']})")
+                tags_text: str = f", tags: {', '.join(doc['tags'])}" if doc.get('tags') else ''
+                st.sidebar.text(f"{doc['filename']} (ID {doc['id']}{tags_text})")
+
+            self.display_search_scope()
 
             selected_file = st.sidebar.selectbox(
                 'Select document to delete',
@@ -51,3 +62,63 @@ class Sidebar:
                 if delete_response:
                     st.sidebar.success(f"Successfully deleted document with ID {selected_file}")
                     st.session_state.documents = self.api_utils.list_documents()
+
+    @staticmethod
+    def display_search_scope() -> None:
+        """
+        Lets user limit the documents the session searches in.
+        Nothing selected means all documents are searched.
+        :return:
+        """
+
+        st.sidebar.subheader('Search Scope')
+        documents: Dict[int, Text] = {doc['id']: doc['filename'] for doc in st.session_state.documents}
+        all_tags: List[Text] = sorted({tag for doc in st.session_state.documents for tag in doc.get('tags', [])})
+
+        # Documents deleted since the last refresh can't stay selected
+        st.session_state.selected_file_ids = [
+            file_id for file_id in st.session_state.selected_file_ids if file_id in documents
+        ]
+        st.session_state.selected_tags = [tag for tag in st.session_state.selected_tags if tag in all_tags]
+
+        st.sidebar.multiselect(
+            'Search only in documents',
+            options=list(documents),
+            format_func=lambda file_id: f'{documents[file_id]} (ID {file_id})',
+            key='selected_file_ids'
+        )
+        if all_tags:
+            st.sidebar.multiselect('Search only in documents tagged', options=all_tags, key='selected_tags')
+
+    @st.fragment(run_every=2)
+    def display_ingestion_jobs(self) -> None:
+        """
+        Polls status of pending ingestion jobs and shows their progress.
+        :return:
+        """
+
+        finished: bool = False
+        for job_id, filename in list(st.session_state.pending_jobs.items()):
+            job: Dict[Text, Any] = self.api_utils.get_job_status(job_id)
+            if not job:
+                continue
+
+            if job['status'] == 'completed':
+                del st.session_state.pending_jobs[job_id]
+                st.toast(f"{filename} has been indexed ({job['chunks_embedded']} chunks).")
+                finished = True
+            elif job['status'] == 'failed':
+                del st.session_state.pending_jobs[job_id]
+                st.toast(f"Failed to index {filename}: {job['error']}")
+                finished = True
+            else:
+                progress: float = job['chunks_embedded'] / job['chunks_total'] if job['chunks_total'] else 0.0
+                st.progress(
+                    progress,
+                    text=f"{filename}: {job['status']}, {job['pages_parsed']} pages parsed, "
+                         f"{job['chunks_embedded']}/{job['chunks_total']} chunks embedded"
+                )
+
+        if finished:
+            st.session_state.documents = self.api_utils.list_documents()
+            st.rerun()
@@ -29,6 +29,15 @@ class StreamlitApp:
         if 'session_id' not in st.session_state:
             st.session_state.session_id = None
 
+        if 'pending_jobs' not in st.session_state:
+            st.session_state.pending_jobs = {}
+
+        if 'selected_file_ids' not in st.session_state:
+            st.session_state.selected_file_ids = []
+
+        if 'selected_tags' not in st.session_state:
+            st.session_state.selected_tags = []
+
         # Displaying components
         self.sidebar.display()
         self.chat_interface.display()
@@ -2,9 +2,10 @@
 This file contains API interaction utils
 """
 
+import json
 import requests
 import streamlit as st
-from typing import Dict, Text, Any
+from typing import Dict, Text, Any, Iterator, List, Optional
 
 
 class APIUtils:
@@ -40,17 +41,63 @@ class APIUtils:
             return None
 
     @staticmethod
-    def upload_document(file) -> Any:
+    def stream_api_response(
+            question: str,
+            session_id: str,
+            model: str,
+            file_ids: Optional[List[int]] = None,
+            tags: Optional[List[str]] = None
+    ) -> Iterator[Dict[Text, Any]]:
+        """
+        Sends chat queries and yields response events as they arrive.
+        Search is limited to file_ids and documents with tags if any are given.
+        :param question:
+        :param session_id:
+        :param model:
+        :param file_ids:
+        :param tags:
+        :return:
+        """
+
+        headers: Dict[Text, Text] = {'accept': 'application/x-ndjson', 'Content-Type': 'application/json'}
+        data: Dict[Text, Any] = {'question': question, 'model': model}
+        if session_id:
+            data['session_id'] = session_id
+        if file_ids or tags:
+            data['file_ids'] = file_ids or []
+            data['tags'] = tags or []
+
+        try:
+            with requests.post(
+                url='http://localhost:8000/chat/stream', headers=headers, json=data, stream=True
+            ) as response:
+                if response.status_code != 200:
+                    st.error(f'API request failed with status code {response.status_code}: {response.text}')
+                    return
+
+                # chunk_size=None hands lines over as soon as they are received
+                for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                    if line:
+                        yield json.loads(line)
+        except Exception as e:
+            st.error(f'An error occurred: {str(e)}')
+
+    @staticmethod
+    def upload_document(file, force: bool = False, tags: str = '') -> Any:
         """
         Handles file uploads to the backend.
         :param file:
+        :param force:
+        :param tags: comma-separated tags of the document
         :return:
         """
 
         try:
             files: Dict[Text, Any] = {'file': (file.name, file, file.type)}
+            # Tags are sent only when given, so that re-uploads keep tags of the stored document
+            data: Dict[Text, Any] = {'tags': tags} if tags.strip() else {}
             response: requests.Response = requests.post(
-                url='http://localhost:8000/upload-doc', files=files
+                url='http://localhost:8000/upload-doc', files=files, data=data, params={'force': force}
             )
             if response.status_code == 200:
                 return response.json()
@@ -61,6 +108,25 @@ class APIUtils:
             st.error(f'An error occurred while uploading the file: {str(e)}')
             return None
 
+    @staticmethod
+    def get_job_status(job_id: str) -> Any:
+        """
+        Retrieves status and progress of a document ingestion job.
+        :param job_id:
+        :return:
+        """
+
+        try:
+            response: requests.Response = requests.get(url=f'http://localhost:8000/jobs/{job_id}')
+            if response.status_code == 200:
+                return response.json()
+            else:
+                st.error(f'Failed to fetch job status. Error: {response.status_code} - {response.text}')
+                return None
+        except Exception as e:
+            st.error(f'An error occurred while fetching the job status: {str(e)}')
+            return None
+
     @staticmethod
     def list_documents() -> Any:
         """